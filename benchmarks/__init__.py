@@ -0,0 +1,8 @@
+"""
+بنچمارک‌های بک‌اند FardaPack CRM.
+از ریشه مخزن اجرا شوند، مثلاً:  python -m benchmarks.bench_event_loop
+
+ساخت داده آزمایشی بزرگ:        python -m benchmarks.datagen --out /tmp/crm-bench.db --scale 1
+همه routeها + مقایسه با baseline: python -m benchmarks.bench_api --baseline benchmarks/baseline.json
+توان ورود (scrypt) به ازای هسته:  python -m benchmarks.bench_login
+"""
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+کلاینت ASGI درون‌پردازه‌ای برای بنچمارک‌ها (بدون httpx/uvicorn).
+درخواست مستقیم به app داده می‌شود و روی همان event loop اجرا می‌شود، پس مسدود شدن loop
+دقیقاً همان‌طور که در uvicorn دیده می‌شود در تأخیرها ظاهر می‌شود.
+"""
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+
+class ASGIResponse:
+    def __init__(self, status: int, headers: List[Tuple[bytes, bytes]], body: bytes, elapsed: float):
+        self.status = status
+        self.headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in headers}
+        self.body = body
+        self.elapsed = elapsed
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+
+class ASGIClient:
+    def __init__(self, app, token: Optional[str] = None):
+        self.app = app
+        self.token = token
+
+    async def request(self, method: str, path: str, *, params: Optional[Dict[str, Any]] = None,
+                      json_body: Any = None, body: bytes = b"", headers: Optional[Dict[str, str]] = None,
+                      content_type: Optional[str] = None) -> ASGIResponse:
+        hdrs = dict(headers or {})
+        if self.token and "authorization" not in {k.lower() for k in hdrs}:
+            hdrs["Authorization"] = f"Bearer {self.token}"
+        if json_body is not None:
+            body = json.dumps(json_body, ensure_ascii=False).encode("utf-8")
+            content_type = "application/json"
+        if content_type:
+            hdrs["Content-Type"] = content_type
+        hdrs.setdefault("Content-Length", str(len(body)))
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": method.upper(), "scheme": "http", "path": path, "raw_path": path.encode(),
+            "query_string": urlencode(params or {}, doseq=True).encode(), "root_path": "",
+            "headers": [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in hdrs.items()],
+            "client": ("127.0.0.1", 50000), "server": ("bench", 80),
+        }
+        done = asyncio.Event()
+        body_sent = False
+        status, resp_headers, chunks = 0, [], []
+
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status, resp_headers
+            if message["type"] == "http.response.start":
+                status, resp_headers = message["status"], message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    done.set()
+
+        started = time.perf_counter()
+        await self.app(scope, receive, send)
+        done.set()
+        return ASGIResponse(status, resp_headers, b"".join(chunks), time.perf_counter() - started)
+
+    async def get(self, path: str, **kw) -> ASGIResponse:
+        return await self.request("GET", path, **kw)
+
+    async def post(self, path: str, **kw) -> ASGIResponse:
+        return await self.request("POST", path, **kw)
+
+    async def put(self, path: str, **kw) -> ASGIResponse:
+        return await self.request("PUT", path, **kw)
+
+    async def login(self, username: str = "admin", password: str = "admin123") -> str:
+        r = await self.post("/api/login", json_body={"username": username, "password": password})
+        if r.status != 200:
+            raise RuntimeError(f"login failed: {r.status} {r.body[:200]!r}")
+        self.token = r.json()["token"]
+        return self.token
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    """خلاصه تأخیرها به میلی‌ثانیه."""
+    return {
+        "n": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 95) * 1000, 2),
+        "p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2) if samples else 0.0,
+    }
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+گزارش‌های /api/analytics از روی rollup در برابر اسکن مستقیم orders/order_items/calls/users (زمان هر گزارش).
+
+  raw     همان گزارش با GROUP BY روی جدول‌های اصلی (کاری که بدون rollup باید برای هر درخواست انجام شود)
+  rollup  توابع sales_analytics / call_analytics / contact_funnel روی جدول‌های تجمیعی
+
+دیتابیس با benchmarks.datagen ساخته می‌شود (یا با --db یک فایل موجود کپی می‌شود) و همه گزارش‌ها کل بازه
+داده (چند سال) را پوشش می‌دهند.
+
+    python -m benchmarks.bench_analytics --scale 0.2
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from benchmarks import datagen
+from benchmarks.common import main
+
+_OWNER = "COALESCE((SELECT u.owner_id FROM users u WHERE u.id = o.user_id), 0)"
+_ITEMS = "order_items i JOIN orders o ON o.id = i.order_id"
+RAW_QUERIES = {
+    "revenue/product/jalali_month": f"""SELECT cal.jalali_month, i.product_id, COUNT(*), SUM(i.quantity * i.unit_price)
+                                        FROM {_ITEMS} LEFT JOIN calendar_days cal ON cal.day = date(o.order_date) GROUP BY 1, 2;""",
+    "revenue/owner/total": f"SELECT {_OWNER}, COUNT(*), SUM(total_amount) FROM orders o GROUP BY 1;",
+    "revenue/company/total": "SELECT company_id, COUNT(*), SUM(total_amount) FROM orders o GROUP BY 1;",
+    "revenue/category/week": f"""SELECT date(o.order_date, '-6 days', 'weekday 6'), p.category, COUNT(*), SUM(i.quantity * i.unit_price)
+                                 FROM {_ITEMS} LEFT JOIN products p ON p.id = i.product_id GROUP BY 1, 2;""",
+    "revenue/product/fiscal_month": f"""SELECT cal.fiscal_month, i.product_id, COUNT(*), SUM(i.quantity * i.unit_price)
+                                        FROM {_ITEMS} LEFT JOIN calendar_days cal ON cal.day = date(o.order_date) GROUP BY 1, 2;""",
+    "calls/agent/week": f"""SELECT date(call_datetime, '-6 days', 'weekday 6'), created_by, COUNT(*), SUM(status = '{main.CALL_STATUSES[1]}')
+                            FROM calls GROUP BY 1, 2;""",
+    "calls/agent/jalali_month": f"""SELECT cal.jalali_month, created_by, COUNT(*), SUM(status = '{main.CALL_STATUSES[1]}')
+                                    FROM calls LEFT JOIN calendar_days cal ON cal.day = date(call_datetime) GROUP BY 1, 2;""",
+    "funnel": "SELECT status, COUNT(*) FROM users GROUP BY status;",
+}
+ROLLUP_CALLS = {
+    "revenue/product/jalali_month": lambda: main.sales_analytics("product", "jalali_month", None, None, [], None),
+    "revenue/owner/total": lambda: main.sales_analytics("owner", "total", None, None, [], None),
+    "revenue/company/total": lambda: main.sales_analytics("company", "total", None, None, [], None),
+    "revenue/category/week": lambda: main.sales_analytics("category", "week", None, None, [], None),
+    "revenue/product/fiscal_month": lambda: main.sales_analytics("product", "fiscal_month", None, None, [], None),
+    "calls/agent/week": lambda: main.call_analytics("week", None, None, None),
+    "calls/agent/jalali_month": lambda: main.call_analytics("jalali_month", None, None, None),
+    "funnel": lambda: main.contact_funnel(None, None, None),
+}
+
+
+def _median_ms(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return round(statistics.median(times) * 1000, 2)
+
+
+def run(argv=None) -> list:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--db", default=None, help="دیتابیس موجود (کپی می‌شود)")
+    p.add_argument("--scale", type=float, default=0.2)
+    p.add_argument("--repeat", type=int, default=5)
+    args = p.parse_args(argv)
+
+    path = os.path.join(tempfile.mkdtemp(prefix="crm-analytics-"), "crm.db")
+    if args.db:
+        shutil.copyfile(args.db, path)
+        main.DB_PATH = path
+        main.db_pool.reset()
+        main.init_db()
+    else:
+        datagen.generate(path, args.scale)
+    conn = main.get_conn()
+    counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t};").fetchone()[0] for t in ("orders", "order_items", "calls", "users")}
+    rollups = {t: conn.execute(f"SELECT COUNT(*) FROM {t};").fetchone()[0] for t in main.ANALYTICS_ROLLUP_TABLES}
+    print(f"db: {path}  {counts}  rollup rows: {rollups}")
+
+    results = []
+    for name, sql in RAW_QUERIES.items():
+        raw = _median_ms(lambda: conn.execute(sql).fetchall(), args.repeat)
+        rollup = _median_ms(ROLLUP_CALLS[name], args.repeat)
+        results.append({"report": name, "raw_ms": raw, "rollup_ms": rollup, "speedup": round(raw / rollup, 1) if rollup else None})
+        print(f"[{name:>28}] raw={raw}ms rollup={rollup}ms  x{results[-1]['speedup']}")
+    main.db_pool.reset()
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+بنچمارک همه routeهای /api/* روی دیتابیس ساخته‌شده با datagen، با مقایسه نسبت به baseline.
+
+هر سناریو چند بار (پس از یک بار گرم کردن) از مسیر کامل app با ASGIClient درون‌پردازه‌ای اجرا می‌شود و
+p50/p95/p99، ردیف در ثانیه (برای لیست‌ها و خروجی‌ها) و اوج RSS پردازه پس از آن سناریو گزارش می‌شود.
+سناریوها هم با نقش ادمین و هم کارشناس (agent1) اجرا می‌شوند. routeای که سناریو ندارد در انتها چاپ می‌شود
+تا route جدید بی‌بنچمارک نماند؛ /api/events (استریم بی‌پایان) و /api/admin/restore-db (جایگزینی دیتابیس)
+عمداً اجرا نمی‌شوند.
+
+دیتابیس ورودی (--db) هیچ‌وقت تغییر نمی‌کند: یک کپی موقت ساخته و نوشتن‌ها روی آن انجام می‌شوند.
+بدون --db، دیتابیس با datagen و --scale ساخته می‌شود.
+
+    python -m benchmarks.datagen --out /tmp/crm-bench.db --scale 1
+    python -m benchmarks.bench_api --db /tmp/crm-bench.db --save-baseline /tmp/baseline-full.json
+    python -m benchmarks.bench_api --scale 0.05 --baseline benchmarks/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, timedelta
+
+from benchmarks import datagen
+from benchmarks.asgi_client import ASGIClient, latency_summary
+from benchmarks.common import main
+
+try:
+    import resource
+except ImportError:  # ویندوز
+    resource = None
+
+SKIPPED_ROUTES = {("GET", "/api/events"), ("POST", "/api/admin/restore-db")}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+class Scenario:
+    """route: الگوی مسیر همان‌طور که در app تعریف شده؛ path_args/body/params می‌توانند تابعی از شماره تکرار باشند."""
+
+    def __init__(self, name, method, route, *, role="admin", path_args=None, params=None, body=None, upload=None,
+                 status=200, repeat=None, fresh_token=False):
+        self.name, self.method, self.route, self.role = name, method, route, role
+        self.path_args, self.params, self.body, self.upload = path_args, params, body, upload
+        self.status, self.repeat, self.fresh_token = status, repeat, fresh_token
+
+
+def _at(value, i):
+    return value(i) if callable(value) else value
+
+
+def _multipart(filename: str, data: bytes):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f"Content-Type: text/csv\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def count_rows(r) -> int:
+    ctype = r.headers.get("content-type", "")
+    if ctype.startswith("text/csv"):
+        return max(0, r.body.count(b"\n") - 1)
+    if not ctype.startswith("application/json"):
+        return 0
+    data = r.json()
+    if isinstance(data, list):
+        return len(data)
+    if isinstance(data, dict):
+        for key in ("items", "rows", "results", "changes"):
+            if isinstance(data.get(key), list):
+                return len(data[key])
+    return 0
+
+
+def _build_context(path: str) -> dict:
+    conn = sqlite3.connect(path)
+    one = lambda sql, *a: conn.execute(sql, a).fetchone()[0]
+    agent = one("SELECT id FROM app_users WHERE username='agent1';")
+    ctx = {
+        "agent_id": agent, "other_agent_id": one("SELECT id FROM app_users WHERE username='agent2';"),
+        "user_id": one("SELECT id FROM users WHERE owner_id=? ORDER BY id LIMIT 1;", agent),
+        "company_id": one("SELECT MIN(company_id) FROM users WHERE owner_id=?;", agent),
+        "product_id": one("SELECT MIN(id) FROM products;"), "order_id": one("SELECT MIN(id) FROM orders;"),
+        "task_id": one("SELECT MIN(id) FROM followups;"),
+        "agent_user_ids": [r[0] for r in conn.execute("SELECT id FROM users WHERE owner_id=? ORDER BY id LIMIT 100;", (agent,))],
+        "task_ids": [r[0] for r in conn.execute("SELECT id FROM followups ORDER BY id LIMIT 100;")],
+        "month_ago": (date.today() - timedelta(days=30)).isoformat(), "today": date.today().isoformat(),
+        "tag": uuid.uuid4().hex[:6],
+    }
+    conn.close()
+    return ctx
+
+
+def scenarios(ctx: dict, repeat: int) -> list:
+    S, c, tag = Scenario, ctx, ctx["tag"]
+    heavy = max(1, repeat // 10)
+    recent = {"start": c["month_ago"], "end": c["today"]}
+    call = lambda i: {"user_id": c["user_id"], "call_datetime": f"{c['today']}T10:00:00", "status": main.CALL_STATUSES[i % 4],
+                      "description": "bench"}
+    followup = lambda i: {"user_id": c["user_id"], "title": "bench", "due_date": f"{c['today']}T12:00:00"}
+    order = lambda i: {"user_id": c["user_id"], "company_id": c["company_id"], "order_date": c["today"],
+                       "status": main.ORDER_STATUSES[i % 4],
+                       "items": [{"product_id": c["product_id"] + j, "quantity": 1 + i % 5} for j in range(1 + i % 3)]}
+    import_csv = lambda i: _multipart("contacts.csv", ("\n".join(
+        [",".join(main.IMPORT_COLUMNS)] +
+        [f"بنچ{j},0998{i:03d}{j:04d},ایمپورت,,,{main.USER_STATUSES[0]},{main.LEVELS[0]},,تهران,agent1," for j in range(20)])
+        + "\n").encode("utf-8"))
+    return [
+        S("root", "GET", "/api"),
+        S("me", "GET", "/api/me"),
+        S("dashboard", "GET", "/api/dashboard-stats"),
+        S("dashboard/agent", "GET", "/api/dashboard-stats", role="agent"),
+        S("search", "GET", "/api/search", params={"q": "محمدی"}),
+        S("search/agent", "GET", "/api/search", role="agent", params={"q": "0912"}),
+        S("changes", "GET", "/api/changes"),
+        S("lookups/users", "GET", "/api/lookups/users"),
+        S("lookups/users/agent", "GET", "/api/lookups/users", role="agent"),
+        S("lookups/companies", "GET", "/api/lookups/companies"),
+        S("users/all", "GET", "/api/users", repeat=heavy),
+        S("users/all/columnar", "GET", "/api/users", params={"format": "columnar", "dictionary": "true"}, repeat=heavy),
+        S("users/page", "GET", "/api/users", params={"limit": 50}),
+        S("users/page/jalali", "GET", "/api/users", params={"limit": 50, "jalali": "true"}),
+        S("users/filtered", "GET", "/api/users", params={"first_q": "علی", "statuses": main.USER_STATUSES[1], "limit": 200}),
+        S("users/agent", "GET", "/api/users", role="agent"),
+        S("users/count", "GET", "/api/users", params={"count_only": "true", "has_open_task": "true"}),
+        S("users/profile", "GET", "/api/users/{user_id}/profile"),
+        S("companies/all", "GET", "/api/companies", repeat=heavy),
+        S("companies/page", "GET", "/api/companies", params={"limit": 50, "has_open_task": "true"}),
+        S("companies/agent", "GET", "/api/companies", role="agent"),
+        S("companies/profile", "GET", "/api/companies/{company_id}/profile"),
+        S("calls/30d", "GET", "/api/calls", params=recent, repeat=heavy),
+        S("calls/page", "GET", "/api/calls", params={"limit": 50}),
+        S("calls/agent/30d", "GET", "/api/calls", role="agent", params=recent),
+        S("followups/open", "GET", "/api/followups", params={"statuses": main.TASK_STATUSES[0], "limit": 200}),
+        S("followups/agent", "GET", "/api/followups", role="agent", params={"statuses": main.TASK_STATUSES[0]}),
+        S("orders/all", "GET", "/api/orders", repeat=heavy),
+        S("orders/page", "GET", "/api/orders", params={"limit": 50, "status_filter": main.ORDER_STATUSES[1]}),
+        S("orders/recent", "GET", "/api/orders", params={"status_filter": main.ORDER_STATUSES[1], **recent}),
+        S("orders/owner", "GET", "/api/orders", params={"limit": 50, "owner_ids_filter": c["agent_id"]}),
+        S("orders/items", "GET", "/api/orders/{order_id}/items"),
+        S("products", "GET", "/api/products"),
+        S("analytics/revenue/product", "GET", "/api/analytics/revenue"),
+        S("analytics/revenue/company", "GET", "/api/analytics/revenue", params={"by": "company", "period": "total"}),
+        S("analytics/revenue/fiscal", "GET", "/api/analytics/revenue", params={"by": "owner", "period": "fiscal_month"}),
+        S("analytics/revenue/owner-week", "GET", "/api/analytics/revenue", params={"by": "owner", "period": "week"}),
+        S("analytics/revenue/agent", "GET", "/api/analytics/revenue", role="agent", params={"by": "category"}),
+        S("analytics/calls", "GET", "/api/analytics/calls"),
+        S("analytics/calls/week", "GET", "/api/analytics/calls", params={"period": "week"}),
+        S("analytics/calls/agent-day", "GET", "/api/analytics/calls", role="agent", params={"period": "day"}),
+        S("analytics/funnel", "GET", "/api/analytics/funnel"),
+        S("analytics/funnel/agent", "GET", "/api/analytics/funnel", role="agent"),
+        S("app-users", "GET", "/api/admin/app-users"),
+        S("runtime-stats", "GET", "/api/admin/runtime-stats"),
+        S("jobs", "GET", "/api/jobs"),
+        S("job", "GET", "/api/jobs/{job_id}"),
+        S("job/download", "GET", "/api/jobs/{job_id}/download"),
+        S("job/cancel-finished", "POST", "/api/jobs/{job_id}/cancel", status=400),
+        S("import-template", "GET", "/api/users/import-template"),
+        S("export/users.csv", "GET", "/api/users/export", params={"format": "csv"}, repeat=heavy),
+        S("export/users.xlsx", "GET", "/api/users/export", params={"format": "xlsx"}, repeat=1),
+        S("export/companies.csv", "GET", "/api/companies/export", repeat=heavy),
+        S("export/calls-30d.csv", "GET", "/api/calls/export", params=recent, repeat=heavy),
+        S("export/followups.csv", "GET", "/api/followups/export", params={"statuses": main.TASK_STATUSES[0]}, repeat=heavy),
+        S("export/orders.csv", "GET", "/api/orders/export", repeat=heavy),
+        S("login", "POST", "/api/login", body={"username": "agent1", "password": datagen.AGENT_PASSWORD}),
+        S("logout", "POST", "/api/logout", fresh_token=True),
+        S("events/ticket", "POST", "/api/events/ticket"),
+        S("users/create", "POST", "/api/users", status=201,
+          body=lambda i: {"first_name": "بنچ", "last_name": f"{tag}{i}", "phone": f"0997{int(tag, 16) % 1000:03d}{i:04d}"}),
+        S("users/update", "PUT", "/api/users/{user_id}", body=lambda i: {"note": f"bench {i}"}),
+        S("users/bulk-owner", "PUT", "/api/users/bulk-owner",
+          body=lambda i: {"user_ids": c["agent_user_ids"], "new_owner_id": c["agent_id" if i % 2 else "other_agent_id"]}),
+        S("users/import", "POST", "/api/users/import-excel", upload=import_csv, repeat=heavy),
+        S("companies/create", "POST", "/api/companies", status=201, body=lambda i: {"name": f"شرکت بنچ {tag} {i}"}),
+        S("companies/update", "PUT", "/api/companies/{company_id}", body=lambda i: {"name": f"شرکت بنچ {i}"}),
+        S("calls/create", "POST", "/api/calls", status=201, body=call),
+        S("calls/create/agent", "POST", "/api/calls", role="agent", status=201, body=call),
+        S("calls/bulk-100", "POST", "/api/calls/bulk", body=lambda i: {"items": [call(j) for j in range(100)]}),
+        S("followups/create", "POST", "/api/followups", status=201, body=followup),
+        S("followups/bulk-100", "POST", "/api/followups/bulk", body=lambda i: {"items": [followup(j) for j in range(100)]}),
+        S("followups/status", "PUT", "/api/followups/{task_id}/status", body=lambda i: {"status": main.TASK_STATUSES[i % 2]}),
+        S("followups/bulk-status-100", "PUT", "/api/followups/bulk-status",
+          body=lambda i: {"items": [{"id": t, "status": main.TASK_STATUSES[i % 2]} for t in c["task_ids"]]}),
+        S("products/create", "POST", "/api/products", status=201, body=lambda i: {"category": "بنچ", "name": f"محصول {tag} {i}", "unit_price": 250_000 + i}),
+        S("products/update", "PUT", "/api/products/{product_id}", body=lambda i: {"category": "بنچ", "name": f"محصول {i}"}),
+        S("orders/create", "POST", "/api/orders", status=201, body=order),
+        S("orders/update", "PUT", "/api/orders/{order_id}", body=order),
+        S("app-users/create", "POST", "/api/admin/app-users",
+          body=lambda i: {"username": f"bench_{tag}_{i}", "password": "bench123", "role": "agent"}),
+        S("app-users/password", "PUT", "/api/admin/app-users/{user_id}/password",
+          path_args={"user_id": c["password_app_user"]}, body={"new_password": "bench456"}),
+        S("app-users/delete", "DELETE", "/api/admin/app-users/{user_id}",
+          path_args=lambda i: {"user_id": c["deletable_app_users"][i]}),
+        S("snapshots", "GET", "/api/admin/snapshots"),
+        S("snapshots/create", "POST", "/api/admin/snapshots", status=202, repeat=1),
+        S("backup-db", "GET", "/api/admin/backup-db", repeat=1),
+    ]
+
+
+async def _run_scenario(s: Scenario, tokens: dict, ctx: dict, repeat: int) -> dict:
+    client = ASGIClient(main.app, tokens[s.role])
+    latencies, rows, errors = [], 0, 0
+    n = s.repeat or repeat
+    for i in range(n + 1):  # تکرار اول گرم کردن است
+        kw = {"params": _at(s.params, i)}
+        if s.body is not None:
+            kw["json_body"] = _at(s.body, i)
+        if s.upload is not None:
+            kw["body"], kw["content_type"] = s.upload(i)
+        if s.fresh_token:
+            kw["headers"] = {"Authorization": f"Bearer {await ASGIClient(main.app).login()}"}
+        path = s.route.format(**{**ctx, **(_at(s.path_args, i) or {})})
+        r = await client.request(s.method, path, **kw)
+        if r.status != s.status:
+            errors += 1
+            if errors == 1:
+                print(f"  ! {s.name}: {r.status} {r.body[:200]!r}")
+        if i:
+            latencies.append(r.elapsed)
+            rows += count_rows(r)
+    total = sum(latencies)
+    return {"name": s.name, "method": s.method, "route": s.route, "role": s.role, **latency_summary(latencies),
+            "rows": rows // n, "rows_per_s": int(rows / total) if total and rows else 0, "errors": errors,
+            "rss_peak_mb": peak_rss_mb()}
+
+
+async def _wait_job(client: ASGIClient, job_id: str, timeout: float = 600) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = (await client.get(f"/api/jobs/{job_id}")).json()
+        if job["status"] not in main.JOB_ACTIVE_STATUSES:
+            return job
+        await asyncio.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+async def _run_all(ctx: dict, repeat: int, only: str = None) -> list:
+    admin, agent = ASGIClient(main.app), ASGIClient(main.app)
+    await admin.login()
+    await agent.login("agent1", datagen.AGENT_PASSWORD)
+    tokens = {"admin": admin.token, "agent": agent.token}
+    # پیش‌نیازها (خارج از زمان‌گیری): یک job تمام‌شده برای routeهای jobs و حساب‌هایی برای تغییر رمز/حذف
+    r = await admin.get("/api/orders/export", params={"background": "true"})
+    ctx["job_id"] = r.json()["job_id"]
+    await _wait_job(admin, ctx["job_id"])
+    accounts = []
+    for i in range(repeat + 2):
+        main.create_app_user(main.AppUserCreate(username=f"bench_acc_{ctx['tag']}_{i}", password="bench123", role="agent"))
+        accounts.append(main.get_app_user_id_by_username(f"bench_acc_{ctx['tag']}_{i}"))
+    ctx["password_app_user"], ctx["deletable_app_users"] = accounts[0], accounts[1:]
+
+    results = []
+    for s in scenarios(ctx, repeat):
+        if only and only not in s.name:
+            continue
+        res = await _run_scenario(s, tokens, ctx, repeat)
+        results.append(res)
+        print(f"[{res['name']:>26}] n={res['n']:<3} p50={res['p50_ms']:>9}ms p95={res['p95_ms']:>9}ms "
+              f"p99={res['p99_ms']:>9}ms rows/s={res['rows_per_s']:>10,} rss={res['rss_peak_mb']}MB"
+              + (f"  errors={res['errors']}" if res["errors"] else ""))
+    return results
+
+
+def uncovered_routes(scenario_list: list) -> list:
+    covered = {(s.method, s.route) for s in scenario_list} | SKIPPED_ROUTES
+    routes = [(m, r.path) for r in main.app.routes if getattr(r, "path", "").startswith("/api")
+              for m in (getattr(r, "methods", None) or ()) if m != "HEAD"]
+    return sorted(set(routes) - covered)
+
+
+def compare(results: list, baseline: dict, tolerance: float, counts: dict) -> list:
+    """سناریوهایی که p50 آن‌ها بیش از tolerance برابر (و بیش از ۱ میلی‌ثانیه) کندتر از baseline شده است."""
+    old = {r["name"]: r for r in baseline["results"]}
+    if baseline["meta"].get("counts") != counts:
+        print("⚠️ اندازه داده با baseline یکی نیست؛ مقایسه فقط تقریبی است.")
+    regressions = []
+    for r in results:
+        b = old.get(r["name"])
+        if b is None:
+            continue
+        ratio = r["p50_ms"] / max(b["p50_ms"], 0.01)
+        slower = ratio > tolerance and r["p50_ms"] - b["p50_ms"] > 1.0
+        if slower:
+            regressions.append(r["name"])
+        print(f"  {'✗' if slower else ' '} {r['name']:>26}  p50 {b['p50_ms']:>9} → {r['p50_ms']:>9} ms  ({ratio:.2f}x)")
+    return regressions
+
+
+def _meta_counts() -> dict:
+    conn = sqlite3.connect(main.DB_PATH)
+    counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t};").fetchone()[0]
+              for t in ("companies", "users", "calls", "followups", "orders")}
+    conn.close()
+    return counts
+
+
+def _prepare_db(args) -> str:
+    work = tempfile.mkdtemp(prefix="crm-bench-api-")
+    main.JOBS_DIR = os.path.join(work, "jobs")
+    main.BACKUP_DIR = os.path.join(work, "backups")
+    path = os.path.join(work, "crm.db")
+    if args.db:
+        src, dst = sqlite3.connect(args.db), sqlite3.connect(path)
+        src.backup(dst)
+        src.close(); dst.close()
+        main.DB_PATH = path
+        main.db_pool.reset()
+        main.init_db()
+    else:
+        info = datagen.generate(path, args.scale, args.seed)
+        print(f"datagen: {info['counts']} in {round(info['load_s'] + info['derive_s'], 1)}s")
+    return path
+
+
+def run(argv=None) -> list:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--db", default=None, help="دیتابیس ساخته‌شده با datagen (کپی می‌شود)")
+    p.add_argument("--scale", type=float, default=0.05, help="اگر --db داده نشود")
+    p.add_argument("--seed", type=int, default=1403)
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--only", default=None, help="فقط سناریوهایی که نامشان شامل این متن است")
+    p.add_argument("--baseline", default=None, help="فایل JSON برای مقایسه")
+    p.add_argument("--tolerance", type=float, default=1.25)
+    p.add_argument("--save-baseline", default=None, help="ذخیره نتیجه این اجرا به‌عنوان baseline")
+    args = p.parse_args(argv)
+
+    path = _prepare_db(args)
+    counts = _meta_counts()
+    print(f"db: {path}  {counts}")
+    ctx = _build_context(path)
+    started = time.perf_counter()
+    results = asyncio.run(_run_all(ctx, args.repeat, args.only))
+    missing = uncovered_routes(scenarios(ctx, args.repeat))
+    if missing:
+        print("routeهای بدون سناریو: " + ", ".join(f"{m} {r}" for m, r in missing))
+    meta = {"counts": counts, "repeat": args.repeat, "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version, "machine": platform.machine(), "platform": platform.system(),
+            "orjson": main.orjson is not None, "seconds": round(time.perf_counter() - started, 1),
+            "rss_peak_mb": peak_rss_mb(), "date": date.today().isoformat()}
+    print(json.dumps({"meta": meta, "results": results}, ensure_ascii=False, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            # هر سناریو در یک خط تا diff دو baseline خوانا باشد
+            f.write(f'{{"meta": {json.dumps(meta, ensure_ascii=False)},\n "results": [\n  '
+                    + ",\n  ".join(json.dumps(r, ensure_ascii=False) for r in results) + "\n]}\n")
+        print(f"baseline ذخیره شد: {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance, counts)
+        if regressions:
+            print(f"کندتر از baseline: {', '.join(regressions)}")
+            raise SystemExit(1)
+    return results
+
+
+if __name__ == "__main__":
+    run()
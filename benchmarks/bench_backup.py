@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+تأخیر نوشتن در حین بکاپ.
+
+یک thread پشت سر هم از مسیر write_conn تماس ثبت می‌کند و تأخیر هر نوشتن اندازه‌گیری می‌شود؛ هم‌زمان
+بکاپ با روش‌های مختلف گرفته می‌شود:
+
+  idle     بدون بکاپ (مبنا)
+  paged    backup_database_to (Connection.backup صفحه‌به‌صفحه با snapshot ثابت) — روش فعلی
+  copyfile کپی مستقیم فایل (روش قدیمی دانلود/پیش از بازیابی)؛ محتوای WAL در آن نیست
+
+برای هر روش مدت بکاپ، p50/p99/max تأخیر نوشتن و اینکه کپی چند ردیف و integrity_check دارد گزارش می‌شود.
+
+    python -m benchmarks.bench_backup --users 20000 --calls-per-user 25
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from benchmarks.asgi_client import latency_summary
+from benchmarks.common import main, seed_users_and_calls, use_fresh_db
+
+
+def _writer(stop: threading.Event, samples: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        with main.write_conn("calls") as conn:
+            conn.execute("INSERT INTO calls (user_id, call_datetime, status) VALUES (1, '2025-01-01 10:00:00', 'موفق');")
+        samples.append(time.perf_counter() - started)
+        time.sleep(0.001)
+
+
+def _copyfile(dest: str):
+    shutil.copyfile(main.DB_PATH, dest)
+
+
+def _inspect(path: str) -> dict:
+    conn = sqlite3.connect(path)
+    try:
+        return {"calls": conn.execute("SELECT COUNT(*) FROM calls;").fetchone()[0],
+                "integrity": conn.execute("PRAGMA integrity_check;").fetchone()[0]}
+    finally:
+        conn.close()
+
+
+def _run_method(name: str, fn, idle_seconds: float) -> dict:
+    stop, samples = threading.Event(), []
+    writer = threading.Thread(target=_writer, args=(stop, samples))
+    writer.start()
+    dest = os.path.join(tempfile.mkdtemp(prefix="crm-backup-bench-"), "copy.db")
+    time.sleep(0.2)
+    samples.clear()
+    started = time.perf_counter()
+    if fn is None:
+        time.sleep(idle_seconds)
+    else:
+        fn(dest)
+    duration = time.perf_counter() - started
+    stop.set()
+    writer.join()
+    result = {"method": name, "duration_s": round(duration, 3), "writes": latency_summary(samples)}
+    if fn is not None:
+        result["copy"] = _inspect(dest)
+    return result
+
+
+def run(argv=None) -> list:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=20000)
+    p.add_argument("--calls-per-user", type=int, default=25)
+    p.add_argument("--idle-seconds", type=float, default=2.0)
+    p.add_argument("--methods", default="idle,paged,copyfile")
+    args = p.parse_args(argv)
+
+    path = use_fresh_db()
+    seed_users_and_calls(args.users, args.calls_per_user)
+    print(f"db: {path}  size={os.path.getsize(path) // 1024} KB  pages/step={main.BACKUP_PAGES_PER_STEP}")
+
+    methods = {"idle": None, "paged": main.backup_database_to, "copyfile": _copyfile}
+    results = []
+    for name in args.methods.split(","):
+        res = _run_method(name.strip(), methods[name.strip()], args.idle_seconds)
+        results.append(res)
+        w = res["writes"]
+        print(f"[{res['method']:>8}] {res['duration_s']}s  writes n={w['n']} p50={w['p50_ms']}ms "
+              f"p99={w['p99_ms']}ms max={w['max_ms']}ms  copy={res.get('copy')}")
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+توان ثبت تماس/پیگیری: درخواست تکی در برابر اندپوینت‌های گروهی (تماس در ثانیه).
+
+  single      هر تماس یک POST /api/calls (یک تراکنش و یک commit برای هر تماس)
+  bulk-N      POST /api/calls/bulk با دسته‌های N تایی (executemany در یک تراکنش)
+  followups   POST /api/followups/bulk با بزرگ‌ترین اندازه دسته
+  status      PUT /api/followups/bulk-status روی همان پیگیری‌ها
+
+همه درخواست‌ها از مسیر کامل app (احراز هویت، اعتبارسنجی pydantic، run_db) عبور می‌کنند. هدف: ۱۰ هزار
+تماس در ثانیه روی لپ‌تاپ در حالت bulk.
+
+    python -m benchmarks.bench_bulk_writes --calls 20000 --batch-sizes 100,1000,5000
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from benchmarks.asgi_client import ASGIClient, latency_summary
+from benchmarks.common import main, seed_users_and_calls, use_fresh_db
+
+
+def _calls(n: int, n_users: int, rnd: random.Random) -> list:
+    return [{"user_id": rnd.randint(1, n_users), "call_datetime": f"2025-03-{rnd.randint(1, 28):02d}T{rnd.randint(8, 19):02d}:00:00",
+             "status": rnd.choice(main.CALL_STATUSES), "description": "تماس بنچمارک"} for _ in range(n)]
+
+
+def _followups(n: int, n_users: int, rnd: random.Random) -> list:
+    return [{"user_id": rnd.randint(1, n_users), "title": "پیگیری بنچمارک", "details": "",
+             "due_date": f"2025-04-{rnd.randint(1, 28):02d}T10:00:00"} for _ in range(n)]
+
+
+async def _post_batches(client: ASGIClient, method: str, path: str, items: list, batch: int) -> dict:
+    latencies, ok, ids = [], 0, []
+    started = time.perf_counter()
+    for i in range(0, len(items), batch):
+        r = await client.request(method, path, json_body={"items": items[i:i + batch]})
+        assert r.status == 200, (r.status, r.body[:200])
+        body = r.json()
+        ok += body["ok"]
+        ids += [x["id"] for x in body["results"] if "id" in x]
+        latencies.append(r.elapsed)
+    elapsed = time.perf_counter() - started
+    return {"items": len(items), "ok": ok, "seconds": round(elapsed, 3), "items_per_s": int(ok / elapsed),
+            "request": latency_summary(latencies), "ids": ids}
+
+
+async def _single(client: ASGIClient, items: list) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for item in items:
+        r = await client.post("/api/calls", json_body=item)
+        assert r.status == 201, (r.status, r.body[:200])
+        latencies.append(r.elapsed)
+    elapsed = time.perf_counter() - started
+    return {"items": len(items), "ok": len(items), "seconds": round(elapsed, 3), "items_per_s": int(len(items) / elapsed),
+            "request": latency_summary(latencies)}
+
+
+async def _run(args) -> list:
+    rnd = random.Random(11)
+    client = ASGIClient(main.app)
+    await client.login()
+    batch_sizes = [int(x) for x in args.batch_sizes.split(",")]
+    results = [{"mode": "single", **await _single(client, _calls(args.single, args.users, rnd))}]
+    for size in batch_sizes:
+        res = await _post_batches(client, "POST", "/api/calls/bulk", _calls(args.calls, args.users, rnd), size)
+        res.pop("ids")
+        results.append({"mode": f"bulk-{size}", **res})
+    res = await _post_batches(client, "POST", "/api/followups/bulk", _followups(args.calls, args.users, rnd), batch_sizes[-1])
+    ids = res.pop("ids")
+    results.append({"mode": f"followups-{batch_sizes[-1]}", **res})
+    updates = [{"id": task_id, "status": main.TASK_STATUSES[1]} for task_id in ids]
+    res = await _post_batches(client, "PUT", "/api/followups/bulk-status", updates, batch_sizes[-1])
+    res.pop("ids")
+    results.append({"mode": f"status-{batch_sizes[-1]}", **res})
+    return results
+
+
+def run(argv=None) -> list:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=5000)
+    p.add_argument("--calls", type=int, default=20000, help="تعداد تماس برای هر اندازه دسته")
+    p.add_argument("--single", type=int, default=1000, help="تعداد تماس در حالت تکی")
+    p.add_argument("--batch-sizes", default="100,1000,5000")
+    args = p.parse_args(argv)
+
+    path = use_fresh_db()
+    seed_users_and_calls(args.users, 0)
+    print(f"db: {path}  users={args.users}  synchronous={main.DB_SYNCHRONOUS}")
+
+    results = asyncio.run(_run(args))
+    for res in results:
+        print(f"[{res['mode']:>16}] items={res['items']} ok={res['ok']} {res['seconds']}s "
+              f"items/s={res['items_per_s']:,}  request p50={res['request']['p50_ms']}ms p99={res['request']['p99_ms']}ms")
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+آیا یک گزارش سنگین event loop را قفل می‌کند؟
+
+در حالی که چند درخواست همزمان کل لیست /api/users را می‌خوانند، تأخیر /api/me اندازه‌گیری می‌شود.
+حالت "inline" رفتار قدیمی (صدا زدن مستقیم SQLite داخل async) را با جایگزین کردن run_db شبیه‌سازی
+می‌کند و حالت "executor" رفتار فعلی است. در حالت executor باید p99 ِ /api/me تقریباً ثابت بماند.
+
+    python -m benchmarks.bench_event_loop --users 20000 --calls-per-user 5
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.asgi_client import ASGIClient, latency_summary
+from benchmarks.common import main, seed_users_and_calls, use_fresh_db
+
+
+async def _inline_run_db(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+async def _sample_me(client: ASGIClient, n: int, interval: float):
+    """تأخیر از لحظه‌ای که درخواست باید ارسال می‌شد حساب می‌شود، نه از لحظه‌ای که loop فرصت ارسال پیدا کرد؛
+    در غیر این صورت زمانی که loop قفل بوده از آمار حذف می‌شود."""
+    samples = []
+    for _ in range(n):
+        due = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        r = await client.get("/api/me")
+        assert r.status == 200, r.status
+        samples.append(time.perf_counter() - due)
+    return samples
+
+
+async def _heavy(client: ASGIClient, stop: asyncio.Event, counter: list):
+    while not stop.is_set():
+        r = await client.get("/api/users")
+        assert r.status == 200, r.status
+        counter.append(r.elapsed)
+        # بدون سوکت واقعی، درخواست هیچ‌جا تسلیم نمی‌شود؛ این خط نقش I/O شبکه را بازی می‌کند
+        await asyncio.sleep(0)
+
+
+async def _run_mode(mode: str, args) -> dict:
+    main.run_db = _inline_run_db if mode == "inline" else _real_run_db
+    client = ASGIClient(main.app)
+    await client.login()
+    idle = await _sample_me(client, args.samples, args.interval)
+
+    stop, heavy_times = asyncio.Event(), []
+    heavy_tasks = [asyncio.create_task(_heavy(ASGIClient(main.app, client.token), stop, heavy_times))
+                   for _ in range(args.concurrency)]
+    await asyncio.sleep(0.05)
+    loaded = await _sample_me(client, args.samples, args.interval)
+    stop.set()
+    await asyncio.gather(*heavy_tasks)
+    return {
+        "mode": mode,
+        "me_idle": latency_summary(idle),
+        "me_under_load": latency_summary(loaded),
+        "heavy_users_list": latency_summary(heavy_times),
+    }
+
+
+_real_run_db = main.run_db
+
+
+def run(argv=None) -> list:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=20000)
+    p.add_argument("--calls-per-user", type=int, default=5)
+    p.add_argument("--samples", type=int, default=200)
+    p.add_argument("--interval", type=float, default=0.005)
+    p.add_argument("--concurrency", type=int, default=2, help="تعداد درخواست‌های سنگین همزمان")
+    p.add_argument("--modes", default="inline,executor")
+    args = p.parse_args(argv)
+
+    path = use_fresh_db()
+    seed_users_and_calls(args.users, args.calls_per_user)
+    print(f"db: {path}  users={args.users} calls={args.users * args.calls_per_user}")
+
+    results = []
+    for mode in args.modes.split(","):
+        res = asyncio.run(_run_mode(mode.strip(), args))
+        results.append(res)
+        print(f"[{res['mode']:>8}] /api/me idle p99={res['me_idle']['p99_ms']}ms  "
+              f"under load p50={res['me_under_load']['p50_ms']}ms p99={res['me_under_load']['p99_ms']}ms  "
+              f"(/api/users p50={res['heavy_users_list']['p50_ms']}ms, n={res['heavy_users_list']['n']})")
+    main.run_db = _real_run_db
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+توان ورود (/api/login) با هش scrypt: ورود در ثانیه به ازای هر هسته و اثر آن روی event loop.
+
+  scrypt  ورود حساب‌هایی که هش scrypt دارند (حالت عادی)
+  legacy  اولین ورود حساب‌هایی که هنوز هش sha256 قدیمی دارند (بررسی + ساخت هش scrypt + UPDATE)
+
+در طول هر حالت، concurrency درخواست ورود همزمان فرستاده می‌شود و همزمان تأخیر /api/me نمونه‌برداری
+می‌شود؛ چون scrypt در password_executor اجرا می‌شود p99 ِ /api/me باید نزدیک حالت بیکار بماند. پاسخ‌های
+503 (پر بودن صف PASSWORD_HASH_QUEUE) جدا شمرده می‌شوند. هدف: --target-per-core ورود در ثانیه برای هر هسته.
+
+    python -m benchmarks.bench_login --logins 400 --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from benchmarks.asgi_client import ASGIClient, latency_summary
+from benchmarks.common import main, use_fresh_db
+
+PASSWORD = "bench-pass-1"
+
+
+def _seed_accounts(n: int):
+    """n حساب با هش scrypt و n حساب با هش sha256 قدیمی؛ حساب‌های scrypt برای سرعت یک هش مشترک دارند
+    (هزینه بررسی به salt بستگی ندارد)."""
+    shared = main.hash_password(PASSWORD)
+    with main.write_conn("app_users") as conn:
+        conn.executemany("INSERT INTO app_users (username, password_sha256, role) VALUES (?,?,'agent');",
+                         [(f"scrypt{i}", shared) for i in range(n)] + [(f"legacy{i}", main.sha256(PASSWORD)) for i in range(n)])
+
+
+async def _sample_me(client: ASGIClient, stop: asyncio.Event, interval: float) -> list:
+    """مثل bench_event_loop: تأخیر از زمانی که درخواست باید ارسال می‌شد حساب می‌شود."""
+    samples = []
+    while not stop.is_set():
+        due = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        r = await client.get("/api/me")
+        assert r.status == 200, r.status
+        samples.append(time.perf_counter() - due)
+    return samples
+
+
+async def _login_worker(usernames: list, latencies: list, rejected: list):
+    client = ASGIClient(main.app)
+    while usernames:
+        username = usernames.pop()
+        r = await client.post("/api/login", json_body={"username": username, "password": PASSWORD})
+        if r.status == 503:
+            rejected.append(username)
+            continue
+        assert r.status == 200, (r.status, r.body[:200])
+        latencies.append(r.elapsed)
+        # بدون سوکت واقعی، درخواست هیچ‌جا تسلیم نمی‌شود؛ این خط نقش I/O شبکه را بازی می‌کند
+        await asyncio.sleep(0)
+
+
+async def _run_mode(mode: str, args, cores: int) -> dict:
+    me = ASGIClient(main.app)
+    await me.login()
+    if mode == "scrypt":
+        usernames = [f"scrypt{i % args.accounts}" for i in range(args.logins)]
+    else:
+        usernames = [f"legacy{i}" for i in range(min(args.logins, args.accounts))]
+    total = len(usernames)
+
+    stop, latencies, rejected = asyncio.Event(), [], []
+    sampler = asyncio.create_task(_sample_me(me, stop, args.interval))
+    started = time.perf_counter()
+    await asyncio.gather(*[_login_worker(usernames, latencies, rejected) for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    me_latency = await sampler
+
+    res = {"mode": mode, "logins": total - len(rejected), "rejected_503": len(rejected), "seconds": round(elapsed, 3),
+           "logins_per_s": round((total - len(rejected)) / elapsed, 1), "login": latency_summary(latencies),
+           "me_under_load": latency_summary(me_latency)}
+    res["logins_per_s_per_core"] = round(res["logins_per_s"] / cores, 1)
+    if mode == "legacy":
+        conn = main.get_conn()
+        res["rehashed"] = conn.execute("SELECT COUNT(*) FROM app_users WHERE username LIKE 'legacy%' "
+                                       "AND password_sha256 LIKE 'scrypt$%';").fetchone()[0]
+        conn.close()
+    return res
+
+
+async def _idle_me(samples: int, interval: float) -> dict:
+    client = ASGIClient(main.app)
+    await client.login()
+    latencies = []
+    for _ in range(samples):
+        due = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        r = await client.get("/api/me")
+        assert r.status == 200, r.status
+        latencies.append(time.perf_counter() - due)
+    return latency_summary(latencies)
+
+
+def run(argv=None) -> list:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--accounts", type=int, default=200, help="تعداد حساب در هر نوع هش")
+    p.add_argument("--logins", type=int, default=400, help="تعداد ورود در حالت scrypt")
+    p.add_argument("--concurrency", type=int, default=8, help="تعداد ورود همزمان")
+    p.add_argument("--interval", type=float, default=0.005, help="فاصله نمونه‌برداری /api/me")
+    p.add_argument("--target-per-core", type=float, default=25.0, help="هدف ورود در ثانیه برای هر هسته")
+    p.add_argument("--modes", default="scrypt,legacy")
+    args = p.parse_args(argv)
+
+    path = use_fresh_db()
+    _seed_accounts(args.accounts)
+    cores = max(1, min(main.PASSWORD_HASH_WORKERS, os.cpu_count() or 1))
+    print(f"db: {path}  scrypt N={main.PASSWORD_SCRYPT_N} r={main.PASSWORD_SCRYPT_R} p={main.PASSWORD_SCRYPT_P}  "
+          f"workers={main.PASSWORD_HASH_WORKERS} queue={main.PASSWORD_HASH_QUEUE} cores={cores}")
+
+    idle = asyncio.run(_idle_me(50, args.interval))
+    print(f"[    idle] /api/me p50={idle['p50_ms']}ms p99={idle['p99_ms']}ms")
+    results = []
+    for mode in args.modes.split(","):
+        res = asyncio.run(_run_mode(mode.strip(), args, cores))
+        res["meets_target"] = res["logins_per_s_per_core"] >= args.target_per_core
+        results.append(res)
+        print(f"[{res['mode']:>8}] logins={res['logins']} 503={res['rejected_503']} {res['seconds']}s "
+              f"logins/s={res['logins_per_s']} per core={res['logins_per_s_per_core']} "
+              f"(target {args.target_per_core}: {'ok' if res['meets_target'] else 'MISSED'})  "
+              f"login p50={res['login']['p50_ms']}ms p99={res['login']['p99_ms']}ms  "
+              f"/api/me under load p50={res['me_under_load']['p50_ms']}ms p99={res['me_under_load']['p99_ms']}ms"
+              + (f"  rehashed={res['rehashed']}" if "rehashed" in res else ""))
+    print(json.dumps({"me_idle": idle, "results": results}, ensure_ascii=False, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    run()
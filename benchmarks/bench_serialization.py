@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+سرعت ساخت و سریال‌سازی لیست مخاطبین (ردیف در ثانیه).
+
+برای کل لیست /api/users (بدون صفحه‌بندی) زمان کوئری + ساخت ردیف‌ها + تبدیل به JSON اندازه‌گیری می‌شود:
+
+  validated  مسیر قدیمی: ردیف‌های dict و response_model=List[Dict] (اعتبارسنجی pydantic + jsonable_encoder)
+  rows       run_db_json با ردیف‌های dict (orjson اگر نصب باشد، وگرنه json استاندارد)
+  columnar   format=columnar: {columns, rows} بدون ساخت dict برای هر ردیف
+  dict       format=columnar&dictionary=true: مقادیر پرتکرار به اندیس در dictionaries تبدیل می‌شوند
+
+حالت‌های rows/columnar یک بار با json استاندارد (stdlib) و اگر orjson نصب باشد یک بار با orjson اجرا می‌شوند.
+برای هر حالت اندازه بدنه خام و پس از gzip (و brotli اگر نصب باشد) با همان تنظیمات CompressionMiddleware
+گزارش می‌شود.
+
+    python -m benchmarks.bench_serialization --users 50000
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import zlib
+
+from fastapi.routing import serialize_response
+from fastapi.responses import JSONResponse
+from fastapi.utils import create_response_field
+
+from benchmarks.common import main, seed_users_and_calls, use_fresh_db
+
+_orjson = main.orjson
+
+
+def _fetch(columnar: bool = False):
+    return main.df_users_advanced(None, None, None, None, None, None, None, None, None, None,
+                                  [], [], [], None, columnar=columnar)
+
+
+def _validated() -> bytes:
+    field = create_response_field(name="Response_get_users_list", type_=main.List[main.Dict])
+    content = asyncio.run(serialize_response(field=field, response_content=_fetch(), is_coroutine=True))
+    return JSONResponse(content).body
+
+
+def _encoded(columnar: bool, use_orjson: bool, dictionary: bool = False):
+    def run() -> bytes:
+        main.orjson = _orjson if use_orjson else None
+        try:
+            body = _fetch(columnar)
+            return main._json_bytes(main.dictionary_encode(body) if dictionary else body)
+        finally:
+            main.orjson = _orjson
+    return run
+
+
+def _wire_sizes(body: bytes) -> dict:
+    sizes = {"gzip_kb": len(zlib.compress(body, 5)) // 1024}
+    if main.brotli is not None:
+        sizes["br_kb"] = len(main.brotli.compress(body, quality=4)) // 1024
+    return sizes
+
+
+def _measure(name: str, fn, repeat: int, n_rows: int) -> dict:
+    times, body = [], b""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = fn()
+        times.append(time.perf_counter() - started)
+    median = statistics.median(times)
+    return {"mode": name, "median_ms": round(median * 1000, 1), "best_ms": round(min(times) * 1000, 1),
+            "rows_per_s": int(n_rows / median), "size_kb": len(body) // 1024, **_wire_sizes(body)}
+
+
+def run(argv=None) -> list:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=50000)
+    p.add_argument("--calls-per-user", type=int, default=2)
+    p.add_argument("--repeat", type=int, default=5)
+    args = p.parse_args(argv)
+
+    path = use_fresh_db()
+    seed_users_and_calls(args.users, args.calls_per_user)
+    print(f"db: {path}  users={args.users}  orjson={'yes' if _orjson else 'no'}")
+
+    modes = [("validated", _validated),
+             ("rows/stdlib", _encoded(False, False)), ("columnar/stdlib", _encoded(True, False)),
+             ("dict/stdlib", _encoded(True, False, True))]
+    if _orjson is not None:
+        modes += [("rows/orjson", _encoded(False, True)), ("columnar/orjson", _encoded(True, True)),
+                  ("dict/orjson", _encoded(True, True, True))]
+    results = []
+    for name, fn in modes:
+        res = _measure(name, fn, args.repeat, args.users)
+        results.append(res)
+        print(f"[{res['mode']:>16}] median={res['median_ms']}ms best={res['best_ms']}ms "
+              f"rows/s={res['rows_per_s']:,}  size={res['size_kb']} KB gzip={res['gzip_kb']} KB"
+              + (f" br={res['br_kb']} KB" if "br_kb" in res else ""))
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""ابزار مشترک بنچمارک‌ها: ساخت دیتابیس موقت و پر کردن سریع آن."""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def use_fresh_db(path: str = None) -> str:
+    """main را به یک فایل دیتابیس تازه متصل و اسکیمای آن را می‌سازد."""
+    path = path or os.path.join(tempfile.mkdtemp(prefix="crm-bench-"), "crm.db")
+    for ext in ("", "-wal", "-shm"):
+        if os.path.exists(path + ext):
+            os.remove(path + ext)
+    main.DB_PATH = path
+    main.db_pool.reset()
+    main.init_db()
+    return path
+
+
+def seed_users_and_calls(n_users: int, calls_per_user: int, seed: int = 7):
+    """n_users مخاطب و برای هر کدام calls_per_user تماس مستقیم با executemany درج می‌کند."""
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(main.DB_PATH)
+    base = datetime(2024, 1, 1)
+    users = [(f"نام{i}", f"خانواده{i}", f"نام{i} خانواده{i}", f"09{i:09d}", 1, main.USER_STATUSES[i % len(main.USER_STATUSES)])
+             for i in range(n_users)]
+    conn.executemany("INSERT INTO users (first_name,last_name,full_name,phone,owner_id,status) VALUES (?,?,?,?,?,?);", users)
+    calls = []
+    for uid in range(1, n_users + 1):
+        for _ in range(calls_per_user):
+            ts = base + timedelta(minutes=rnd.randrange(0, 365 * 24 * 60))
+            calls.append((uid, ts.strftime("%Y-%m-%d %H:%M:%S"), rnd.choice(main.CALL_STATUSES)))
+    conn.executemany("INSERT INTO calls (user_id, call_datetime, status) VALUES (?,?,?);", calls)
+    conn.commit()
+    conn.close()
+    main.db_pool.reset()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+ساخت دیتابیس آزمایشی واقعی‌نما برای بنچمارک (نام/تلفن فارسی، توزیع‌های ناهمگون).
+
+اندازه پیش‌فرض (scale=1): ۱۰ هزار شرکت، ۵۰۰ هزار مخاطب، ۵ میلیون تماس، ۱ میلیون پیگیری، ۲۰۰ هزار سفارش (۱ تا ۳ قلم)؛
+--scale همه را به یک نسبت کوچک/بزرگ می‌کند. خروجی با seed ثابت همیشه یکسان است.
+
+داده مستقیم با executemany در فایل SQLite نوشته می‌شود: triggerها و جدول‌های مشتق (user_activity، rollupها، ایندکس
+جستجو) پیش از درج حذف و پس از آن با init_db از روی داده دوباره ساخته می‌شوند (مثل یک دیتابیس قدیمی که
+مهاجرت می‌کند). change_log خالی می‌ماند. رمز همه کارشناس‌ها agent123 و ادمین admin/admin123 است.
+
+    python -m benchmarks.datagen --out /tmp/crm-bench.db --scale 0.1
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import time
+
+from benchmarks.common import main, use_fresh_db
+
+FULL_SIZE = {"companies": 10_000, "users": 500_000, "calls": 5_000_000, "followups": 1_000_000,
+             "orders": 200_000, "products": 300, "agents": 25}
+AGENT_PASSWORD = "agent123"
+CHUNK = 50_000
+
+FIRST_NAMES = ["علی", "محمد", "حسین", "رضا", "مهدی", "امیر", "سعید", "حمید", "مجید", "احمد", "مصطفی", "جواد",
+               "فاطمه", "زهرا", "مریم", "نرگس", "سارا", "مینا", "لیلا", "الهام", "شیما", "نازنین", "فرزانه", "مهسا",
+               "علیرضا", "محمدرضا", "امیرحسین", "ابوالفضل", "پویا", "کیان", "بهاره", "پریسا", "سمیرا", "هانیه"]
+LAST_NAMES = ["محمدی", "حسینی", "احمدی", "رضایی", "کریمی", "موسوی", "جعفری", "قاسمی", "صادقی", "رحیمی",
+              "نوری", "کاظمی", "مرادی", "عباسی", "اکبری", "تهرانی", "شیرازی", "اصفهانی", "یزدانی", "فرهادی",
+              "طاهری", "نجفی", "سلطانی", "زارعی", "باقری", "شریفی", "امینی", "خسروی", "میرزایی", "بهرامی"]
+PROVINCES = ["تهران", "اصفهان", "خراسان رضوی", "فارس", "آذربایجان شرقی", "خوزستان", "البرز", "قم", "مازندران",
+             "گیلان", "کرمان", "یزد", "همدان", "کرمانشاه", "مرکزی", "قزوین", "سمنان", "هرمزگان", "بوشهر", "زنجان"]
+DOMAINS = ["صنایع غذایی", "لبنیات", "دارویی", "آرایشی بهداشتی", "شوینده", "خشکبار", "نوشیدنی", "شیرینی و شکلات",
+           "ادویه", "کشاورزی", "پخش مویرگی", "فروشگاه زنجیره‌ای"]
+COMPANY_PREFIXES = ["شرکت", "صنایع", "گروه صنعتی", "بازرگانی", "پخش", "کارخانه"]
+COMPANY_WORDS = ["پارس", "آریا", "سپهر", "البرز", "کیمیا", "زرین", "مهر", "آفتاب", "نگین", "سحر", "دنا", "تابان",
+                 "ایرانیان", "شرق", "ماهان", "رویا", "پاک", "سبز", "طلایی", "بهار"]
+PRODUCT_CATEGORIES = ["لفاف", "کارتن", "سلفون", "لیبل", "کیسه", "ظروف یکبار مصرف"]
+CALL_NOTES = ["", "", "درخواست پیش‌فاکتور", "قیمت ارسال شد", "تماس مجدد هفته بعد", "نمونه خواستند",
+              "مسئول خرید در جلسه بود", "شماره اشتباه", "پیگیری سفارش قبلی", "ناراضی از قیمت"]
+FOLLOWUP_TITLES = ["ارسال پیش‌فاکتور", "تماس مجدد", "ارسال نمونه", "هماهنگی جلسه", "پیگیری پرداخت", "پیگیری سفارش"]
+PHONE_PREFIXES = ["0912", "0935", "0919", "0901", "0936", "0915", "0917", "0921", "0990", "0938"]
+
+SPAN_SECONDS = 2 * 365 * 24 * 3600  # داده دو سال گذشته
+
+
+def sizes_for(scale: float) -> dict:
+    return {k: max(1, int(v * scale)) if k not in ("products", "agents") else v for k, v in FULL_SIZE.items()}
+
+
+def _skewed(rnd: random.Random, n: int) -> int:
+    """ID بین 1 و n با توزیع ناهمگون: تعداد کمی مخاطب بیشتر تماس‌ها را دارند (مثل داده واقعی)."""
+    return int(n * rnd.random() ** 2.5) + 1
+
+
+def _companies(rnd: random.Random, n: int, now: int):
+    for i in range(n):
+        ts = now - rnd.randrange(SPAN_SECONDS)
+        yield (f"{rnd.choice(COMPANY_PREFIXES)} {rnd.choice(COMPANY_WORDS)} {rnd.choice(COMPANY_WORDS)} {i + 1}",
+               f"021{rnd.randrange(10**7, 10**8)}", f"{rnd.choice(PROVINCES)}، خیابان {rnd.choice(COMPANY_WORDS)}",
+               rnd.choices(main.LEVELS, (70, 5, 10, 15))[0], rnd.choices(main.COMPANY_STATUSES, (50, 25, 10, 15))[0], ts, ts)
+
+
+def _users(rnd: random.Random, n: int, n_companies: int, agent_ids: list, now: int):
+    for i in range(n):
+        first, last = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+        ts = now - rnd.randrange(SPAN_SECONDS)
+        yield (first, last, f"{first} {last}", f"{PHONE_PREFIXES[i % len(PHONE_PREFIXES)]}{i:07d}",
+               rnd.randint(1, n_companies) if rnd.random() < 0.7 else None,
+               rnd.choices(main.USER_STATUSES, (40, 30, 10, 15, 5))[0], rnd.choice(DOMAINS), rnd.choice(PROVINCES),
+               rnd.choices(main.LEVELS, (70, 5, 10, 15))[0],
+               rnd.choice(agent_ids) if rnd.random() < 0.95 else None, ts, ts)
+
+
+def _calls(rnd: random.Random, n: int, n_users: int, agent_ids: list, now: int):
+    for _ in range(n):
+        ts = now - rnd.randrange(SPAN_SECONDS)
+        ts -= ts % 60
+        yield (_skewed(rnd, n_users), ts, rnd.choices(main.CALL_STATUSES, (35, 40, 15, 10))[0],
+               rnd.choice(CALL_NOTES), rnd.choice(agent_ids), ts, ts)
+
+
+def _followups(rnd: random.Random, n: int, n_users: int, agent_ids: list, now: int):
+    for _ in range(n):
+        due = now + rnd.randrange(-SPAN_SECONDS, 60 * 24 * 3600)
+        # پیگیری‌های گذشته بیشتر بسته شده‌اند
+        done = rnd.random() < (0.85 if due < now else 0.1)
+        yield (_skewed(rnd, n_users), rnd.choice(FOLLOWUP_TITLES), "", due - due % 3600,
+               main.TASK_STATUSES[1 if done else 0], rnd.choice(agent_ids))
+
+
+def _products(rnd: random.Random, n: int):
+    for i in range(n):
+        category = rnd.choice(PRODUCT_CATEGORIES)
+        yield category, f"{category} کد {i + 1}", round(rnd.lognormvariate(14.5, 0.8), -3)  # تومان؛ میانه حدود ۲ میلیون
+
+
+def _orders(rnd: random.Random, n: int, n_users: int, user_company: dict, prices: list, now: int):
+    """(سفارش، اقلام) با ID صریح: ۱ تا ۳ قلم با قیمت فهرست (گاهی با تخفیف) و مبلغ کل برابر جمع اقلام."""
+    for order_id in range(1, n + 1):
+        uid = _skewed(rnd, n_users)
+        ts = now - rnd.randrange(SPAN_SECONDS)
+        lines = [(order_id, pid, rnd.choice((1, 2, 5, 10, 20, 50, 100)), prices[pid - 1] * rnd.choice((1, 1, 1, 0.95, 0.9)))
+                 for pid in rnd.sample(range(1, len(prices) + 1), rnd.choices((1, 2, 3), (60, 30, 10))[0])]
+        total = round(sum(qty * price for _, _, qty, price in lines), 2)
+        yield (order_id, uid, user_company.get(uid), lines[0][1], ts,
+               rnd.choices(main.ORDER_STATUSES, (30, 50, 10, 10))[0], total, ts, ts), lines
+
+
+def _insert(conn: sqlite3.Connection, sql: str, rows, child_sql: str = None) -> int:
+    """درج تکه‌تکه (حافظه ثابت، مستقل از اندازه داده). با child_sql هر ردیف (ردیف، ردیف‌های فرزند) است."""
+    total, chunk, children = 0, [], []
+    for row in rows:
+        if child_sql:
+            row, child_rows = row
+            children += child_rows
+        chunk.append(row)
+        if len(chunk) >= CHUNK:
+            conn.executemany(sql, chunk); total += len(chunk); chunk = []
+            if child_sql: conn.executemany(child_sql, children); children = []
+    if chunk:
+        conn.executemany(sql, chunk); total += len(chunk)
+    if children:
+        conn.executemany(child_sql, children)
+    return total
+
+
+def generate(path: str, scale: float = 1.0, seed: int = 1403) -> dict:
+    sizes = sizes_for(scale)
+    rnd = random.Random(seed)
+    started = time.perf_counter()
+    path = use_fresh_db(path)
+    for i in range(sizes["agents"]):
+        main.create_app_user(main.AppUserCreate(username=f"agent{i + 1}", password=AGENT_PASSWORD, role="agent"))
+    conn = sqlite3.connect(path)
+    agent_ids = [r[0] for r in conn.execute("SELECT id FROM app_users WHERE role='agent' ORDER BY id;")]
+    now = int(time.time())
+
+    # triggerها و جدول‌های مشتق حذف می‌شوند؛ init_db در انتها همه را از روی داده دوباره می‌سازد
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='trigger';").fetchall():
+        conn.execute(f"DROP TRIGGER {name};")
+    for table in ("user_activity", "users_fts", "companies_fts", *main.ANALYTICS_ROLLUP_TABLES):
+        conn.execute(f"DROP TABLE IF EXISTS {table};")
+    conn.execute("PRAGMA synchronous=OFF;")
+    conn.execute("PRAGMA cache_size=-262144;")
+
+    # زمان‌ها به‌صورت ثانیه یونیکس فرستاده و در خود SQLite قالب‌بندی می‌شوند
+    counts, ts = {}, "datetime(?, 'unixepoch')"
+    with conn:
+        counts["products"] = _insert(conn, "INSERT INTO products (category, name, unit_price) VALUES (?,?,?);",
+                                     _products(rnd, sizes["products"]))
+        counts["companies"] = _insert(conn, f"""INSERT INTO companies (name, phone, address, level, status, created_at, updated_at)
+            VALUES (?,?,?,?,?,{ts},{ts});""", _companies(rnd, sizes["companies"], now))
+        counts["users"] = _insert(conn, f"""INSERT INTO users (first_name, last_name, full_name, phone, company_id, status,
+            domain, province, level, owner_id, created_at, updated_at)
+            VALUES (?,?,?,?,?,?,?,?,?,?,{ts},{ts});""",
+            _users(rnd, sizes["users"], counts["companies"], agent_ids, now))
+        counts["calls"] = _insert(conn, f"""INSERT INTO calls (user_id, call_datetime, status, description, created_by,
+            created_at, updated_at) VALUES (?,{ts},?,?,?,{ts},{ts});""",
+            _calls(rnd, sizes["calls"], counts["users"], agent_ids, now))
+        counts["followups"] = _insert(conn, f"""INSERT INTO followups (user_id, title, details, due_date, status, created_by)
+            VALUES (?,?,?,{ts},?,?);""", _followups(rnd, sizes["followups"], counts["users"], agent_ids, now))
+        user_company = dict(conn.execute("SELECT id, company_id FROM users WHERE company_id IS NOT NULL;").fetchall())
+        prices = [r[0] for r in conn.execute("SELECT unit_price FROM products ORDER BY id;")]
+        counts["orders"] = _insert(conn, f"""INSERT INTO orders (id, user_id, company_id, product_id, order_date, status,
+            total_amount, created_at, updated_at) VALUES (?,?,?,?,date(?, 'unixepoch'),?,?,{ts},{ts});""",
+            _orders(rnd, sizes["orders"], counts["users"], user_company, prices, now),
+            "INSERT INTO order_items (order_id, product_id, quantity, unit_price) VALUES (?,?,?,?);")
+        counts["order_items"] = conn.execute("SELECT COUNT(*) FROM order_items;").fetchone()[0]
+    conn.close()
+    loaded = time.perf_counter()
+
+    main.db_pool.reset()
+    main.init_db()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    conn.close()
+    main.db_pool.reset()
+    counts["agents"] = len(agent_ids)
+    return {"path": path, "scale": scale, "seed": seed, "counts": counts,
+            "load_s": round(loaded - started, 1), "derive_s": round(time.perf_counter() - loaded, 1),
+            "size_mb": round(os.path.getsize(path) / 2**20, 1)}
+
+
+def run(argv=None) -> dict:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--out", default=None, help="مسیر فایل خروجی (پیش‌فرض: پوشه موقت)")
+    p.add_argument("--scale", type=float, default=1.0)
+    p.add_argument("--seed", type=int, default=1403)
+    args = p.parse_args(argv)
+    info = generate(args.out, args.scale, args.seed)
+    print(json.dumps(info, ensure_ascii=False, indent=2))
+    return info
+
+
+if __name__ == "__main__":
+    run()
@@ -38,7 +38,8 @@ api.interceptors.response.use(
     },
     (error) => {
         // اگر خطای 401 (غیرمجاز) بود، توکن را حذف و به صفحه اصلی هدایت کن
-        if (error.response && error.response.status === 401) {
+        // (درخواست‌هایی که با skipAuthRedirect فرستاده شده‌اند 401 را خودشان مدیریت می‌کنند)
+        if (error.response && error.response.status === 401 && !error.config?.skipAuthRedirect) {
             localStorage.removeItem('crm-token');
             // از window.location.replace استفاده می‌کنیم تا تاریخچه مرورگر را تمیز کنیم
             if (window.location.pathname !== '/') {
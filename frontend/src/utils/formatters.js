@@ -40,4 +40,12 @@ export function formatJalaliDateTime(isoString) {
   } catch (e) {
     return isoString;
   }
-}
\ No newline at end of file
+}
+/**
+ * مبلغ عددی را با جداکننده هزارگان نمایش می‌دهد (مثال: 15000000 -> "15,000,000").
+ */
+export function formatAmount(value) {
+  if (value === null || value === undefined || value === '') return value;
+  const n = Number(value);
+  return Number.isFinite(n) ? n.toLocaleString('en-US', { maximumFractionDigits: 0 }) : value;
+}
@@ -6,22 +6,37 @@ FardaPack Mini-CRM — Backend API (FastAPI + SQLite)
 
 # ====================== 1. وارد کردن کتابخانه‌ها ======================
 import sqlite3
-from datetime import datetime, date, timedelta
-from typing import Optional, List, Tuple, Dict, Any
+from datetime import datetime, date, timedelta, timezone
+from typing import Optional, List, Tuple, Dict, Any, Union
 
 # ❌ pandas حذف شده (این خط واردات هم حذف شد)
-import hashlib
+import hashlib, hmac, zlib
 import uuid
-import os, io, zipfile, shutil
+import os, io, zipfile, shutil, tempfile, mimetypes
+import json, base64, re, csv
+from xml.sax.saxutils import escape as xml_escape
+import xml.etree.ElementTree as ET
+import threading, time, asyncio, functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import OrderedDict
 
 # 👇 کتابخانه‌های FastAPI
-from fastapi import FastAPI, Depends, HTTPException, status, Query, Body, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Body, UploadFile, File, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, Response, HTMLResponse 
+from fastapi.responses import FileResponse, JSONResponse, Response, HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles 
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import MutableHeaders, Headers
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from pydantic import BaseModel, Field
 
+try:
+    import orjson  # اختیاری: encode سریع‌تر JSON لیست‌ها
+except Exception:
+    orjson = None
+
 # ====================== 2. راه‌اندازی FastAPI و CORS ======================
 
 app = FastAPI(
@@ -39,6 +54,93 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- فشرده‌سازی پاسخ‌ها (brotli/gzip) ---
+# پاسخ‌های متنی/JSON بزرگ‌تر از COMPRESS_MIN_SIZE فشرده می‌شوند؛ پاسخ‌های استریم (خروجی CSV) تکه‌به‌تکه با
+# flush فشرده می‌شوند تا استریم بمانند. SSE و فایل‌های از قبل فشرده (zip/xlsx/zst/بکاپ) دست نمی‌خورند.
+try:
+    import brotli  # اختیاری؛ بدون آن فقط gzip
+except Exception:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get("CRM_COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+COMPRESS_SKIP_TYPES = ("text/event-stream",)
+COMPRESS_ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)  # به ترتیب اولویت
+
+def preferred_encodings(accept_encoding: str, supported) -> List[str]:
+    """کدگذاری‌های supported که Accept-Encoding می‌پذیرد، به ترتیب q و بعد ترتیب خود supported؛ q=0 یعنی رد.
+    کدگذاری نام‌برده‌نشده q ِ «*» را می‌گیرد (و اگر * نباشد پذیرفته نیست)."""
+    weights = {}
+    for token in accept_encoding.lower().split(","):
+        name, *params = [part.strip() for part in token.split(";")]
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try: q = float(value)
+                except ValueError: q = 0.0
+        weights[name] = q
+    ranked = [(weights.get(e, weights.get("*", 0.0)), -i, e) for i, e in enumerate(supported)]
+    return [e for q, _, e in sorted(ranked, reverse=True) if q > 0]
+
+class _StreamCompressor:
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            self._c = brotli.Compressor(quality=4)
+            self._step, self._flush, self._finish = self._c.process, self._c.flush, self._c.finish
+        else:
+            self._c = zlib.compressobj(5, zlib.DEFLATED, 31)
+            self._step = self._c.compress
+            self._flush, self._finish = (lambda: self._c.flush(zlib.Z_SYNC_FLUSH)), self._c.flush
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self._step(data) + (self._finish() if final else self._flush())
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_SIZE):
+        self.app, self.minimum_size = app, minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"accept-encoding"), "")
+        encoding = next(iter(preferred_encodings(accept, COMPRESS_ENCODINGS)), None)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        start, compressor = None, None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                start = message; return  # تا رسیدن اولین تکه بدنه (برای دانستن اندازه) نگه داشته می‌شود
+            if message["type"] != "http.response.body":
+                return await send(message)
+            body, more = message.get("body", b""), message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(scope=start)
+                ctype = headers.get("content-type", "")
+                if ("content-encoding" not in headers and ctype.startswith(COMPRESS_TYPES)
+                        and not ctype.startswith(COMPRESS_SKIP_TYPES) and (more or len(body) >= self.minimum_size)):
+                    compressor = _StreamCompressor(encoding)
+                    body = compressor.compress(body, final=not more)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers: del headers["content-length"]
+                    if not more: headers["Content-Length"] = str(len(body))
+                    etag = headers.get("etag")
+                    if etag and not etag.startswith("W/"): headers["ETag"] = "W/" + etag
+                await send(start); start = None
+                return await send({"type": "http.response.body", "body": body, "more_body": more})
+            if compressor is not None:
+                body = compressor.compress(body, final=not more)
+            await send({"type": "http.response.body", "body": body, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
+
+app.add_middleware(CompressionMiddleware)
+
 # ✅ سرو فایل‌های استاتیک
 try:
     if os.path.exists("static"):
@@ -59,6 +161,10 @@ class TokenResponse(BaseModel):
     username: str
     role: str
 
+class StreamTicketResponse(BaseModel):
+    ticket: str
+    expires_in: int
+
 class UserAuthInfo(BaseModel):
     id: int
     username: str
@@ -121,17 +227,45 @@ class FollowupCreate(BaseModel):
 class FollowupStatusUpdate(BaseModel):
     status: str
 
+BULK_WRITE_MAX_ITEMS = int(os.environ.get("CRM_BULK_WRITE_MAX_ITEMS", "5000"))
+
+class CallBulkCreate(BaseModel):
+    items: List[CallCreate] = Field(..., min_length=1, max_length=BULK_WRITE_MAX_ITEMS)
+
+class FollowupBulkCreate(BaseModel):
+    items: List[FollowupCreate] = Field(..., min_length=1, max_length=BULK_WRITE_MAX_ITEMS)
+
+class FollowupStatusItem(BaseModel):
+    id: int
+    status: str
+
+class FollowupBulkStatusUpdate(BaseModel):
+    items: List[FollowupStatusItem] = Field(..., min_length=1, max_length=BULK_WRITE_MAX_ITEMS)
+
+class BulkWriteResult(BaseModel):
+    ok: int
+    failed: int
+    results: List[Dict[str, Any]]  # به ترتیب ورودی: {"index", "id"} یا {"index", "error"}
+
 class ProductCreate(BaseModel):
     category: str
     name: str
+    unit_price: float = Field(0, ge=0)  # قیمت فهرست؛ در هر قلم سفارش کپی می‌شود
+
+class OrderItemCreate(BaseModel):
+    product_id: int
+    quantity: float = Field(1, gt=0)
+    unit_price: Optional[float] = Field(None, ge=0)  # خالی = قیمت فعلی محصول
 
 class OrderCreate(BaseModel):
     user_id: Optional[int] = None
     company_id: Optional[int] = None
-    product_id: int
+    product_id: Optional[int] = None
     order_date: date
     status: str = "در حال پیگیری"
-    total_amount: float
+    items: Optional[List[OrderItemCreate]] = Field(None, min_length=1, max_length=BULK_WRITE_MAX_ITEMS)
+    # مبلغ کل از اقلام محاسبه می‌شود؛ فقط در شکل قدیمی (product_id بدون items) مبلغ همان یک قلم است
+    total_amount: Optional[float] = None
 
 class AppUserCreate(BaseModel):
     username: str
@@ -146,45 +280,113 @@ class BulkOwnerUpdate(BaseModel):
 class PasswordUpdate(BaseModel):
     new_password: str
 
+class JobAccepted(BaseModel):
+    message: str
+    job_id: str
+    status_url: str
+
 
 # ====================== 4. توابع کمکی (تاریخ شمسی و ...) ======================
-try:
-    from persiantools.jdatetime import JalaliDate, JalaliDateTime
-except Exception:
-    JalaliDate = None
-    JalaliDateTime = None
+# تبدیل حسابی میلادی ↔ شمسی (بدون وابستگی خارجی). تبدیل هر روز یک بار انجام و در LRU نگه داشته می‌شود؛
+# لیست‌های بزرگ با jalali_columns ستون‌به‌ستون تبدیل می‌شوند و گزارش‌های SQL از جدول calendar_days استفاده می‌کنند.
+_G_DAYS_BEFORE_MONTH = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+_JALALI_DATE_RE = re.compile(r"^\s*(\d{4})[/\-](\d{1,2})[/\-](\d{1,2})\s*$")
+
+def gregorian_to_jalali(gy: int, gm: int, gd: int) -> Tuple[int, int, int]:
+    gy2 = gy + 1 if gm > 2 else gy
+    days = 355666 + 365 * gy + (gy2 + 3) // 4 - (gy2 + 99) // 100 + (gy2 + 399) // 400 + gd + _G_DAYS_BEFORE_MONTH[gm - 1]
+    jy = -1595 + 33 * (days // 12053)
+    days %= 12053
+    jy += 4 * (days // 1461)
+    days %= 1461
+    if days > 365:
+        jy += (days - 1) // 365
+        days = (days - 1) % 365
+    if days < 186:
+        return jy, 1 + days // 31, 1 + days % 31
+    return jy, 7 + (days - 186) // 30, 1 + (days - 186) % 30
+
+def jalali_to_gregorian(jy: int, jm: int, jd: int) -> Tuple[int, int, int]:
+    jy += 1595
+    days = -355668 + 365 * jy + (jy // 33) * 8 + (jy % 33 + 3) // 4 + jd + ((jm - 1) * 31 if jm < 7 else (jm - 7) * 30 + 186)
+    gy = 400 * (days // 146097)
+    days %= 146097
+    if days > 36524:
+        days -= 1
+        gy += 100 * (days // 36524)
+        days %= 36524
+        if days >= 365: days += 1
+    gy += 4 * (days // 1461)
+    days %= 1461
+    if days > 365:
+        gy += (days - 1) // 365
+        days = (days - 1) % 365
+    g = date(gy, 1, 1) + timedelta(days=days)
+    return g.year, g.month, g.day
+
+@functools.lru_cache(maxsize=65536)
+def _jalali_day(day: str) -> Optional[str]:
+    """'2024-03-20' ← '1403/01/01'؛ None اگر day تاریخ میلادی معتبر نباشد."""
+    try:
+        jy, jm, jd = gregorian_to_jalali(*date.fromisoformat(day).timetuple()[:3])
+    except (TypeError, ValueError):
+        return None
+    return f"{jy:04d}/{jm:02d}/{jd:02d}"
 
-def _jalali_supported() -> bool:
-    return JalaliDate is not None
+@functools.lru_cache(maxsize=8192)
+def jalali_month(day: Optional[str]) -> Optional[str]:
+    """'2024-03-20' ← '1403/01' (هر روز فقط یک بار محاسبه می‌شود)؛ در SQL همان ستون calendar_days.jalali_month است."""
+    jday = _jalali_day(day[:10]) if isinstance(day, str) else None
+    return jday[:7] if jday else None
 
 def today_jalali_str() -> str:
-    return JalaliDate.today().strftime("%Y/%m/%d") if _jalali_supported() else ""
+    return date_to_jalali_str(date.today())
 
+@functools.lru_cache(maxsize=8192)
 def jalali_str_to_date(s: str) -> Optional[date]:
-    if not s or not _jalali_supported(): return None
-    try:
-        g = JalaliDate.strptime(s.strip(), "%Y/%m/%d").to_gregorian()
-        return date(g.year, g.month, g.day)
-    except Exception: return None
+    """'1403/01/01' (یا با - و ارقام فارسی) ← date؛ تاریخ ناموجود مثل 1403/12/31 None می‌دهد."""
+    m = _JALALI_DATE_RE.match(normalize_fa(s)) if s else None
+    if not m: return None
+    jy, jm, jd = map(int, m.groups())
+    if not (1 <= jm <= 12 and 1 <= jd <= 31): return None
+    g = date(*jalali_to_gregorian(jy, jm, jd))
+    return g if gregorian_to_jalali(g.year, g.month, g.day) == (jy, jm, jd) else None
 
 def date_to_jalali_str(d: date) -> str:
-    if not d or not _jalali_supported(): return ""
-    try:
-        return JalaliDate.fromgregorian(date=d).strftime("%Y/%m/%d")
-    except Exception: return ""
+    return (_jalali_day(d.isoformat()) or "") if d else ""
 
 def dt_to_jalali_str(dt_iso_or_none: Optional[str]) -> str:
-    if not dt_iso_or_none or not _jalali_supported(): return dt_iso_or_none or ""
-    try:
-        if "T" in dt_iso_or_none: gdt = datetime.fromisoformat(dt_iso_or_none)
-        else:
-            try: gdt = datetime.strptime(dt_iso_or_none, "%Y-%m-%d %H:%M:%S")
-            except ValueError:
-                try: gdt = datetime.strptime(dt_iso_or_none, "%Y-%m-%d %H:%M")
-                except ValueError: gdt = datetime.strptime(dt_iso_or_none, "%Y-%m-%d")
-        jdt = JalaliDateTime.fromgregorian(datetime=gdt)
-        return jdt.strftime("%Y/%m/%d %H:%M")
-    except Exception: return dt_iso_or_none
+    """'2025-10-13 09:46:00' یا '2025-10-13T09:46' ← '1404/07/21 09:46'؛ تاریخ فقط ← '1404/07/21'. مقدار نامعتبر همان‌طور برمی‌گردد."""
+    if not dt_iso_or_none or not isinstance(dt_iso_or_none, str): return dt_iso_or_none or ""
+    jday = _jalali_day(dt_iso_or_none[:10])
+    if jday is None: return dt_iso_or_none
+    time_part = dt_iso_or_none[11:16]
+    return f"{jday} {time_part}" if time_part else jday
+
+# ستون‌های تاریخ خروجی توابع لیست (df_*) که با ?jalali=true شمسی برگردانده می‌شوند
+JALALI_DATE_COLUMNS = frozenset({"تاریخ_ایجاد", "آخرین_تماس", "آخرین_پیگیری_باز", "وضعیت_پیگیری_باز",
+                                 "تاریخ_و_زمان", "تاریخ_پیگیری", "تاریخ_سفارش"})
+
+def _jalali_value(value: Any) -> Any:
+    return dt_to_jalali_str(value) if value else value
+
+def jalali_columns(result: Any) -> Any:
+    """ستون‌های JALALI_DATE_COLUMNS را در خروجی لیست (ردیف‌ها، صفحه یا columnar) یکجا شمسی می‌کند: هر ستون با یک
+    map روی dt_to_jalali_str تبدیل می‌شود و روزهای تکراری از LRU خوانده می‌شوند. مقدار خالی (None) همان می‌ماند و
+    cursor صفحه قبلاً ساخته شده و دست نمی‌خورد."""
+    if isinstance(result, dict) and "columns" in result:
+        idx = [i for i, col in enumerate(result["columns"]) if col in JALALI_DATE_COLUMNS]
+        if idx and result["rows"]:
+            cols = list(zip(*result["rows"]))
+            for i in idx:
+                cols[i] = tuple(map(_jalali_value, cols[i]))
+            result["rows"] = list(zip(*cols))
+        return result
+    rows = result.get("items", []) if isinstance(result, dict) else result
+    for col in (JALALI_DATE_COLUMNS.intersection(rows[0]) if rows else ()):
+        for row, value in zip(rows, map(_jalali_value, [r[col] for r in rows])):
+            row[col] = value
+    return result
 
 # ====================== 5. دیتابیس و CRUD ======================
 DB_PATH = "crm.db"
@@ -195,29 +397,374 @@ COMPANY_STATUSES = ["بدون وضعیت", "در حال پیگیری", "پیش 
 LEVELS = ["هیچکدام", "طلایی", "نقره‌ای", "برنز"]
 ORDER_STATUSES = ["در حال پیگیری", "تایید شده", "کنسل شده", "رد شده"]
 
+# تنظیمات اتصال SQLite (از متغیرهای محیطی قابل تغییر است)
+DB_CACHE_SIZE_KB = int(os.environ.get("CRM_DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.environ.get("CRM_DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_SYNCHRONOUS = os.environ.get("CRM_DB_SYNCHRONOUS", "NORMAL").upper()
+DB_FILE_CHECK_INTERVAL = 1.0  # ثانیه؛ تشخیص جایگزین شدن فایل دیتابیس توسط process دیگر
+
+class PooledConnection(sqlite3.Connection):
+    """اتصال متعلق به استخر؛ close() آن را نمی‌بندد و اتصال برای درخواست بعدی همان thread باقی می‌ماند."""
+    def close(self):
+        pass
+
+    def really_close(self):
+        super().close()
+
+class ConnectionPool:
+    """
+    یک اتصال فقط‌خواندنی برای هر thread و یک اتصال نویسنده‌ی مشترک که با قفل سریال می‌شود.
+    PRAGMAها فقط یک بار هنگام باز شدن هر اتصال اعمال می‌شوند.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._writer: Optional[PooledConnection] = None
+        self._readers: List[PooledConnection] = []
+        self._generation = 0
+        self._opened = 0
+        self._reader_reuses = 0
+        self._writes = 0
+        self._write_wait_total = 0.0
+        self._write_wait_max = 0.0
+        self._file_id: Optional[Tuple[int, int]] = None
+        self._last_file_check = 0.0
+        self._reopened_after_replace = 0
+
+    @staticmethod
+    def _stat_file_id() -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(DB_PATH)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def _check_replaced(self, force: bool = False):
+        """اگر فایل دیتابیس زیر پای این process عوض شده باشد (بازیابی در worker دیگر)، اتصال‌ها دوباره باز می‌شوند.
+        برای خواندن حداکثر هر DB_FILE_CHECK_INTERVAL ثانیه یک stat؛ نوشتن (force) همیشه بررسی می‌کند تا روی فایل
+        قبلی ننویسد. داخل بلوک نوشتن انجام نمی‌شود."""
+        now = time.monotonic()
+        if getattr(self._local, "writing", False): return
+        if not force and now - self._last_file_check < DB_FILE_CHECK_INTERVAL: return
+        self._last_file_check = now
+        current = self._stat_file_id()
+        if self._file_id is not None and current is not None and current != self._file_id:
+            self._reopened_after_replace += 1
+            self.reset()
+
+    def _open(self, read_only: bool) -> PooledConnection:
+        if self._file_id is None:
+            self._file_id = self._stat_file_id()
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10, factory=PooledConnection)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        if not read_only:
+            conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS};")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB};")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE};")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        if read_only:
+            conn.execute("PRAGMA query_only=ON;")
+        conn.row_factory = sqlite3.Row
+        self._opened += 1
+        return conn
+
+    def reader(self) -> PooledConnection:
+        self._check_replaced()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.generation == self._generation:
+            self._reader_reuses += 1
+            return conn
+        with self._lock:
+            if conn is not None:
+                # اتصال کهنه همین thread؛ فقط خود thread صاحب آن را می‌بندد چون ممکن است وسط یک کوئری باشد
+                self._readers.remove(conn)
+                conn.really_close()
+            conn = self._open(read_only=True)
+            self._readers.append(conn)
+            self._local.conn, self._local.generation = conn, self._generation
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """اتصال نویسنده را قفل می‌کند؛ در پایان commit و در صورت خطا rollback می‌شود."""
+        self._check_replaced(force=True)
+        started = time.perf_counter()
+        with self._write_lock:
+            waited = time.perf_counter() - started
+            self._write_wait_total += waited
+            self._write_wait_max = max(self._write_wait_max, waited)
+            if self._writer is None:
+                self._writer = self._open(read_only=False)
+            conn = self._writer
+            outer = getattr(self._local, "writing", False)
+            self._local.writing = True
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._local.writing = outer
+                self._writes += 1
+
+    def _retire_all(self):
+        """اتصال‌های فعلی را کهنه اعلام می‌کند. خواننده‌ها ممکن است همین حالا در thread دیگری وسط کوئری باشند، پس
+        بسته نمی‌شوند؛ هر thread در فراخوانی بعدی reader() اتصال کهنه خودش را می‌بندد. نویسنده زیر قفل نوشتن است
+        و همین‌جا بسته می‌شود."""
+        self._generation += 1
+        if self._writer is not None:
+            self._writer.really_close()
+            self._writer = None
+        self._file_id = None
+
+    def reset(self):
+        """اتصال‌ها را کهنه می‌کند (مثلاً پس از جایگزینی فایل دیتابیس)؛ اتصال‌های جدید با DB_PATH فعلی باز می‌شوند."""
+        with self._write_lock, self._lock:
+            self._retire_all()
+
+    def swap_database(self, new_path: str):
+        """new_path را به‌صورت اتمیک جای DB_PATH می‌گذارد. زیر قفل نوشتن، WAL دیتابیس قبلی با checkpoint(TRUNCATE)
+        خالی می‌شود تا هیچ فریمی از آن روی فایل جدید اعمال نشود؛ -wal/-shm حذف نمی‌شوند چون process‌های دیگر هنوز
+        آن‌ها را باز دارند. اگر خواننده یا نویسنده‌ای (در این یا process دیگر) تا پایان timeout مانع checkpoint شود،
+        جایگزینی انجام نمی‌شود و sqlite3.OperationalError برمی‌گردد."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._open(read_only=False)
+            busy, _, _ = self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()
+            if busy:
+                raise sqlite3.OperationalError("دیتابیس مشغول است؛ checkpoint پیش از بازیابی انجام نشد")
+            with self._lock:
+                self._retire_all()
+                with open(new_path, "rb+") as f:
+                    os.fsync(f.fileno())
+                os.replace(new_path, DB_PATH)
+                try:
+                    dir_fd = os.open(os.path.dirname(os.path.abspath(DB_PATH)), os.O_RDONLY)
+                    try: os.fsync(dir_fd)
+                    finally: os.close(dir_fd)
+                except OSError:
+                    pass  # fsync روی پوشه در همه سیستم‌عامل‌ها پشتیبانی نمی‌شود
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "db_path": DB_PATH,
+            "open_readers": len(self._readers),
+            "writer_open": self._writer is not None,
+            "connections_opened": self._opened,
+            "reader_reuses": self._reader_reuses,
+            "writes": self._writes,
+            "reopened_after_replace": self._reopened_after_replace,
+            "write_wait_avg_ms": round(self._write_wait_total / self._writes * 1000, 3) if self._writes else 0.0,
+            "write_wait_max_ms": round(self._write_wait_max * 1000, 3),
+            "synchronous": DB_SYNCHRONOUS,
+            "cache_size_kb": DB_CACHE_SIZE_KB,
+            "mmap_size": DB_MMAP_SIZE,
+        }
+
+db_pool = ConnectionPool()
+
 def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10)
-    conn.execute("PRAGMA foreign_keys = ON;")
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.row_factory = sqlite3.Row
-    return conn
+    """اتصال خواندنی thread فعلی؛ close() روی آن بی‌اثر است و اتصال به استخر برمی‌گردد."""
+    return db_pool.reader()
+
+@contextmanager
+def write_conn(*tables: str):
+    """with write_conn("calls") as conn: ... — تمام نوشتن‌ها از این اتصال سریال‌شده عبور می‌کنند.
+    tables: جدول‌هایی که تغییر می‌کنند؛ پس از commit موفق به tables_changed اعلام می‌شوند تا کش‌ها باطل شوند."""
+    with db_pool.writer() as conn:
+        yield conn
+        if not SEARCH_INDEX.keys().isdisjoint(tables):
+            index_pending_search(conn)
+    if tables:
+        tables_changed(*tables)
+
+# --- اجرای کارهای دیتابیس خارج از event loop ---
+# اندپوینت‌های async هیچ‌وقت مستقیم SQLite صدا نمی‌زنند؛ کار در این استخر محدود انجام و await می‌شود
+# تا یک گزارش سنگین بقیه درخواست‌های همان worker را قفل نکند.
+DB_WORKERS = int(os.environ.get("CRM_DB_WORKERS", "8"))
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="crm-db")
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(fn, *args, **kwargs))
+
+def _dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, ensure_ascii=False, default=str, separators=(",", ":")).encode("utf-8")
+
+def _json_bytes(data: Any) -> bytes:
+    # لیست‌ها ردیف‌به‌ردیف encode می‌شوند: یک فراخوانی json.dumps روی کل لیست GIL را تا پایان نگه می‌دارد
+    # و event loop در آن مدت هیچ درخواستی را جواب نمی‌دهد.
+    if isinstance(data, list):
+        return b"[" + b",".join(_dumps(item) for item in data) + b"]"
+    if isinstance(data, dict):
+        key = next((k for k in ("items", "rows") if isinstance(data.get(k), list)), None)
+        if key:
+            rest = {k: v for k, v in data.items() if k != key}
+            tail = (b"," + _dumps(rest)[1:]) if rest else b"}"
+            return b'{"' + key.encode() + b'":' + _json_bytes(data[key]) + tail
+    return _dumps(data)
+
+async def run_db_json(fn, *args, **kwargs) -> Response:
+    """مثل run_db، ولی خروجی را هم در همان thread به JSON تبدیل می‌کند تا سریال‌سازی لیست‌های بزرگ
+    (که در FastAPI روی event loop انجام می‌شود) هم از loop خارج شود."""
+    body = await run_db(lambda: _json_bytes(fn(*args, **kwargs)))
+    return Response(content=body, media_type="application/json")
+
+class LRUTTLCache:
+    """کش LRU با انقضای زمانی، امن برای چند thread، همراه با شمارنده hit/miss."""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data: "OrderedDict[Any, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0: return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def remove_where(self, predicate) -> int:
+        with self._lock:
+            keys = [k for k, (v, _) in self._data.items() if predicate(k, v)]
+            for k in keys:
+                del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "maxsize": self.maxsize, "ttl_s": self.ttl,
+                "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0}
+
+# --- رویدادهای زنده (pub/sub داخل process برای SSE) ---
+# publish بعد از commit از threadهای DB صدا زده می‌شود و با call_soon_threadsafe به صف هر مشترک روی event loop
+# می‌رسد. رویداد فقط جدول و IDها را می‌گوید؛ کلاینت ردیف‌ها را از /api/changes می‌گیرد. مشترکی که عقب بماند
+# (صف پر) به‌جای رویدادهای جاافتاده یک رویداد resync می‌گیرد.
+EVENTS_QUEUE_SIZE = 256
+EVENTS_KEEPALIVE_SECONDS = 15.0
+
+class EventBroker:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Queue, Optional[int]]] = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.published = self.delivered = self.overflows = 0
+
+    def subscribe(self, owner_id: Optional[int]) -> Tuple[int, asyncio.Queue]:
+        """owner_id=None (ادمین) همه رویدادها را می‌گیرد؛ کارشناس فقط رویدادهای مخاطبین خودش را."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._next_id += 1
+            sub_id = self._next_id
+            self._subscribers[sub_id] = (asyncio.get_running_loop(), queue, owner_id)
+        return sub_id, queue
+
+    def unsubscribe(self, sub_id: int):
+        with self._lock:
+            self._subscribers.pop(sub_id, None)
+
+    def publish(self, table: str, op: str, ids: List[int], owner_ids: Optional[set] = None, **extra):
+        """owner_ids: کارشناس‌هایی که رویداد به آن‌ها مربوط است؛ None یعنی همه کاربران."""
+        event = (f"{table}.{op}", {"table": table, "op": op, "ids": ids, **extra})
+        with self._lock:
+            self.published += 1
+            targets = [(loop, queue) for loop, queue, owner in self._subscribers.values()
+                       if owner is None or owner_ids is None or owner in owner_ids]
+        for loop, queue in targets:
+            try: loop.call_soon_threadsafe(self._deliver, queue, event)
+            except RuntimeError: pass  # loop بسته شده
+
+    def _deliver(self, queue: asyncio.Queue, event):
+        if queue.full():
+            while not queue.empty(): queue.get_nowait()
+            event = ("resync", {})
+            self.overflows += 1
+        queue.put_nowait(event)
+        self.delivered += 1
+
+    def close(self):
+        """به همه استریم‌های باز پایان می‌دهد (هنگام shutdown)."""
+        with self._lock:
+            targets = [(loop, queue) for loop, queue, _ in self._subscribers.values()]
+        for loop, queue in targets:
+            try: loop.call_soon_threadsafe(queue.put_nowait, None)
+            except (RuntimeError, asyncio.QueueFull): pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"subscribers": len(self._subscribers), "published": self.published,
+                    "delivered": self.delivered, "overflows": self.overflows}
+
+event_broker = EventBroker(EVENTS_QUEUE_SIZE)
 
 def sha256(txt: str) -> str:
     return hashlib.sha256((txt or "").encode("utf-8")).hexdigest()
 
+# همه زمان‌ها به یک شکل متنی ذخیره می‌شوند ("YYYY-MM-DD HH:MM:SS"، مثل CURRENT_TIMESTAMP) تا مقایسه رشته‌ای
+# همان مقایسه زمانی باشد و فیلترهای بازه‌ای مستقیماً از ایندکس استفاده کنند (بدون date() روی ستون).
+DB_DATETIME_FMT = "%Y-%m-%d %H:%M:%S"
+
+def dt_to_db(dt: datetime) -> str:
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.strftime(DB_DATETIME_FMT)
+
+def _date_range_where(where: List[str], params: List, col: str, start: Optional[date], end: Optional[date]):
+    """start <= col < end+1 روز؛ معادل date(col) BETWEEN start AND end ولی قابل استفاده با ایندکس."""
+    if start: where.append(f"{col} >= ?"); params.append(start.isoformat())
+    if end:   where.append(f"{col} < ?"); params.append((end + timedelta(days=1)).isoformat())
+
 def _column_exists(conn: sqlite3.Connection, table: str, col: str) -> bool:
     rows = conn.execute(f"PRAGMA table_info({table});").fetchall()
     return any(r[1] == col for r in rows)
 
 def init_db():
-    conn = get_conn(); cur = conn.cursor()
+    with write_conn() as conn:
+        _create_schema(conn)
+
+def _create_schema(conn: sqlite3.Connection):
+    cur = conn.cursor()
     cur.execute("""
         CREATE TABLE IF NOT EXISTS companies (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL, phone TEXT, address TEXT, note TEXT,
             level TEXT NOT NULL DEFAULT 'هیچکدام',
             status TEXT NOT NULL DEFAULT 'بدون وضعیت',
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP, created_by INTEGER
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP, created_by INTEGER,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
         );
     """)
     if not _column_exists(conn, "companies", "status"):
@@ -234,6 +781,7 @@ def init_db():
             level TEXT NOT NULL DEFAULT 'هیچکدام',
             owner_id INTEGER,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP, created_by INTEGER,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(company_id) REFERENCES companies(id) ON DELETE SET NULL
         );
     """)
@@ -249,6 +797,7 @@ def init_db():
             user_id INTEGER NOT NULL, call_datetime TEXT NOT NULL,
             status TEXT NOT NULL CHECK(status IN ('ناموفق','موفق','خاموش','رد تماس')),
             description TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP, created_by INTEGER,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
         );
     """)
@@ -259,6 +808,7 @@ def init_db():
             due_date TEXT NOT NULL,
             status TEXT NOT NULL CHECK(status IN ('در حال انجام','پایان یافته')) DEFAULT 'در حال انجام',
             created_at TEXT DEFAULT CURRENT_TIMESTAMP, created_by INTEGER,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
         );
     """)
@@ -279,10 +829,17 @@ def init_db():
             FOREIGN KEY(app_user_id) REFERENCES app_users(id) ON DELETE CASCADE
         );
     """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stream_tickets (
+            ticket TEXT PRIMARY KEY, session_token TEXT NOT NULL, expires_at TEXT NOT NULL,
+            FOREIGN KEY(session_token) REFERENCES sessions(token) ON DELETE CASCADE
+        );
+    """)
     cur.execute(""" 
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT, category TEXT NOT NULL,
-            name TEXT NOT NULL, created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            name TEXT NOT NULL, created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
         );
     """)
     cur.execute("""
@@ -291,6 +848,7 @@ def init_db():
             product_id INTEGER, order_date TEXT NOT NULL,
             status TEXT NOT NULL DEFAULT 'در حال پیگیری',
             total_amount REAL NOT NULL, created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE SET NULL,
             FOREIGN KEY(company_id) REFERENCES companies(id) ON DELETE SET NULL,
             FOREIGN KEY(product_id) REFERENCES products(id) ON DELETE SET NULL
@@ -304,61 +862,614 @@ def init_db():
     cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id);")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_company ON orders(company_id);")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_product ON orders(product_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_date ON orders(status, order_date);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_date ON orders(order_date);")
+    if not _column_exists(conn, "products", "unit_price"):
+        cur.execute("ALTER TABLE products ADD COLUMN unit_price REAL NOT NULL DEFAULT 0;")
+        # trigger نسخه محصولات با ستون‌های جدید VERSIONED_TABLES دوباره ساخته می‌شود
+        cur.execute("DROP TRIGGER IF EXISTS trg_products_version_upd;")
+    _create_order_items(conn)
+    _migrate_timestamps(conn)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_calls_datetime ON calls(call_datetime);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_followups_due ON followups(due_date);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_followups_status_due ON followups(status, due_date);")
+    # triggerهای user_activity پیگیری‌های باز هر مخاطب را (user_id=? AND status=?) می‌شمارند؛ بدون این ایندکس
+    # planner روی idx_followups_status_due همه پیگیری‌های باز را می‌پیماید و درج گروهی درجه دو می‌شود
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_followups_user_status_due ON followups(user_id, status, due_date);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_companies_created ON companies(created_at);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at);")
+    _create_user_activity(conn)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued','running','done','failed','cancelled')),
+            progress REAL NOT NULL DEFAULT 0, message TEXT, result TEXT, error TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0, worker_pid INTEGER,
+            created_by INTEGER, created_at TEXT DEFAULT CURRENT_TIMESTAMP, started_at TEXT, finished_at TEXT
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at);")
+    _create_search_index(conn)
+    _create_change_log(conn)
+    _create_table_versions(conn)
+    _create_calendar(conn)
+    _create_analytics_rollups(conn)
     if cur.execute("SELECT COUNT(*) FROM app_users;").fetchone()[0] == 0:
         cur.execute("INSERT INTO app_users (username, password_sha256, role) VALUES (?,?,?);",
-                    ("admin", sha256("admin123"), "admin"))
-    conn.commit(); conn.close()
+                    ("admin", hash_password("admin123"), "admin"))
+
+def _migrate_timestamps(conn: sqlite3.Connection):
+    """مقادیر قدیمی call_datetime/due_date (مثل '2025-10-13T09:46' یا '2025-10-13') را یک بار به شکل استاندارد DB_DATETIME_FMT می‌برد."""
+    if conn.execute("PRAGMA user_version;").fetchone()[0] >= 1:
+        return
+    for table, col in (("calls", "call_datetime"), ("followups", "due_date")):
+        canon = f"strftime('%Y-%m-%d %H:%M:%S', {col})"
+        conn.execute(f"UPDATE {table} SET {col} = {canon} WHERE {canon} IS NOT NULL AND {col} <> {canon};")
+    conn.execute("PRAGMA user_version = 1;")
+
+def _create_order_items(conn: sqlite3.Connection):
+    """اقلام سفارش (محصول، تعداد، قیمت واحد). سفارش‌های قدیمی یک محصول و یک مبلغ کل داشتند و یک بار به یک قلم
+    با تعداد ۱ تبدیل می‌شوند؛ سهم محصول/دسته در sales_rollup از این پس از اقلام می‌آید، پس rollup فروش هم از نو ساخته می‌شود."""
+    is_new = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='order_items';").fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, order_id INTEGER NOT NULL, product_id INTEGER,
+            quantity REAL NOT NULL CHECK(quantity > 0), unit_price REAL NOT NULL,
+            FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE,
+            FOREIGN KEY(product_id) REFERENCES products(id) ON DELETE SET NULL
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items(product_id, order_id);")
+    if is_new:
+        conn.execute("INSERT INTO order_items (order_id, product_id, quantity, unit_price) SELECT id, product_id, 1, total_amount FROM orders;")
+        for event in ("ins", "del", "upd"):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_sales_rollup_{event};")
+        conn.execute("DROP TABLE IF EXISTS sales_rollup;")
+
+# خلاصه فعالیت هر مخاطب (آخرین تماس، پیگیری‌های باز) که با trigger روی calls/followups به‌روز می‌ماند
+# تا لیست مخاطبین به‌جای چند زیرکوئری وابسته برای هر ردیف، یک JOIN ساده و فیلترهای ایندکس‌دار داشته باشد.
+_USER_ACTIVITY_REFRESH = """
+    INSERT OR REPLACE INTO user_activity
+        (user_id, last_call_at, last_call_status, open_followups_count, next_open_due, last_open_due)
+    SELECT u.id,
+        (SELECT cl.call_datetime FROM calls cl WHERE cl.user_id=u.id ORDER BY cl.call_datetime DESC, cl.id DESC LIMIT 1),
+        (SELECT cl.status FROM calls cl WHERE cl.user_id=u.id ORDER BY cl.call_datetime DESC, cl.id DESC LIMIT 1),
+        (SELECT COUNT(*) FROM followups f WHERE f.user_id=u.id AND f.status='در حال انجام'),
+        (SELECT MIN(f.due_date) FROM followups f WHERE f.user_id=u.id AND f.status='در حال انجام'),
+        (SELECT MAX(f.due_date) FROM followups f WHERE f.user_id=u.id AND f.status='در حال انجام')
+    FROM users u {where};
+"""
+
+def _create_user_activity(conn: sqlite3.Connection):
+    is_new = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_activity';").fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_activity (
+            user_id INTEGER PRIMARY KEY,
+            last_call_at TEXT, last_call_status TEXT,
+            open_followups_count INTEGER NOT NULL DEFAULT 0,
+            next_open_due TEXT, last_open_due TEXT
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_last_call ON user_activity(last_call_at);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_open ON user_activity(open_followups_count) WHERE open_followups_count > 0;")
+    refresh = lambda expr: _USER_ACTIVITY_REFRESH.format(where=f"WHERE u.id = {expr}")
+    triggers = {
+        "trg_users_activity_ins": f"AFTER INSERT ON users BEGIN {refresh('new.id')} END",
+        "trg_users_activity_del": "AFTER DELETE ON users BEGIN DELETE FROM user_activity WHERE user_id = old.id; END",
+        "trg_calls_activity_ins": f"AFTER INSERT ON calls BEGIN {refresh('new.user_id')} END",
+        "trg_calls_activity_del": f"AFTER DELETE ON calls BEGIN {refresh('old.user_id')} END",
+        "trg_calls_activity_upd": f"AFTER UPDATE OF user_id, call_datetime, status ON calls BEGIN {refresh('old.user_id')} {refresh('new.user_id')} END",
+        "trg_followups_activity_ins": f"AFTER INSERT ON followups BEGIN {refresh('new.user_id')} END",
+        "trg_followups_activity_del": f"AFTER DELETE ON followups BEGIN {refresh('old.user_id')} END",
+        "trg_followups_activity_upd": f"AFTER UPDATE OF user_id, due_date, status ON followups BEGIN {refresh('old.user_id')} {refresh('new.user_id')} END",
+    }
+    for name, body in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body};")
+    if is_new:
+        conn.execute(_USER_ACTIVITY_REFRESH.format(where=""))
+
+# --- جستجوی متنی (FTS5) ---
+# یکسان‌سازی حروف عربی/فارسی، ارقام و نیم‌فاصله؛ همین تابع هم روی متن ایندکس‌شده و هم روی متن جستجو اعمال
+# می‌شود تا «علي» و «علی» یا «۰۹۱۲» و «0912» یک توکن شوند.
+_FA_NORMALIZE_MAP = {
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه", "أ": "ا", "إ": "ا", "ٱ": "ا",
+    "\u200c": " ", "\u200f": "", "ـ": "",
+    **{d: str(i) for i, d in enumerate("۰۱۲۳۴۵۶۷۸۹")},
+    **{d: str(i) for i, d in enumerate("٠١٢٣٤٥٦٧٨٩")},
+}
+_FA_TRANSLATE = str.maketrans(_FA_NORMALIZE_MAP)
+
+def normalize_fa(text: Optional[str]) -> str:
+    return (text or "").translate(_FA_TRANSLATE).lower()
+
+def normalize_phone(phone: Optional[str]) -> str:
+    """شماره بدون فاصله/خط تیره/پرانتز تا «0912 333» و «0912-333» هم با جستجوی «0912333» پیدا شوند."""
+    return re.sub(r"[\s\-()]", "", normalize_fa(phone))
+
+def _drop_triggers_calling(conn: sqlite3.Connection, *functions: str):
+    """triggerهای نسخه‌های قبل که توابع ثبت‌شده در app را صدا می‌زدند حذف می‌شوند تا با SQL خالص دوباره ساخته شوند."""
+    for name, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger';").fetchall():
+        if any(f"{fn}(" in sql for fn in functions):
+            conn.execute(f"DROP TRIGGER {name};")
+
+# توکنایزر trigram جستجوی «زیررشته» را ایندکس‌پذیر می‌کند (رضا ← علیرضا، 333 ← 09123334444)، اما کلمات کوتاه‌تر از
+# سه حرف را نمی‌تواند جستجو کند.
+FTS_MIN_TOKEN = 3
+
+def fts_match_query(q: Optional[str], column: Optional[str] = None, strict: bool = False) -> Optional[str]:
+    """متن کاربر را به عبارت MATCH امن تبدیل می‌کند: هر کلمه یک زیررشته و همه با هم (AND).
+    strict: اگر کلمه‌ای کوتاه‌تر از FTS_MIN_TOKEN باشد None برمی‌گرداند تا فراخواننده به LIKE برگردد؛
+    در غیر این صورت کلمات کوتاه نادیده گرفته می‌شوند."""
+    tokens = re.findall(r"\w+", normalize_fa(q))
+    if strict and any(len(t) < FTS_MIN_TOKEN for t in tokens): return None
+    tokens = [t for t in tokens if len(t) >= FTS_MIN_TOKEN]
+    if not tokens: return None
+    expr = " ".join(f'"{t}"' for t in tokens)
+    return f"{column} : ({expr})" if column else expr
+
+# triggerها فقط شناسه ردیف درج/ویرایش‌شده را در search_pending می‌گذارند (SQL خالص، پس نوشتن از sqlite3 CLI یا
+# اسکریپت‌های بیرون از app هم کار می‌کند) و متن یکسان‌شده در پایتون ساخته می‌شود: write_conn پیش از commit هر نوشتن
+# روی users/companies صف را در FTS خالی می‌کند. ردیف‌هایی که بیرون از app نوشته شده‌اند در اولین نوشتن بعدی app
+# روی همین جدول‌ها یا در init_db ایندکس می‌شوند. حذف ردیف مستقیماً در trigger از FTS پاک می‌شود.
+SEARCH_INDEX = {
+    # جدول: (جدول FTS، ستون‌های FTS، (ستون مبدأ، تابع یکسان‌سازی) به همان ترتیب)
+    "users": ("users_fts", "name, phone, domain, province, note",
+              (("full_name", normalize_fa), ("phone", normalize_phone), ("domain", normalize_fa),
+               ("province", normalize_fa), ("note", normalize_fa))),
+    "companies": ("companies_fts", "name, phone, address",
+                  (("name", normalize_fa), ("phone", normalize_phone), ("address", normalize_fa))),
+}
+
+def _create_search_index(conn: sqlite3.Connection):
+    tokenize = "tokenize=\"trigram case_sensitive 0\""
+    conn.execute("""CREATE TABLE IF NOT EXISTS search_pending (
+        tbl TEXT NOT NULL, row_id INTEGER NOT NULL, PRIMARY KEY (tbl, row_id)) WITHOUT ROWID;""")
+    # triggerهای نسخه قبل متن را با توابع ثبت‌شده در app (fa_norm/fa_phone) یکسان می‌کردند
+    _drop_triggers_calling(conn, "fa_norm", "fa_phone")
+    for table, (fts, columns, sources) in SEARCH_INDEX.items():
+        is_new = conn.execute("SELECT 1 FROM sqlite_master WHERE name=?;", (fts,)).fetchone() is None
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({columns}, {tokenize});")
+        enqueue = f"INSERT OR IGNORE INTO search_pending (tbl, row_id) VALUES ('{table}', new.id);"
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{fts}_ins AFTER INSERT ON {table} BEGIN {enqueue} END;")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_{fts}_upd AFTER UPDATE OF {', '.join(col for col, _ in sources)}
+            ON {table} BEGIN {enqueue} END;""")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_{fts}_del AFTER DELETE ON {table} BEGIN
+            DELETE FROM {fts} WHERE rowid = old.id; END;""")
+        if is_new:
+            conn.execute(f"INSERT OR IGNORE INTO search_pending (tbl, row_id) SELECT '{table}', id FROM {table};")
+    index_pending_search(conn)
+
+def index_pending_search(conn: sqlite3.Connection) -> int:
+    """ردیف‌های صف search_pending را با متن یکسان‌شده در FTS بازنویسی و صف را خالی می‌کند (داخل همان تراکنش)."""
+    total = 0
+    for (table,) in conn.execute("SELECT DISTINCT tbl FROM search_pending;").fetchall():
+        fts, columns, sources = SEARCH_INDEX[table]
+        conn.execute(f"DELETE FROM {fts} WHERE rowid IN (SELECT row_id FROM search_pending WHERE tbl = ?);", (table,))
+        cur = conn.execute(f"""SELECT t.id, {', '.join(f't.{col}' for col, _ in sources)}
+            FROM search_pending q JOIN {table} t ON t.id = q.row_id WHERE q.tbl = ?;""", (table,))
+        insert = f"INSERT INTO {fts}(rowid, {columns}) VALUES ({', '.join('?' * (len(sources) + 1))});"
+        while rows := cur.fetchmany(5000):
+            conn.executemany(insert, [(r[0], *(norm(v) for (_, norm), v in zip(sources, r[1:]))) for r in rows])
+            total += len(rows)
+        conn.execute("DELETE FROM search_pending WHERE tbl = ?;", (table,))
+    return total
+
+# --- لاگ تغییرات (برای همگام‌سازی افزایشی فرانت) ---
+# هر درج/ویرایش/حذف در جدول‌های SYNC_TABLES با trigger یک ردیف در change_log می‌گذارد؛ برای هر ردیف فقط
+# آخرین تغییر نگه داشته می‌شود تا اندازه لاگ به تعداد ردیف‌های تغییرکرده محدود بماند. تغییر user_activity
+# (تماس/پیگیری جدید) هم تغییر ردیف مخاطب حساب می‌شود چون ستون‌های آن در لیست مخاطبین نمایش داده می‌شوند.
+SYNC_TABLES = ("companies", "users", "calls", "followups", "orders", "products")
+CHANGE_LOG_RETENTION_DAYS = float(os.environ.get("CRM_CHANGE_LOG_RETENTION_DAYS", "30"))
+
+def _create_change_log(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT NOT NULL, row_id INTEGER NOT NULL,
+            op TEXT NOT NULL CHECK(op IN ('upsert','delete')),
+            changed_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log(tbl, row_id);")
+    # epoch با هر بازیابی دیتابیس عوض می‌شود تا cursorهای قدیمی کلاینت‌ها به بارگذاری کامل برگردند
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            id INTEGER PRIMARY KEY CHECK(id = 1), epoch TEXT NOT NULL, pruned_seq INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    conn.execute("INSERT OR IGNORE INTO sync_state (id, epoch) VALUES (1, ?);", (uuid.uuid4().hex[:12],))
+    log = lambda table, row, op: (f"DELETE FROM change_log WHERE tbl='{table}' AND row_id={row};"
+                                  f" INSERT INTO change_log (tbl, row_id, op) VALUES ('{table}', {row}, '{op}');")
+    for table in SYNC_TABLES:
+        if not _column_exists(conn, table, "updated_at"):
+            # ALTER TABLE پیش‌فرض CURRENT_TIMESTAMP نمی‌پذیرد؛ برای ردیف‌های جدید trigger مقدار را پر می‌کند
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN updated_at TEXT;")
+            conn.execute(f"UPDATE {table} SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP);")
+        triggers = {
+            f"trg_{table}_updated_at_ins": f"""AFTER INSERT ON {table} WHEN new.updated_at IS NULL BEGIN
+                UPDATE {table} SET updated_at = CURRENT_TIMESTAMP WHERE id = new.id; END""",
+            f"trg_{table}_sync_ins": f"""AFTER INSERT ON {table} BEGIN
+                INSERT INTO change_log (tbl, row_id, op) VALUES ('{table}', new.id, 'upsert'); END""",
+            # old.updated_at IS NULL فقط همان پر کردن بالا است؛ recursive_triggers خاموش است پس UPDATE داخلی دوباره این trigger را اجرا نمی‌کند
+            f"trg_{table}_sync_upd": f"""AFTER UPDATE ON {table} WHEN old.updated_at IS NOT NULL BEGIN
+                UPDATE {table} SET updated_at = CURRENT_TIMESTAMP WHERE id = new.id AND new.updated_at IS old.updated_at;
+                {log(table, 'new.id', 'upsert')} END""",
+            f"trg_{table}_sync_del": f"AFTER DELETE ON {table} BEGIN {log(table, 'old.id', 'delete')} END",
+        }
+        for name, body in triggers.items():
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body};")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_user_activity_sync AFTER INSERT ON user_activity BEGIN
+        {log('users', 'new.user_id', 'upsert')} END;""")
+
+# نسخه جدول‌های مرجع (لیست‌های کشویی فرم‌ها) که با هر تغییر ستون‌های نمایش‌داده‌شده یک واحد بالا می‌رود؛
+# ETag این لیست‌ها از همین نسخه‌ها ساخته می‌شود و چون در دیتابیس است بین workerها یکسان است.
+VERSIONED_TABLES = {"products": "category, name, unit_price", "app_users": "username, role",
+                    "companies": "name", "users": "full_name, company_id, owner_id"}
+
+def _create_table_versions(conn: sqlite3.Connection):
+    conn.execute("CREATE TABLE IF NOT EXISTS table_versions (tbl TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0);")
+    for table, watched in VERSIONED_TABLES.items():
+        conn.execute("INSERT OR IGNORE INTO table_versions (tbl) VALUES (?);", (table,))
+        bump = f"UPDATE table_versions SET version = version + 1 WHERE tbl = '{table}';"
+        for name, event in (("ins", "INSERT"), ("upd", f"UPDATE OF {watched}"), ("del", "DELETE")):
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{name} AFTER {event} ON {table} BEGIN {bump} END;")
+
+# --- تقویم (calendar_days) ---
+# یک ردیف برای هر روز میلادی با معادل شمسی، شنبه همان هفته و ماه مالی؛ گزارش‌ها به‌جای تبدیل هر ردیف در پایتون
+# با یک JOIN روی کلید day دوره شمسی/هفتگی/مالی را می‌گیرند. با تغییر بازه یا ماه شروع سال مالی دوباره ساخته می‌شود.
+CALENDAR_FIRST_DAY, CALENDAR_LAST_DAY = date(2000, 1, 1), date(2060, 12, 31)
+FISCAL_YEAR_START_MONTH = int(os.environ.get("CRM_FISCAL_YEAR_START_MONTH", "1"))  # ماه شمسی (۱ = فروردین)
+
+def fiscal_period(jy: int, jm: int) -> Tuple[int, int]:
+    """(سال مالی، ماه مالی) برای یک ماه شمسی؛ سال مالی با سال شمسی‌ای که در آن شروع شده نام‌گذاری می‌شود."""
+    return (jy if jm >= FISCAL_YEAR_START_MONTH else jy - 1), (jm - FISCAL_YEAR_START_MONTH) % 12 + 1
+
+def _calendar_row(d: date) -> tuple:
+    jy, jm, jd = gregorian_to_jalali(d.year, d.month, d.day)
+    fy, fm = fiscal_period(jy, jm)
+    weekday = (d.weekday() + 2) % 7  # شنبه = ۰
+    return (d.isoformat(), f"{jy:04d}/{jm:02d}/{jd:02d}", jy, jm, jd, f"{jy:04d}/{jm:02d}",
+            (d - timedelta(days=weekday)).isoformat(), weekday, fy, f"{fy:04d}/{fm:02d}")
+
+def _create_calendar(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS calendar_days (
+            day TEXT PRIMARY KEY, jalali TEXT NOT NULL, jy INTEGER NOT NULL, jm INTEGER NOT NULL, jd INTEGER NOT NULL,
+            jalali_month TEXT NOT NULL, week_start TEXT NOT NULL, weekday INTEGER NOT NULL,
+            fiscal_year INTEGER NOT NULL, fiscal_month TEXT NOT NULL
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_calendar_jalali ON calendar_days(jalali);")
+    n_days = (CALENDAR_LAST_DAY - CALENDAR_FIRST_DAY).days + 1
+    expected = (n_days, CALENDAR_FIRST_DAY.isoformat(), CALENDAR_LAST_DAY.isoformat(), _calendar_row(CALENDAR_FIRST_DAY)[-1])
+    current = conn.execute("""SELECT COUNT(*), MIN(day), MAX(day),
+        (SELECT fiscal_month FROM calendar_days WHERE day = ?) FROM calendar_days;""", (CALENDAR_FIRST_DAY.isoformat(),)).fetchone()
+    if tuple(current) != expected:
+        conn.execute("DELETE FROM calendar_days;")
+        conn.executemany("INSERT INTO calendar_days VALUES (?,?,?,?,?,?,?,?,?,?);",
+                         (_calendar_row(CALENDAR_FIRST_DAY + timedelta(days=i)) for i in range(n_days)))
+
+# --- جدول‌های تجمیعی گزارش‌ها (rollup) ---
+# هر درج/ویرایش/حذف سفارش، تماس یا مخاطب با trigger فقط ردیف دوره/کلید خودش را در این جدول‌ها کم و زیاد
+# می‌کند (ویرایش = حذف مقدار قدیم + افزودن مقدار جدید)، تا گزارش‌های /api/analytics به‌جای اسکن orders و calls
+# ردیف‌های تجمیعی را جمع بزنند. فروش در سه دانه روزانه، ماه شمسی و کل دوره نگه داشته می‌شود چون تعداد سفارش هر
+# محصول/شرکت در یک روز معمولاً یکی است و فقط دانه‌های درشت‌تر واقعاً فشرده‌اند. مالک سفارش همان مالک فعلی مخاطب
+# آن است (dim='owner') و با تغییر مالک مخاطب جابه‌جا می‌شود. شرکت و مالک از خود سفارش (مبلغ کل) و محصول و دسته
+# از اقلام سفارش (تعداد × قیمت واحد) می‌آیند؛ orders در این دو بُعد تعداد اقلام است و API آن را lines می‌نامد.
+ANALYTICS_ROLLUP_TABLES = ("sales_rollup", "call_rollup", "contact_rollup")
+SALES_DIMENSIONS = ("product", "category", "company", "owner")
+SALES_GRAINS = ("day", "jalali_month", "total")
+_ORDER_OWNER_SQL = "COALESCE((SELECT u.owner_id FROM users u WHERE u.id = o.user_id), 0)"
+# ماه شمسی از جدول تقویم خوانده می‌شود تا triggerها به تابع ثبت‌شده در app وابسته نباشند و نوشتن روی orders از
+# اتصال‌های بیرون از app هم کار کند؛ تاریخ بیرون از بازه تقویم در دانه ماهانه bucket خالی می‌گیرد.
+_ORDER_MONTH_SQL = "COALESCE((SELECT cal.jalali_month FROM calendar_days cal WHERE cal.day = substr(o.order_date, 1, 10)), '')"
+_ROLLUP_SPECS = {
+    # نام: (جدول rollup، جدول مبدأ، alias، ستون‌هایی که ویرایششان rollup را عوض می‌کند، INSERT ... ON CONFLICT)
+    "sales_rollup": ("sales_rollup", "orders", "o", ("order_date", "status", "user_id", "company_id", "total_amount"), """
+        INSERT INTO sales_rollup (grain, dim, bucket, status, key, orders, revenue)
+        SELECT g.grain, d.dim,
+            CASE g.grain WHEN 'day' THEN substr(o.order_date, 1, 10) WHEN 'jalali_month' THEN {month}
+                ELSE '' END, o.status,
+            CASE d.dim WHEN 'company' THEN COALESCE(o.company_id, 0) ELSE {owner} END,
+            {sign}COUNT(*), {sign}TOTAL(o.total_amount)
+        FROM {source}, (SELECT 'company' AS dim UNION ALL SELECT 'owner') d,
+             (SELECT 'day' AS grain UNION ALL SELECT 'jalali_month' UNION ALL SELECT 'total') g
+        WHERE {where} GROUP BY 1, 2, 3, 4, 5
+        ON CONFLICT(grain, dim, bucket, status, key) DO UPDATE
+            SET orders = orders + excluded.orders, revenue = revenue + excluded.revenue;"""),
+    "sales_rollup_items": ("sales_rollup", "order_items", "i", ("order_id", "product_id", "quantity", "unit_price"), """
+        INSERT INTO sales_rollup (grain, dim, bucket, status, key, orders, revenue)
+        SELECT g.grain, d.dim,
+            CASE g.grain WHEN 'day' THEN substr(o.order_date, 1, 10) WHEN 'jalali_month' THEN {month}
+                ELSE '' END, o.status,
+            CASE d.dim WHEN 'product' THEN COALESCE(i.product_id, 0)
+                ELSE COALESCE((SELECT p.category FROM products p WHERE p.id = i.product_id), '') END,
+            {sign}COUNT(*), {sign}TOTAL(i.quantity * i.unit_price)
+        FROM {source} JOIN {order} ON o.id = i.order_id, (SELECT 'product' AS dim UNION ALL SELECT 'category') d,
+             (SELECT 'day' AS grain UNION ALL SELECT 'jalali_month' UNION ALL SELECT 'total') g
+        WHERE {where} GROUP BY 1, 2, 3, 4, 5
+        ON CONFLICT(grain, dim, bucket, status, key) DO UPDATE
+            SET orders = orders + excluded.orders, revenue = revenue + excluded.revenue;"""),
+    "call_rollup": ("call_rollup", "calls", "c", ("call_datetime", "status", "created_by"), """
+        INSERT INTO call_rollup (day, agent_id, status, calls)
+        SELECT substr(c.call_datetime, 1, 10), COALESCE(c.created_by, 0), c.status, {sign}COUNT(*)
+        FROM {source} WHERE {where} GROUP BY 1, 2, 3
+        ON CONFLICT(day, agent_id, status) DO UPDATE SET calls = calls + excluded.calls;"""),
+    "contact_rollup": ("contact_rollup", "users", "u", ("created_at", "status", "owner_id"), """
+        INSERT INTO contact_rollup (day, owner_id, status, contacts)
+        SELECT COALESCE(substr(u.created_at, 1, 10), ''), COALESCE(u.owner_id, 0), u.status, {sign}COUNT(*)
+        FROM {source} WHERE {where} GROUP BY 1, 2, 3
+        ON CONFLICT(day, owner_id, status) DO UPDATE SET contacts = contacts + excluded.contacts;"""),
+}
+
+def _rollup_sql(name: str, ref: Optional[str] = None, sign: str = "", where: str = "1", owner: str = _ORDER_OWNER_SQL,
+                order: str = "orders o") -> str:
+    """ref=new/old: فقط ردیف trigger؛ بدون ref: کل جدول مبدأ (ساخت دوباره). order: سفارشی که اقلام به آن وصل‌اند."""
+    _, table, alias, cols, upsert = _ROLLUP_SPECS[name]
+    source = f"(SELECT {', '.join(f'{ref}.{col} AS {col}' for col in cols)}) {alias}" if ref else f"{table} {alias}"
+    return upsert.format(source=source, sign=sign, where=where, owner=owner, order=order, month=_ORDER_MONTH_SQL)
+
+def _create_analytics_rollups(conn: sqlite3.Connection):
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sales_rollup (
+            grain TEXT NOT NULL, dim TEXT NOT NULL, bucket TEXT NOT NULL, status TEXT NOT NULL, key NOT NULL,
+            orders INTEGER NOT NULL DEFAULT 0, revenue REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (grain, dim, bucket, status, key)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS call_rollup (
+            day TEXT NOT NULL, agent_id INTEGER NOT NULL, status TEXT NOT NULL, calls INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, agent_id, status)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS contact_rollup (
+            day TEXT NOT NULL, owner_id INTEGER NOT NULL, status TEXT NOT NULL, contacts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, owner_id, status)
+        ) WITHOUT ROWID;
+    """)
+    # triggerهای نسخه قبل ماه شمسی را با تابع jalali_month ثبت‌شده در app حساب می‌کردند
+    _drop_triggers_calling(conn, "jalali_month")
+    for name, (rollup, table, _, cols, _) in _ROLLUP_SPECS.items():
+        triggers = {
+            f"trg_{name}_ins": f"AFTER INSERT ON {table} BEGIN {_rollup_sql(name, 'new')} END",
+            f"trg_{name}_del": f"AFTER DELETE ON {table} BEGIN {_rollup_sql(name, 'old', '-')} END",
+            f"trg_{name}_upd": f"AFTER UPDATE OF {', '.join(cols)} ON {table} BEGIN "
+                               f"{_rollup_sql(name, 'old', '-')} {_rollup_sql(name, 'new')} END",
+        }
+        for trigger, body in triggers.items():
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger} {body};")
+        if rollup not in existing:
+            conn.execute(_rollup_sql(name))
+    # تغییر مالک مخاطب، سفارش‌های او را از مالک قبلی به مالک جدید می‌برد. حذف مخاطب/محصول با ON DELETE SET NULL
+    # سفارش را ویرایش می‌کند ولی در آن لحظه ردیف والد دیگر پیدا نمی‌شود، پس سهمش پیش از حذف به «بدون مالک/دسته» منتقل می‌شود.
+    move_orders = lambda ref, owner, sign: _rollup_sql("sales_rollup", sign=sign, owner=owner,
+                                                       where=f"o.user_id = {ref}.id AND d.dim = 'owner'")
+    # اقلام سفارش با تاریخ/وضعیت خود سفارش در rollup نشسته‌اند و با ویرایش آن جابه‌جا می‌شوند
+    move_items = lambda ref, sign: _rollup_sql("sales_rollup_items", sign=sign, where=f"i.order_id = {ref}.id",
+                                               order=f"(SELECT {ref}.id AS id, {ref}.order_date AS order_date, {ref}.status AS status) o")
+    # ردیف‌های dim='product' هر محصول دقیقاً سهم آن از دسته‌اش است
+    move_category = lambda ref, category, sign: f"""
+        INSERT INTO sales_rollup (grain, dim, bucket, status, key, orders, revenue)
+        SELECT grain, 'category', bucket, status, COALESCE({category}, ''), {sign}orders, {sign}revenue
+        FROM sales_rollup WHERE dim = 'product' AND key = {ref}.id
+        ON CONFLICT(grain, dim, bucket, status, key) DO UPDATE
+            SET orders = orders + excluded.orders, revenue = revenue + excluded.revenue;"""
+    triggers = {
+        "trg_sales_rollup_owner": ("AFTER UPDATE OF owner_id ON users WHEN old.owner_id IS NOT new.owner_id"
+                                   " AND EXISTS (SELECT 1 FROM orders o WHERE o.user_id = new.id)",
+                                   move_orders("new", "COALESCE(old.owner_id, 0)", "-") + move_orders("new", "COALESCE(new.owner_id, 0)", "")),
+        "trg_sales_rollup_user_del": ("BEFORE DELETE ON users WHEN EXISTS (SELECT 1 FROM orders o WHERE o.user_id = old.id)",
+                                      move_orders("old", "COALESCE(old.owner_id, 0)", "-") + move_orders("old", "0", "")),
+        "trg_sales_rollup_order_items": ("AFTER UPDATE OF order_date, status ON orders"
+                                         " WHEN old.order_date IS NOT new.order_date OR old.status IS NOT new.status",
+                                         move_items("old", "-") + move_items("new", "")),
+        # حذف آبشاری اقلام پس از حذف سفارش اجرا می‌شود و تاریخ/وضعیت آن دیگر در دسترس نیست؛ اقلام پیش از آن حذف می‌شوند
+        "trg_sales_rollup_order_del": ("BEFORE DELETE ON orders", "DELETE FROM order_items WHERE order_id = old.id;"),
+        "trg_sales_rollup_category": ("AFTER UPDATE OF category ON products WHEN old.category IS NOT new.category",
+                                      move_category("new", "old.category", "-") + move_category("new", "new.category", "")),
+        "trg_sales_rollup_product_del": ("BEFORE DELETE ON products",
+                                         move_category("old", "old.category", "-") + move_category("old", "''", "")),
+    }
+    for trigger, (event, body) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger} {event} BEGIN {body} END;")
+
+def rotate_sync_epoch():
+    with write_conn() as conn:
+        conn.execute("UPDATE sync_state SET epoch = ? WHERE id = 1;", (uuid.uuid4().hex[:12],))
+
+def prune_change_log() -> int:
+    """تغییرات قدیمی‌تر از CHANGE_LOG_RETENTION_DAYS را حذف می‌کند؛ cursorهای قبل از آن‌ها reset می‌گیرند."""
+    cutoff = (datetime.utcnow() - timedelta(days=CHANGE_LOG_RETENTION_DAYS)).strftime(DB_DATETIME_FMT)
+    with write_conn() as conn:
+        last = conn.execute("SELECT MAX(seq) FROM change_log WHERE changed_at < ?;", (cutoff,)).fetchone()[0]
+        if last is None: return 0
+        deleted = conn.execute("DELETE FROM change_log WHERE seq <= ?;", (last,)).rowcount
+        conn.execute("UPDATE sync_state SET pruned_seq = MAX(pruned_seq, ?) WHERE id = 1;", (last,))
+    return deleted
+
+def search_all(q: str, limit: int, enforce_owner: Optional[int]) -> List[Dict[str, Any]]:
+    """جستجوی ترکیبی مخاطبین و شرکت‌ها، مرتب بر اساس bm25 (عدد کمتر = مرتبط‌تر)."""
+    match = fts_match_query(q)
+    if not match: return []
+    conn = get_conn()
+    user_owner_sql, company_owner_sql, owner_params = "", "", []
+    if enforce_owner:
+        user_owner_sql = "AND u.owner_id = ?"
+        company_owner_sql = "AND EXISTS (SELECT 1 FROM users u WHERE u.company_id=c.id AND u.owner_id=?)"
+        owner_params = [enforce_owner]
+    users = conn.execute(f"""
+        SELECT 'user' AS type, u.id AS id, u.full_name AS title,
+               TRIM(COALESCE(u.phone,'') || ' ' || COALESCE(c.name,'')) AS subtitle,
+               bm25(users_fts, 10.0, 6.0, 1.0, 1.0, 0.5) AS rank
+        FROM users_fts JOIN users u ON u.id = users_fts.rowid
+        LEFT JOIN companies c ON c.id = u.company_id
+        WHERE users_fts MATCH ? {user_owner_sql}
+        ORDER BY rank LIMIT ?;
+    """, [match, *owner_params, limit]).fetchall()
+    companies = conn.execute(f"""
+        SELECT 'company' AS type, c.id AS id, c.name AS title, COALESCE(c.phone,'') AS subtitle,
+               bm25(companies_fts, 10.0, 6.0, 1.0) AS rank
+        FROM companies_fts JOIN companies c ON c.id = companies_fts.rowid
+        WHERE companies_fts MATCH ? {company_owner_sql}
+        ORDER BY rank LIMIT ?;
+    """, [match, *owner_params, limit]).fetchall()
+    conn.close()
+    results = sorted((dict(r) for r in users + companies), key=lambda r: r["rank"])
+    return results[:limit]
 
 # --- توابع Auth ---
+# توکن ← UserAuthInfo؛ هر worker کش خودش را دارد، پس خروج در یک worker حداکثر تا TTL در بقیه دیده نمی‌شود.
+SESSION_CACHE_TTL = float(os.environ.get("CRM_SESSION_CACHE_TTL", "60"))
+SESSION_CACHE_SIZE = int(os.environ.get("CRM_SESSION_CACHE_SIZE", "10000"))
+session_cache = LRUTTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+
 def create_session(app_user_id: int, days_valid: int = 30) -> str:
     token = uuid.uuid4().hex
     expires = (datetime.utcnow() + timedelta(days=days_valid)).strftime("%Y-%m-%d %H:%M:%S")
-    conn = get_conn()
-    conn.execute("INSERT INTO sessions (token, app_user_id, expires_at) VALUES (?,?,?);",
-                 (token, app_user_id, expires))
-    conn.commit(); conn.close()
+    with write_conn("sessions") as conn:
+        conn.execute("INSERT INTO sessions (token, app_user_id, expires_at) VALUES (?,?,?);",
+                     (token, app_user_id, expires))
     return token
 
 def get_session_user(token: str) -> Optional[UserAuthInfo]:
+    """سشن را از دیتابیس می‌خواند و نتیجه را در session_cache می‌گذارد (نه بیشتر از زمان انقضای خود سشن)."""
     if not token: return None
     conn = get_conn()
     row = conn.execute("""
-        SELECT au.id, au.username, au.role, au.linked_user_id
+        SELECT au.id, au.username, au.role, au.linked_user_id, s.expires_at
         FROM sessions s
         JOIN app_users au ON au.id = s.app_user_id
         WHERE s.token=? AND (s.expires_at IS NULL OR s.expires_at >= datetime('now'));
     """, (token,)).fetchone()
     conn.close()
     if not row: return None
-    return UserAuthInfo(**row)
+    info = UserAuthInfo(id=row["id"], username=row["username"], role=row["role"], linked_user_id=row["linked_user_id"])
+    ttl = None
+    if row["expires_at"]:
+        try:
+            ttl = (datetime.strptime(row["expires_at"], "%Y-%m-%d %H:%M:%S") - datetime.utcnow()).total_seconds()
+        except ValueError:
+            ttl = 0
+    session_cache.set(token, info, ttl)
+    return info
+
+# تیکت استریم رویدادها: EventSource مرورگر نمی‌تواند هدر Authorization بفرستد و توکن سشن در query string در لاگ
+# دسترسی uvicorn/پراکسی می‌ماند؛ به‌جای آن تیکتی کوتاه‌عمر و یک‌بار مصرف در URL می‌آید که به سشن صادرکننده وابسته است
+# (با خروج یا حذف سشن باطل می‌شود).
+STREAM_TICKET_TTL = int(os.environ.get("CRM_STREAM_TICKET_TTL", "30"))  # ثانیه
+
+def create_stream_ticket(session_token: str) -> str:
+    ticket = uuid.uuid4().hex
+    now = datetime.utcnow()
+    with write_conn() as conn:
+        conn.execute("DELETE FROM stream_tickets WHERE expires_at < ?;", (now.strftime(DB_DATETIME_FMT),))
+        conn.execute("INSERT INTO stream_tickets (ticket, session_token, expires_at) VALUES (?,?,?);",
+                     (ticket, session_token, (now + timedelta(seconds=STREAM_TICKET_TTL)).strftime(DB_DATETIME_FMT)))
+    return ticket
+
+def consume_stream_ticket(ticket: str) -> Optional[UserAuthInfo]:
+    """تیکت را حذف (مصرف) و کاربر سشن صادرکننده را برمی‌گرداند؛ تیکت ناموجود/منقضی None می‌دهد."""
+    if not ticket: return None
+    with write_conn() as conn:
+        rows = conn.execute("DELETE FROM stream_tickets WHERE ticket=? RETURNING session_token, expires_at;", (ticket,)).fetchall()
+    if not rows or rows[0][1] < datetime.utcnow().strftime(DB_DATETIME_FMT): return None
+    return get_session_user(rows[0][0])
+
+def invalidate_app_user_sessions(app_user_id: int):
+    session_cache.remove_where(lambda _token, info: info.id == app_user_id)
 
 def delete_session(token: str):
     if not token: return
-    conn = get_conn()
-    conn.execute("DELETE FROM sessions WHERE token=?;", (token,))
-    conn.commit(); conn.close()
+    session_cache.pop(token)
+    with write_conn("sessions") as conn:
+        conn.execute("DELETE FROM sessions WHERE token=?;", (token,))
+
+# --- هش رمز عبور (scrypt) ---
+# رمزها با scrypt و salt تصادفی به شکل "scrypt$N$r$p$salt$hash" ذخیره می‌شوند (ستون هنوز password_sha256 نام دارد).
+# هش‌های قدیمی sha256 بدون salt در اولین ورود موفق با هش جدید جایگزین می‌شوند؛ همین‌طور هشی که با N/r/p کمتر
+# از تنظیم فعلی ساخته شده. هر بررسی ده‌ها میلی‌ثانیه CPU است، پس در استخر جداگانه و محدود password_executor اجرا
+# می‌شود تا نه event loop و نه کارگرهای دیتابیس را نگه دارد؛ وقتی صف آن پر است ورود با 503 رد می‌شود.
+PASSWORD_SCRYPT_N = int(os.environ.get("CRM_PASSWORD_SCRYPT_N", str(2 ** 14)))
+PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P = 8, 1
+PASSWORD_HASH_WORKERS = int(os.environ.get("CRM_PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE = int(os.environ.get("CRM_PASSWORD_HASH_QUEUE", "64"))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="crm-password")
+_password_pending = 0
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int, dklen: int = 32) -> bytes:
+    # hashlib.scrypt در طول محاسبه GIL را آزاد می‌کند
+    return hashlib.scrypt((password or "").encode("utf-8"), salt=salt, n=n, r=r, p=p, dklen=dklen, maxmem=256 * n * r)
+
+def hash_password(password: str) -> str:
+    salt = os.urandom(16)
+    digest = _scrypt(password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    b64 = lambda b: base64.b64encode(b).decode("ascii")
+    return f"scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}${b64(salt)}${b64(digest)}"
+
+def verify_password(password: str, stored: str) -> Tuple[bool, bool]:
+    """(رمز درست است، هش باید با تنظیم فعلی دوباره ساخته شود)."""
+    if not (stored or "").startswith("scrypt$"):
+        ok = hmac.compare_digest(sha256(password), stored or "")
+        return ok, ok
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        n, r, p, salt, digest = int(n), int(r), int(p), base64.b64decode(salt), base64.b64decode(digest)
+    except ValueError:
+        return False, False
+    ok = hmac.compare_digest(_scrypt(password, salt, n, r, p, len(digest)), digest)
+    return ok, ok and (n, r, p) < (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+
+@functools.lru_cache(maxsize=1)
+def _dummy_password_hash() -> str:
+    return hash_password(uuid.uuid4().hex)
+
+async def run_password_hash(fn, *args, **kwargs):
+    """مثل run_db ولی روی password_executor و با سقف PASSWORD_HASH_QUEUE کار در انتظار."""
+    global _password_pending
+    if _password_pending >= PASSWORD_HASH_QUEUE:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="سرور مشغول است؛ کمی بعد دوباره تلاش کنید",
+                            headers={"Retry-After": "1"})
+    _password_pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, functools.partial(fn, *args, **kwargs))
+    finally:
+        _password_pending -= 1
 
 def auth_check(username: str, password: str):
     conn = get_conn()
     row = conn.execute("SELECT id, username, password_sha256, role, linked_user_id FROM app_users WHERE username=?;",
                        ((username or "").strip(),)).fetchone()
     conn.close()
-    if not row: return None
+    if not row:
+        # نام کاربری ناموجود هم همان زمان بررسی را می‌گیرد تا از زمان پاسخ معلوم نشود کدام نام‌ها وجود دارند
+        verify_password(password, _dummy_password_hash())
+        return None
     uid, uname, pwh, role, linked_user_id = row
-    return {"id": uid, "username": uname, "role": role, "linked_user_id": linked_user_id} if sha256(password) == pwh else None
+    ok, needs_rehash = verify_password(password, pwh)
+    if not ok: return None
+    if needs_rehash:
+        new_hash = hash_password(password)
+        with write_conn("app_users") as conn:
+            conn.execute("UPDATE app_users SET password_sha256 = ? WHERE id = ? AND password_sha256 = ?;", (new_hash, uid, pwh))
+    return {"id": uid, "username": uname, "role": role, "linked_user_id": linked_user_id}
 
 # --- توابع CRUD ---
-def list_companies(_: Optional[int]) -> List[Tuple[int, str]]:
+def list_companies(_: Optional[int]) -> List[Dict]:
     conn = get_conn()
     rows = conn.execute("SELECT id, name FROM companies ORDER BY name COLLATE NOCASE;").fetchall()
-    conn.close(); return [tuple(r) for r in rows]
+    conn.close(); return [dict(r) for r in rows]
 
 def list_sales_accounts_including_admins() -> List[Dict]:
     conn = get_conn()
     rows = conn.execute("SELECT id, username, role FROM app_users WHERE role IN ('agent','admin') ORDER BY role DESC, username;").fetchall()
     conn.close(); return [dict(r) for r in rows]
 
-def list_users_basic(only_owner_appuser: Optional[int]) -> List[Tuple[int, str, Optional[int]]]:
+def list_users_basic(only_owner_appuser: Optional[int]) -> List[Dict]:
     conn = get_conn()
     if only_owner_appuser:
         rows = conn.execute(
@@ -367,7 +1478,7 @@ def list_users_basic(only_owner_appuser: Optional[int]) -> List[Tuple[int, str,
         ).fetchall()
     else:
         rows = conn.execute("SELECT id, full_name, company_id FROM users ORDER BY full_name COLLATE NOCASE;").fetchall()
-    conn.close(); return [tuple(r) for r in rows]
+    conn.close(); return [dict(r) for r in rows]
 
 def phone_exists(phone: str, ignore_user_id: Optional[int] = None) -> bool:
     ph = (phone or "").strip()
@@ -380,20 +1491,19 @@ def phone_exists(phone: str, ignore_user_id: Optional[int] = None) -> bool:
     conn.close(); return row is not None
 
 def create_company(company_data: CompanyCreate, creator_id: int):
-    conn = get_conn()
-    conn.execute(
-        "INSERT INTO companies (name, phone, address, note, level, status, created_by) VALUES (?,?,?,?,?,?,?);",
-        (
-            company_data.name.strip(),
-            (company_data.phone or "").strip(),
-            (company_data.address or "").strip(),
-            (company_data.note or "").strip(),
-            company_data.level,
-            company_data.status,
-            creator_id
+    with write_conn("companies") as conn:
+        conn.execute(
+            "INSERT INTO companies (name, phone, address, note, level, status, created_by) VALUES (?,?,?,?,?,?,?);",
+            (
+                company_data.name.strip(),
+                (company_data.phone or "").strip(),
+                (company_data.address or "").strip(),
+                (company_data.note or "").strip(),
+                company_data.level,
+                company_data.status,
+                creator_id
+            )
         )
-    )
-    conn.commit(); conn.close()
 
 def update_company(company_id: int, company_data: CompanyUpdate):
     fields = company_data.dict(exclude_unset=True)
@@ -403,9 +1513,9 @@ def update_company(company_id: int, company_data: CompanyUpdate):
     if not sets:
         return True, "بدون تغییر"
     params.append(company_id)
-    conn = get_conn()
-    conn.execute(f"UPDATE companies SET {', '.join(sets)} WHERE id=?;", params)
-    conn.commit(); conn.close(); return True, "ذخیره شد."
+    with write_conn("companies") as conn:
+        conn.execute(f"UPDATE companies SET {', '.join(sets)} WHERE id=?;", params)
+    return True, "ذخیره شد."
 
 def create_user(user_data: UserCreate, creator_id: int) -> Tuple[bool, str]:
     if user_data.phone and phone_exists(user_data.phone):
@@ -416,26 +1526,26 @@ def create_user(user_data: UserCreate, creator_id: int) -> Tuple[bool, str]:
     if not (user_data.first_name or "").strip(): 
         return False, "نام اجباری است."
     
-    conn = get_conn()
-    conn.execute("""INSERT INTO users
-        (first_name,last_name,full_name,phone,role,company_id,note,status,domain,province,level,owner_id,created_by)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?);""",
-        (
-            (user_data.first_name or "").strip(),
-            (user_data.last_name or "").strip(),
-            full_name,
-            (user_data.phone or "").strip(),
-            (user_data.role or "").strip(),
-            user_data.company_id,
-            (user_data.note or "").strip(),
-            user_data.status,
-            (user_data.domain or "").strip(),
-            (user_data.province or "").strip(),
-            user_data.level,
-            user_data.owner_id,
-            creator_id
-        ))
-    conn.commit(); conn.close(); return True, "کاربر ثبت شد."
+    with write_conn("users") as conn:
+        conn.execute("""INSERT INTO users
+            (first_name,last_name,full_name,phone,role,company_id,note,status,domain,province,level,owner_id,created_by)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?);""",
+            (
+                (user_data.first_name or "").strip(),
+                (user_data.last_name or "").strip(),
+                full_name,
+                (user_data.phone or "").strip(),
+                (user_data.role or "").strip(),
+                user_data.company_id,
+                (user_data.note or "").strip(),
+                user_data.status,
+                (user_data.domain or "").strip(),
+                (user_data.province or "").strip(),
+                user_data.level,
+                user_data.owner_id,
+                creator_id
+            ))
+    return True, "کاربر ثبت شد."
 
 def update_user(user_id: int, user_data: UserUpdate):
     if user_data.phone and phone_exists(user_data.phone, ignore_user_id=user_id):
@@ -457,59 +1567,163 @@ def update_user(user_id: int, user_data: UserUpdate):
         return True, "بدون تغییر"
     params.append(user_id)
     
-    conn = get_conn()
-    conn.execute(f"UPDATE users SET {', '.join(sets)} WHERE id=?;", params)
-    conn.commit(); conn.close(); return True, "ذخیره شد."
+    with write_conn("users") as conn:
+        conn.execute(f"UPDATE users SET {', '.join(sets)} WHERE id=?;", params)
+    return True, "ذخیره شد."
+
+def _owner_of_user(conn: sqlite3.Connection, user_id: Optional[int]) -> Optional[int]:
+    row = conn.execute("SELECT owner_id FROM users WHERE id=?;", (user_id,)).fetchone()
+    return row[0] if row else None
 
 def update_followup_status(task_id: int, new_status: str):
-    conn = get_conn(); conn.execute("UPDATE followups SET status=? WHERE id=?;", (new_status, task_id))
-    conn.commit(); conn.close()
+    with write_conn("followups") as conn:
+        conn.execute("UPDATE followups SET status=? WHERE id=?;", (new_status, task_id))
+        row = conn.execute("SELECT user_id FROM followups WHERE id=?;", (task_id,)).fetchone()
+        owner = _owner_of_user(conn, row[0]) if row else None
+    if row:
+        event_broker.publish("followups", "updated", [task_id], {owner}, user_id=row[0], status=new_status)
 
 def create_call(call_data: CallCreate, creator_id: int):
-    conn = get_conn()
-    conn.execute("INSERT INTO calls (user_id, call_datetime, status, description, created_by) VALUES (?,?,?,?,?);",
-                (
-                    call_data.user_id,
-                    call_data.call_datetime.isoformat(),
-                    call_data.status,
-                    (call_data.description or "").strip(),
-                    creator_id
-                ))
-    conn.commit(); conn.close()
+    with write_conn("calls") as conn:
+        cur = conn.execute("INSERT INTO calls (user_id, call_datetime, status, description, created_by) VALUES (?,?,?,?,?);",
+                    (
+                        call_data.user_id,
+                        dt_to_db(call_data.call_datetime),
+                        call_data.status,
+                        (call_data.description or "").strip(),
+                        creator_id
+                    ))
+        owner = _owner_of_user(conn, call_data.user_id)
+    event_broker.publish("calls", "created", [cur.lastrowid], {owner}, user_id=call_data.user_id)
 
 def create_followup(fu_data: FollowupCreate, creator_id: int):
-    conn = get_conn()
-    conn.execute("INSERT INTO followups (user_id, title, details, due_date, status, created_by) VALUES (?,?,?,?,?,?);",
-                (
-                    fu_data.user_id,
-                    (fu_data.title or "").strip(),
-                    (fu_data.details or "").strip(),
-                    fu_data.due_date.isoformat(),
-                    fu_data.status,
-                    creator_id
-                ))
-    conn.commit(); conn.close()
+    with write_conn("followups") as conn:
+        cur = conn.execute("INSERT INTO followups (user_id, title, details, due_date, status, created_by) VALUES (?,?,?,?,?,?);",
+                    (
+                        fu_data.user_id,
+                        (fu_data.title or "").strip(),
+                        (fu_data.details or "").strip(),
+                        dt_to_db(fu_data.due_date),
+                        fu_data.status,
+                        creator_id
+                    ))
+        owner = _owner_of_user(conn, fu_data.user_id)
+    event_broker.publish("followups", "created", [cur.lastrowid], {owner}, user_id=fu_data.user_id)
+
+# --- ثبت گروهی تماس/پیگیری ---
+# کل لیست داخل یک تراکنش نویسنده اعتبارسنجی و با executemany درج می‌شود (یک commit/fsync برای همه).
+# آیتم نامعتبر (مخاطب ناموجود، وضعیت نامعتبر، ...) فقط در نتیجه همان آیتم خطا می‌گیرد و بقیه ثبت می‌شوند.
+def _user_owners(conn: sqlite3.Connection, user_ids) -> Dict[int, Optional[int]]:
+    ids = list(set(user_ids))
+    return dict(conn.execute(f"SELECT id, owner_id FROM users WHERE id IN ({','.join('?' * len(ids))});", ids).fetchall()) if ids else {}
+
+def _bulk_insert(conn: sqlite3.Connection, sql: str, rows: List[tuple]) -> List[int]:
+    """IDهای ردیف‌های درج‌شده به ترتیب؛ نویسنده سریال است و جدول AUTOINCREMENT، پس IDها پشت سر هم‌اند."""
+    if not rows: return []
+    conn.executemany(sql, rows)
+    last = conn.execute("SELECT last_insert_rowid();").fetchone()[0]
+    return list(range(last - len(rows) + 1, last + 1))
+
+def _bulk_result(n_items: int, ids: List[int], errors: Dict[int, str]) -> Dict[str, Any]:
+    """نتیجه هر آیتم به ترتیب ورودی؛ ids فقط برای آیتم‌های بدون خطا و به همان ترتیب است."""
+    it = iter(ids)
+    results = [{"index": i, "error": errors[i]} if i in errors else {"index": i, "id": next(it)} for i in range(n_items)]
+    return {"ok": len(ids), "failed": len(errors), "results": results}
+
+def _publish_by_owner(table: str, op: str, pairs: List[Tuple[int, int]], owners: Dict[int, Optional[int]], **extra):
+    """pairs: (row_id, user_id)؛ برای هر کارشناس یک رویداد با IDهای مخاطبین خودش."""
+    groups: Dict[Optional[int], List[int]] = {}
+    for row_id, user_id in pairs:
+        groups.setdefault(owners.get(user_id), []).append(row_id)
+    for owner, ids in groups.items():
+        event_broker.publish(table, op, ids, {owner}, **extra)
+
+def bulk_create_calls(items: List[CallCreate], creator_id: int) -> Dict[str, Any]:
+    errors: Dict[int, str] = {}
+    rows, user_ids = [], []
+    with write_conn("calls") as conn:
+        owners = _user_owners(conn, (c.user_id for c in items))
+        for i, c in enumerate(items):
+            if c.user_id not in owners: errors[i] = "مخاطب یافت نشد"
+            elif c.status not in CALL_STATUSES: errors[i] = "وضعیت نامعتبر است"
+            else:
+                rows.append((c.user_id, dt_to_db(c.call_datetime), c.status, (c.description or "").strip(), creator_id))
+                user_ids.append(c.user_id)
+        ids = _bulk_insert(conn, "INSERT INTO calls (user_id, call_datetime, status, description, created_by) VALUES (?,?,?,?,?);", rows)
+    _publish_by_owner("calls", "created", list(zip(ids, user_ids)), owners)
+    return _bulk_result(len(items), ids, errors)
+
+def bulk_create_followups(items: List[FollowupCreate], creator_id: int) -> Dict[str, Any]:
+    errors: Dict[int, str] = {}
+    rows, user_ids = [], []
+    with write_conn("followups") as conn:
+        owners = _user_owners(conn, (f.user_id for f in items))
+        for i, f in enumerate(items):
+            title = (f.title or "").strip()
+            if f.user_id not in owners: errors[i] = "مخاطب یافت نشد"
+            elif not title: errors[i] = "عنوان پیگیری خالی است"
+            elif f.status not in TASK_STATUSES: errors[i] = "وضعیت نامعتبر است"
+            else:
+                rows.append((f.user_id, title, (f.details or "").strip(), dt_to_db(f.due_date), f.status, creator_id))
+                user_ids.append(f.user_id)
+        ids = _bulk_insert(conn, "INSERT INTO followups (user_id, title, details, due_date, status, created_by) VALUES (?,?,?,?,?,?);", rows)
+    _publish_by_owner("followups", "created", list(zip(ids, user_ids)), owners)
+    return _bulk_result(len(items), ids, errors)
+
+def bulk_update_followups_status(items: List[FollowupStatusItem]) -> Dict[str, Any]:
+    errors: Dict[int, str] = {}
+    rows, pairs = [], []
+    with write_conn("followups") as conn:
+        task_ids = list({f.id for f in items})
+        task_users = dict(conn.execute(f"SELECT id, user_id FROM followups WHERE id IN ({','.join('?' * len(task_ids))});",
+                                       task_ids).fetchall())
+        for i, f in enumerate(items):
+            if f.id not in task_users: errors[i] = "پیگیری یافت نشد"
+            elif f.status not in TASK_STATUSES: errors[i] = "وضعیت نامعتبر است"
+            else:
+                rows.append((f.status, f.id))
+                pairs.append((f.id, task_users[f.id]))
+        if rows:
+            conn.executemany("UPDATE followups SET status=? WHERE id=?;", rows)
+        owners = _user_owners(conn, (u for _, u in pairs))
+    _publish_by_owner("followups", "updated", pairs, owners)
+    return _bulk_result(len(items), [task_id for task_id, _ in pairs], errors)
+
+BULK_OWNER_CHUNK = 500
+BULK_OWNER_JOB_THRESHOLD = int(os.environ.get("CRM_BULK_OWNER_JOB_THRESHOLD", "2000"))
 
 def bulk_update_users_owner(user_ids: List[int], new_owner_id: Optional[int], current_user: UserAuthInfo) -> int:
     """owner_id را برای لیست user_ids به‌صورت گروهی تغییر می‌دهد."""
     if not user_ids: return 0
     
-    conn = get_conn()
     placeholders = ",".join(["?"] * len(user_ids))
     
-    params: List = [new_owner_id] # 1. new_owner_id
-    
-    sql_query = f"UPDATE users SET owner_id=? WHERE id IN ({placeholders})"
+    params: List = [int(x) for x in user_ids] # 1. user_ids (به ترتیب placeholderها)
+    where_sql = f"id IN ({placeholders})"
     
     if current_user.role != 'admin':
-        sql_query += " AND owner_id = ?"
+        where_sql += " AND owner_id = ?"
         params.append(current_user.id) # 2. current_user.id (if needed)
-        
-    params.extend([int(x) for x in user_ids]) # 3. user_ids (always last)
     
-    cur = conn.execute(sql_query, params)
-    conn.commit(); conn.close()
-    return cur.rowcount if hasattr(cur, "rowcount") else len(user_ids)
+    with write_conn("users") as conn:
+        # کارشناس‌های قبلی هم باید بدانند مخاطب از لیستشان خارج شده؛ فقط ردیف‌هایی که واقعاً عوض می‌شوند
+        old_owners = {r[0]: r[1] for r in conn.execute(f"SELECT id, owner_id FROM users WHERE {where_sql};", params)}
+        cur = conn.execute(f"UPDATE users SET owner_id=? WHERE {where_sql}", [new_owner_id] + params)
+    affected = cur.rowcount if hasattr(cur, "rowcount") else len(old_owners)
+    changed = {uid: owner for uid, owner in old_owners.items() if owner != new_owner_id}
+    if changed:
+        event_broker.publish("users", "owner_changed", sorted(changed), set(changed.values()) | {new_owner_id},
+                             owner_id=new_owner_id)
+    return affected
+
+def job_bulk_update_owner(job: "JobContext", user_ids: List[int], new_owner_id: Optional[int], current_user: UserAuthInfo) -> Dict[str, Any]:
+    """نسخه پس‌زمینه: هر BULK_OWNER_CHUNK مخاطب در یک تراکنش جدا، تا قفل نویسنده برای درخواست‌های دیگر آزاد شود."""
+    affected = 0
+    for i in range(0, len(user_ids), BULK_OWNER_CHUNK):
+        job.check_cancelled()
+        affected += bulk_update_users_owner(user_ids[i:i + BULK_OWNER_CHUNK], new_owner_id, current_user)
+        job.progress(min(i + BULK_OWNER_CHUNK, len(user_ids)), len(user_ids))
+    return {"message": f"کارشناس فروش {affected} مخاطب تغییر کرد.", "affected": affected}
 
 def get_company_id_by_name(name: str) -> Optional[int]:
     if not (name or "").strip(): return None
@@ -533,70 +1747,225 @@ def get_app_user_id_by_username(username: str) -> Optional[int]:
     conn.close()
     return row[0] if row else None
 
+def create_app_user(data: AppUserCreate):
+    with write_conn("app_users") as conn:
+        conn.execute("INSERT INTO app_users (username,password_sha256,role,linked_user_id) VALUES (?,?,?,?);",
+                     (data.username.strip(), hash_password(data.password), data.role, data.linked_user_id))
+
+def set_app_user_password(app_user_id: int, new_password: str):
+    with write_conn("app_users") as conn:
+        conn.execute("UPDATE app_users SET password_sha256 = ? WHERE id = ?", (hash_password(new_password), app_user_id))
+    invalidate_app_user_sessions(app_user_id)
+
+def remove_app_user(app_user_id: int) -> int:
+    with write_conn("app_users") as conn:
+        cur = conn.execute("DELETE FROM app_users WHERE id = ?", (app_user_id,))
+    invalidate_app_user_sessions(app_user_id)
+    return cur.rowcount
+
 # --- توابع محصولات و سفارشات ---
-def list_products() -> List[Dict]:
+def list_products(ids: Optional[List[int]] = None) -> List[Dict]:
     conn = get_conn()
-    rows = conn.execute("SELECT id, category, name FROM products ORDER BY category, name;").fetchall()
+    where = f"WHERE id IN ({','.join(['?'] * len(ids))})" if ids else ""
+    rows = conn.execute(f"SELECT id, category, name, unit_price FROM products {where} ORDER BY category, name;", ids or []).fetchall()
     conn.close()
     return [dict(r) for r in rows]
 
 def create_product(prod_data: ProductCreate):
-    conn = get_conn()
-    conn.execute("INSERT INTO products (category, name) VALUES (?, ?);", (prod_data.category.strip(), prod_data.name.strip()))
-    conn.commit()
-    conn.close()
+    with write_conn("products") as conn:
+        conn.execute("INSERT INTO products (category, name, unit_price) VALUES (?, ?, ?);",
+                     (prod_data.category.strip(), prod_data.name.strip(), prod_data.unit_price))
 
 def update_product(product_id: int, prod_data: ProductCreate):
-    conn = get_conn()
-    conn.execute("UPDATE products SET category=?, name=? WHERE id=?;", (prod_data.category.strip(), prod_data.name.strip(), product_id))
-    conn.commit()
-    conn.close()
-
-def create_order(order_data: OrderCreate):
-    conn = get_conn()
-    conn.execute("""
-        INSERT INTO orders (user_id, company_id, product_id, order_date, status, total_amount)
-        VALUES (?, ?, ?, ?, ?, ?);
-    """, (
-        order_data.user_id,
-        order_data.company_id,
-        order_data.product_id,
-        order_data.order_date.isoformat(),
-        order_data.status,
-        order_data.total_amount
-    ))
-    conn.commit()
-    conn.close()
+    sets, params = ["category=?", "name=?"], [prod_data.category.strip(), prod_data.name.strip()]
+    # کلاینت‌های قدیمی قیمت نمی‌فرستند؛ قیمت فقط وقتی صریحاً آمده عوض می‌شود
+    if "unit_price" in prod_data.dict(exclude_unset=True):
+        sets.append("unit_price=?"); params.append(prod_data.unit_price)
+    with write_conn("products") as conn:
+        conn.execute(f"UPDATE products SET {', '.join(sets)} WHERE id=?;", params + [product_id])
+
+def _order_lines(conn: sqlite3.Connection, order_data: OrderCreate) -> Tuple[List[Tuple[int, float, float]], str]:
+    """اقلام سفارش به شکل (product_id, quantity, unit_price)؛ قیمت خالی از قیمت فعلی محصول پر می‌شود.
+    شکل قدیمی (product_id و total_amount بدون items) یک قلم با تعداد ۱ است. در صورت خطا ([]، پیام)."""
+    if order_data.items:
+        lines = [(item.product_id, item.quantity, item.unit_price) for item in order_data.items]
+    elif order_data.product_id:
+        lines = [(order_data.product_id, 1, order_data.total_amount)]
+    else:
+        return [], "سفارش باید حداقل یک محصول داشته باشد."
+    ids = sorted({line[0] for line in lines})
+    prices = dict(conn.execute(f"SELECT id, unit_price FROM products WHERE id IN ({','.join('?' * len(ids))});", ids).fetchall())
+    missing = [pid for pid in ids if pid not in prices]
+    if missing:
+        return [], f"محصول با شناسه {missing[0]} یافت نشد."
+    return [(pid, qty, prices[pid] if price is None else price) for pid, qty, price in lines], ""
+
+def _save_order_lines(conn: sqlite3.Connection, order_id: int, lines: List[Tuple[int, float, float]]):
+    conn.execute("DELETE FROM order_items WHERE order_id = ?;", (order_id,))
+    conn.executemany("INSERT INTO order_items (order_id, product_id, quantity, unit_price) VALUES (?, ?, ?, ?);",
+                     [(order_id, *line) for line in lines])
+
+def _order_total(lines: List[Tuple[int, float, float]]) -> float:
+    return round(sum(qty * price for _, qty, price in lines), 2)
+
+def create_order(order_data: OrderCreate) -> Tuple[bool, str]:
+    with write_conn("orders") as conn:
+        lines, error = _order_lines(conn, order_data)
+        if error:
+            return False, error
+        # orders.product_id محصول قلم اول است (برای نمایش در لیست و کلاینت‌های قدیمی)
+        cur = conn.execute("""
+            INSERT INTO orders (user_id, company_id, product_id, order_date, status, total_amount)
+            VALUES (?, ?, ?, ?, ?, ?);
+        """, (
+            order_data.user_id,
+            order_data.company_id,
+            lines[0][0],
+            order_data.order_date.isoformat(),
+            order_data.status,
+            _order_total(lines)
+        ))
+        _save_order_lines(conn, cur.lastrowid, lines)
+    # سفارش‌ها برای همه کاربران قابل مشاهده‌اند
+    event_broker.publish("orders", "created", [cur.lastrowid])
+    return True, "سفارش ثبت شد"
 
 def update_order_status(order_id: int, new_status: str):
-    conn = get_conn()
-    conn.execute("UPDATE orders SET status=? WHERE id=?;", (new_status, order_id))
-    conn.commit()
-    conn.close()
+    with write_conn("orders") as conn:
+        conn.execute("UPDATE orders SET status=? WHERE id=?;", (new_status, order_id))
+    event_broker.publish("orders", "updated", [order_id], status=new_status)
 
 def update_order(order_id: int, order_data: OrderCreate):
     fields = order_data.dict(exclude_unset=True)
-    fields['order_date'] = fields['order_date'].isoformat()
-    sets, params = [], []
-    for k, v in fields.items():
-        sets.append(f"{k}=?"); params.append(v)
-    if not sets:
-        return True, "بدون تغییر"
-    params.append(order_id)
+    # ارسال items (یا product_id/total_amount در شکل قدیمی) همه اقلام را جایگزین و مبلغ کل را دوباره حساب می‌کند
+    replace_lines = any([fields.pop(k, None) is not None for k in ("items", "product_id", "total_amount")])
+    if "order_date" in fields:
+        fields['order_date'] = fields['order_date'].isoformat()
+    with write_conn("orders") as conn:
+        if conn.execute("SELECT 1 FROM orders WHERE id=?;", (order_id,)).fetchone() is None:
+            return False, "سفارش یافت نشد."
+        if replace_lines:
+            lines, error = _order_lines(conn, order_data)
+            if error:
+                return False, error
+            _save_order_lines(conn, order_id, lines)
+            fields.update(product_id=lines[0][0], total_amount=_order_total(lines))
+        sets, params = [], []
+        for k, v in fields.items():
+            sets.append(f"{k}=?"); params.append(v)
+        if not sets:
+            return True, "بدون تغییر"
+        params.append(order_id)
+        conn.execute(f"UPDATE orders SET {', '.join(sets)} WHERE id=?;", params)
+    event_broker.publish("orders", "updated", [order_id])
+    return True, "ذخیره شد."
+
+def list_order_items(order_id: int) -> Optional[List[Dict[str, Any]]]:
+    """اقلام یک سفارش؛ None اگر سفارش وجود نداشته باشد."""
     conn = get_conn()
-    conn.execute(f"UPDATE orders SET {', '.join(sets)} WHERE id=?;", params)
-    conn.commit(); conn.close(); return True, "ذخیره شد."
+    if conn.execute("SELECT 1 FROM orders WHERE id=?;", (order_id,)).fetchone() is None:
+        conn.close()
+        return None
+    rows = conn.execute("""
+        SELECT i.id, i.product_id, p.name AS product, p.category, i.quantity, i.unit_price,
+               ROUND(i.quantity * i.unit_price, 2) AS line_total
+        FROM order_items i LEFT JOIN products p ON p.id = i.product_id
+        WHERE i.order_id = ? ORDER BY i.id;
+    """, (order_id,)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+# --- صفحه‌بندی keyset ---
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+def encode_cursor(values: List[Any]) -> str:
+    raw = json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Optional[List[Any]]:
+    """cursor مات را به مقادیر کلید مرتب‌سازی (تاریخ، ID) برمی‌گرداند؛ در صورت خرابی None."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception: return None
+    if (not isinstance(values, list) or len(values) != 2 or not isinstance(values[1], int)
+            or not isinstance(values[0], (str, int, float, type(None)))):
+        return None
+    return values
+
+def _keyset_where(where: List[str], params: List, keys: Tuple[str, str], after: Optional[List[Any]],
+                  nullable: bool = True):
+    """شرط «بعد از آخرین ردیف صفحه قبل» برای ORDER BY keys[0] DESC, keys[1] DESC.
+    مقادیر NULL در مرتب‌سازی نزولی آخر می‌آیند؛ برای ستون‌های NOT NULL شرط OR حذف می‌شود تا ایندکس دست‌نخورده بماند."""
+    if not after: return
+    if after[0] is None:
+        where.append(f"({keys[0]} IS NULL AND {keys[1]} < ?)"); params.append(after[1])
+    elif nullable:
+        where.append(f"(({keys[0]}, {keys[1]}) < (?, ?) OR {keys[0]} IS NULL)"); params += list(after)
+    else:
+        where.append(f"({keys[0]}, {keys[1]}) < (?, ?)"); params += list(after)
 
+def _collect_rows(cur: sqlite3.Cursor, limit: Optional[int], cursor_fields: Tuple[str, str], transform=None,
+                  columnar: bool = False):
+    """ردیف‌ها را dict می‌کند؛ با limit خروجی یک صفحه است (کوئری باید limit+1 ردیف خوانده باشد).
+    با columnar خروجی {columns, rows} است و ردیف‌ها (اگر transform نداشته باشند) اصلاً dict نمی‌شوند."""
+    columns = [description[0] for description in cur.description]
+    rows = cur.fetchall()
+    page = rows if limit is None else rows[:limit]
+    if columnar and not transform:
+        results = [tuple(row) for row in page]
+    else:
+        results = []
+        for row in page:
+            row_dict = dict(zip(columns, row))
+            if transform: transform(row_dict)
+            results.append(row_dict)
+        if columnar:
+            results = [tuple(r.values()) for r in results]
+    last = (lambda f: results[-1][columns.index(f)]) if columnar else (lambda f: results[-1][f])
+    body = {"columns": columns, "rows": results} if columnar else {"items": results}
+    if limit is None:
+        return body if columnar else results
+    next_cursor = None
+    if len(rows) > limit and results:
+        next_cursor = encode_cursor([last(f) for f in cursor_fields])
+    return {**body, "next_cursor": next_cursor, "limit": limit}
+
+def _limit_sql(limit: Optional[int], params: List) -> str:
+    if limit is None: return ""
+    params.append(limit + 1)
+    return "LIMIT ?"
 
 # --- توابع گزارش‌گیری (بدون pandas) ---
+def _name_query_where(where: List[str], params: List, name_query: Optional[str]):
+    """جستجوی نام مخاطب یا نام شرکت از طریق ایندکس FTS؛ برای متن‌های خیلی کوتاه همان LIKE قبلی."""
+    if not name_query: return
+    match = fts_match_query(name_query, column="name", strict=True)
+    if not match:
+        where.append("(u.full_name LIKE ? OR c.name LIKE ?)"); q=f"%{name_query.strip()}%"; params += [q,q]
+        return
+    where.append("(u.id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)"
+                 " OR u.company_id IN (SELECT rowid FROM companies_fts WHERE companies_fts MATCH ?))")
+    params += [match, match]
+
 def df_companies_advanced(q_name, f_status, f_level, created_from, created_to,
-                          has_open_task, owner_ids_filter: Optional[List[int]], enforce_owner: Optional[int]):
+                          has_open_task, owner_ids_filter: Optional[List[int]], enforce_owner: Optional[int],
+                          limit: Optional[int] = None, after: Optional[List[Any]] = None, count_only: bool = False,
+                          ids: Optional[List[int]] = None, columnar: bool = False):
     conn = get_conn(); params, where = [], []
-    if q_name: where.append("c.name LIKE ?"); params.append(f"%{q_name.strip()}%")
+    if q_name:
+        match = fts_match_query(q_name, column="name", strict=True)
+        if match: where.append("c.id IN (SELECT rowid FROM companies_fts WHERE companies_fts MATCH ?)"); params.append(match)
+        else: where.append("c.name LIKE ?"); params.append(f"%{q_name.strip()}%")
     if f_status: where.append("c.status IN (" + ",".join(["?"]*len(f_status)) + ")"); params += f_status
     if f_level: where.append("c.level IN (" + ",".join(["?"]*len(f_level)) + ")"); params += f_level
-    if created_from: where.append("date(c.created_at) >= ?"); params.append(created_from.isoformat())
-    if created_to:    where.append("date(c.created_at) <= ?"); params.append(created_to.isoformat())
+    if ids: where.append("c.id IN (" + ",".join(["?"]*len(ids)) + ")"); params += ids
+    _date_range_where(where, params, "c.created_at", created_from, created_to)
+    if has_open_task is not None:
+        where.append(("" if has_open_task else "NOT ") + """EXISTS(SELECT 1 FROM users u JOIN user_activity ua ON ua.user_id=u.id
+                     WHERE u.company_id=c.id AND ua.open_followups_count > 0)""")
     if enforce_owner:
         where.append("EXISTS (SELECT 1 FROM users u WHERE u.company_id=c.id AND u.owner_id=?)")
         params.append(enforce_owner)
@@ -604,16 +1973,25 @@ def df_companies_advanced(q_name, f_status, f_level, created_from, created_to,
         placeholders = ",".join(["?"]*len(owner_ids_filter))
         where.append(f"EXISTS (SELECT 1 FROM users u WHERE u.company_id=c.id AND u.owner_id IN ({placeholders}))")
         params += owner_ids_filter
+
+    if count_only:
+        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+        total = conn.execute(f"SELECT COUNT(*) FROM companies c {where_sql}", params).fetchone()[0]
+        conn.close()
+        return {"total": total}
+
+    _keyset_where(where, params, ("c.created_at", "c.id"), after)
     where_sql = ("WHERE " + " AND ".join(where)) if where else ""
-    
+    limit_sql = _limit_sql(limit, params)
+
     # جایگزین ساده بدون pandas
     query = f"""
       SELECT
         c.id AS ID, c.name AS نام_شرکت, COALESCE(c.phone,'') AS تلفن,
         COALESCE(c.status,'') AS وضعیت_شرکت, COALESCE(c.level,'') AS سطح_شرکت,
         c.created_at AS تاریخ_ایجاد,
-        EXISTS(SELECT 1 FROM users u JOIN followups f ON f.user_id=u.id 
-              WHERE u.company_id=c.id AND f.status='در حال انجام') AS پیگیری_باز_دارد,
+        CASE WHEN EXISTS(SELECT 1 FROM users u JOIN user_activity ua ON ua.user_id=u.id
+              WHERE u.company_id=c.id AND ua.open_followups_count > 0) THEN 'دارد' ELSE 'ندارد' END AS پیگیری_باز_دارد,
         (
           SELECT GROUP_CONCAT(username, '، ')
           FROM (
@@ -622,40 +2000,51 @@ def df_companies_advanced(q_name, f_status, f_level, created_from, created_to,
             WHERE u.company_id=c.id AND au.username IS NOT NULL
           ) AS d
         ) AS کارشناس_فروش
-      FROM companies c {where_sql} ORDER BY c.created_at DESC, c.id DESC
+      FROM companies c {where_sql} ORDER BY c.created_at DESC, c.id DESC {limit_sql}
     """
-    
-    cur = conn.execute(query, params)
-    columns = [description[0] for description in cur.description]
-    results = []
-    for row in cur.fetchall():
-        row_dict = dict(zip(columns, row))
-        # تبدیل پیگیری_باز_دارد به متن فارسی
-        row_dict["پیگیری_باز_دارد"] = "دارد" if row_dict.get("پیگیری_باز_دارد") == 1 else "ندارد"
-        results.append(row_dict)
-    
+
+    results = _collect_rows(conn.execute(query, params), limit, ("تاریخ_ایجاد", "ID"), columnar=columnar)
     conn.close()
     return results
 
 def df_users_advanced(first_q, last_q, phone_q, role_q, domain_q, created_from, created_to,
                       has_open_task, last_call_from, last_call_to,
-                      statuses, levels, owner_ids_filter: Optional[List[int]], enforce_owner: Optional[int]):
+                      statuses, levels, owner_ids_filter: Optional[List[int]], enforce_owner: Optional[int],
+                      limit: Optional[int] = None, after: Optional[List[Any]] = None, count_only: bool = False,
+                      ids: Optional[List[int]] = None, columnar: bool = False):
     conn = get_conn(); params, where = [], []
     if first_q: where.append("u.first_name LIKE ?"); params.append(f"%{first_q.strip()}%")
     if last_q:  where.append("u.last_name  LIKE ?"); params.append(f"%{last_q.strip()}%")
     if phone_q: where.append("u.phone LIKE ?"); params.append(f"%{phone_q.strip()}%")
     if role_q:  where.append("u.role LIKE ?"); params.append(f"%{role_q.strip()}%")
     if domain_q: where.append("u.domain LIKE ?"); params.append(f"%{domain_q.strip()}%")
-    if created_from: where.append("date(u.created_at) >= ?"); params.append(created_from.isoformat())
-    if created_to:    where.append("date(u.created_at) <= ?"); params.append(created_to.isoformat())
+    _date_range_where(where, params, "u.created_at", created_from, created_to)
     if statuses: where.append("u.status IN (" + ",".join(["?"]*len(statuses)) + ")"); params += statuses
     if levels: where.append("u.level IN (" + ",".join(["?"]*len(levels)) + ")"); params += levels
+    if ids: where.append("u.id IN (" + ",".join(["?"]*len(ids)) + ")"); params += ids
+
+    # فیلترهای پیگیری باز و آخرین تماس روی جدول خلاصه user_activity (ایندکس‌دار) اعمال می‌شوند
+    if has_open_task is True:
+        where.append("ua.open_followups_count > 0")
+    elif has_open_task is False:
+        where.append("COALESCE(ua.open_followups_count, 0) = 0")
+    _date_range_where(where, params, "ua.last_call_at", last_call_from, last_call_to)
 
     if enforce_owner:
         where.append("u.owner_id=?"); params.append(enforce_owner)
     if owner_ids_filter:
         where.append("u.owner_id IN (" + ",".join(["?"]*len(owner_ids_filter)) + ")"); params += owner_ids_filter
+
+    if count_only:
+        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+        total = conn.execute(f"SELECT COUNT(*) FROM users u LEFT JOIN user_activity ua ON ua.user_id=u.id {where_sql}",
+                             params).fetchone()[0]
+        conn.close()
+        return {"total": total}
+
+    _keyset_where(where, params, ("u.created_at", "u.id"), after)
     where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+    limit_sql = _limit_sql(limit, params)
 
     query = f"""
       SELECT
@@ -664,170 +2053,1081 @@ def df_users_advanced(first_q, last_q, phone_q, role_q, domain_q, created_from,
         COALESCE(u.status,'') AS وضعیت_کاربر, COALESCE(u.level,'') AS سطح_کاربر,
         COALESCE(u.domain,'') AS حوزه_فعالیت, COALESCE(u.province,'') AS استان,
         u.created_at AS تاریخ_ایجاد, u.company_id AS ID_شرکت,
-        
-        (SELECT cl.call_datetime FROM calls cl WHERE cl.user_id=u.id ORDER BY cl.call_datetime DESC LIMIT 1) AS آخرین_تماس,
-        (SELECT cl.status FROM calls cl WHERE cl.user_id=u.id ORDER BY cl.call_datetime DESC LIMIT 1) AS آخرین_وضعیت_تماس,
-        
-        EXISTS(SELECT 1 FROM followups f WHERE f.user_id=u.id AND f.status='در حال انجام') AS پیگیری_باز_دارد,
-        (SELECT MAX(f2.due_date) FROM followups f2 WHERE f2.user_id=u.id AND f2.status='در حال انجام') AS آخرین_پیگیری_باز,
-        COALESCE(au.username,'') AS کارشناس_فروش
+        ua.last_call_at AS آخرین_تماس, ua.last_call_status AS آخرین_وضعیت_تماس,
+        COALESCE(ua.open_followups_count, 0) > 0 AS پیگیری_باز_دارد,
+        ua.last_open_due AS آخرین_پیگیری_باز,
+        COALESCE(au.username,'') AS کارشناس_فروش,
+        CASE WHEN COALESCE(ua.open_followups_count, 0) > 0 AND COALESCE(ua.last_open_due, '') <> ''
+             THEN ua.last_open_due ELSE 'ندارد' END AS وضعیت_پیگیری_باز
       FROM users u
+      LEFT JOIN user_activity ua ON ua.user_id=u.id
       LEFT JOIN companies c ON c.id=u.company_id
       LEFT JOIN app_users au ON au.id=u.owner_id
-      {where_sql} ORDER BY u.created_at DESC, u.id DESC
+      {where_sql} ORDER BY u.created_at DESC, u.id DESC {limit_sql}
     """
-    
-    cur = conn.execute(query, params)
-    columns = [description[0] for description in cur.description]
-    results = []
-    for row in cur.fetchall():
-        row_dict = dict(zip(columns, row))
-        
-        # فیلتر کردن بر اساس has_open_task
-        if has_open_task is not None:
-            has_open = row_dict.get("پیگیری_باز_دارد") == 1
-            if has_open_task != has_open:
-                continue
-        
-        # فیلتر کردن بر اساس تاریخ آخرین تماس
-        if last_call_from and row_dict.get("آخرین_تماس"):
-            try:
-                last_call_date = datetime.fromisoformat(row_dict["آخرین_تماس"]).date()
-                if last_call_date < last_call_from:
-                    continue
-            except:
-                pass
-                
-        if last_call_to and row_dict.get("آخرین_تماس"):
-            try:
-                last_call_date = datetime.fromisoformat(row_dict["آخرین_تماس"]).date()
-                if last_call_date > last_call_to:
-                    continue
-            except:
-                pass
-        
-        # تبدیل وضعیت پیگیری به متن فارسی
-        if row_dict.get("پیگیری_باز_دارد") == 0 or not row_dict.get("آخرین_پیگیری_باز"):
-            row_dict["وضعیت_پیگیری_باز"] = "ندارد"
-        else:
-            row_dict["وضعیت_پیگیری_باز"] = row_dict.get("آخرین_پیگیری_باز", "")
-            
-        results.append(row_dict)
-    
+
+    results = _collect_rows(conn.execute(query, params), limit, ("تاریخ_ایجاد", "ID"), columnar=columnar)
     conn.close()
     return results
 
 def df_calls_by_filters(name_query, statuses, start, end,
-                          owner_ids_filter: Optional[List[int]], enforce_owner: Optional[int]):
+                          owner_ids_filter: Optional[List[int]], enforce_owner: Optional[int],
+                          limit: Optional[int] = None, after: Optional[List[Any]] = None, count_only: bool = False,
+                          ids: Optional[List[int]] = None, columnar: bool = False):
     conn = get_conn(); params, where = [], ["1=1"]
-    if name_query:
-        where.append("(u.full_name LIKE ? OR c.name LIKE ?)"); q=f"%{name_query.strip()}%"; params += [q,q]
+    _name_query_where(where, params, name_query)
     if statuses: where.append("cl.status IN (" + ",".join(["?"]*len(statuses)) + ")"); params += statuses
-    if start: where.append("date(cl.call_datetime) >= ?"); params.append(start.isoformat())
-    if end:    where.append("date(cl.call_datetime) <= ?"); params.append(end.isoformat())
+    if ids: where.append("cl.id IN (" + ",".join(["?"]*len(ids)) + ")"); params += ids
+    _date_range_where(where, params, "cl.call_datetime", start, end)
     if enforce_owner: where.append("u.owner_id=?"); params.append(enforce_owner)
     if owner_ids_filter: where.append("u.owner_id IN (" + ",".join(["?"]*len(owner_ids_filter)) + ")"); params += owner_ids_filter
-    
+
+    from_sql = """
+        FROM calls cl
+        JOIN users u ON u.id=cl.user_id
+        LEFT JOIN companies c ON c.id=u.company_id
+    """
+    if count_only:
+        total = conn.execute(f"SELECT COUNT(*) {from_sql} WHERE {' AND '.join(where)}", params).fetchone()[0]
+        conn.close()
+        return {"total": total}
+
+    _keyset_where(where, params, ("cl.call_datetime", "cl.id"), after, nullable=False)
+    limit_sql = _limit_sql(limit, params)
+
     query = f"""
         SELECT cl.id AS ID, u.full_name AS نام_کاربر, COALESCE(c.name,'') AS شرکت,
                 cl.call_datetime AS تاریخ_و_زمان, cl.status AS وضعیت, 
                 COALESCE(cl.description,'') AS توضیحات, u.id AS ID_کاربر,
                 COALESCE(au.username,'') AS کارشناس_فروش
-        FROM calls cl
-        JOIN users u ON u.id=cl.user_id
-        LEFT JOIN companies c ON c.id=u.company_id
+        {from_sql}
         LEFT JOIN app_users au ON au.id=u.owner_id
         WHERE {' AND '.join(where)}
-        ORDER BY cl.call_datetime DESC, cl.id DESC
+        ORDER BY cl.call_datetime DESC, cl.id DESC {limit_sql}
     """
-    
-    cur = conn.execute(query, params)
-    columns = [description[0] for description in cur.description]
-    results = [dict(zip(columns, row)) for row in cur.fetchall()]
-    
+
+    results = _collect_rows(conn.execute(query, params), limit, ("تاریخ_و_زمان", "ID"), columnar=columnar)
     conn.close()
     return results
 
 def df_followups_by_filters(name_query, statuses, start, end,
-                            owner_ids_filter: Optional[List[int]], enforce_owner: Optional[int]):
+                            owner_ids_filter: Optional[List[int]], enforce_owner: Optional[int],
+                            limit: Optional[int] = None, after: Optional[List[Any]] = None, count_only: bool = False,
+                            ids: Optional[List[int]] = None, columnar: bool = False):
     conn = get_conn(); params, where = [], ["1=1"]
-    if name_query:
-        where.append("(u.full_name LIKE ? OR c.name LIKE ?)"); q=f"%{name_query.strip()}%"; params += [q,q]
+    _name_query_where(where, params, name_query)
     if statuses: where.append("f.status IN (" + ",".join(["?"]*len(statuses)) + ")"); params += statuses
-    if start: where.append("date(f.due_date) >= ?"); params.append(start.isoformat())
-    if end:    where.append("date(f.due_date) <= ?"); params.append(end.isoformat())
+    if ids: where.append("f.id IN (" + ",".join(["?"]*len(ids)) + ")"); params += ids
+    _date_range_where(where, params, "f.due_date", start, end)
     if enforce_owner: where.append("u.owner_id=?"); params.append(enforce_owner)
     if owner_ids_filter: where.append("u.owner_id IN (" + ",".join(["?"]*len(owner_ids_filter)) + ")"); params += owner_ids_filter
-    
+
+    from_sql = """
+        FROM followups f
+        JOIN users u ON u.id=f.user_id
+        LEFT JOIN companies c ON c.id=u.company_id
+    """
+    if count_only:
+        total = conn.execute(f"SELECT COUNT(*) {from_sql} WHERE {' AND '.join(where)}", params).fetchone()[0]
+        conn.close()
+        return {"total": total}
+
+    _keyset_where(where, params, ("f.due_date", "f.id"), after, nullable=False)
+    limit_sql = _limit_sql(limit, params)
+
     query = f"""
         SELECT f.id AS ID, u.full_name AS نام_کاربر, COALESCE(c.name,'') AS شرکت,
                 f.title AS عنوان, COALESCE(f.details,'') AS جزئیات,
                 f.due_date AS تاریخ_پیگیری, f.status AS وضعیت, u.id AS ID_کاربر,
                 COALESCE(au.username,'') AS کارشناس_فروش
-        FROM followups f
-        JOIN users u ON u.id=f.user_id
-        LEFT JOIN companies c ON c.id=u.company_id
+        {from_sql}
         LEFT JOIN app_users au ON au.id=u.owner_id
         WHERE {' AND '.join(where)}
-        ORDER BY f.due_date DESC, f.id DESC
+        ORDER BY f.due_date DESC, f.id DESC {limit_sql}
     """
-    
-    cur = conn.execute(query, params)
-    columns = [description[0] for description in cur.description]
-    results = [dict(zip(columns, row)) for row in cur.fetchall()]
-        
+
+    results = _collect_rows(conn.execute(query, params), limit, ("تاریخ_پیگیری", "ID"), columnar=columnar)
     conn.close()
     return results
 
 def df_orders_by_filters(user_filter: Optional[int] = None, company_filter: Optional[int] = None,
-                          product_filter: Optional[int] = None, status_filter: Optional[str] = None):
+                          product_filter: Optional[int] = None, status_filter: Optional[str] = None,
+                          start: Optional[date] = None, end: Optional[date] = None,
+                          owner_ids_filter: Optional[List[int]] = None,
+                          limit: Optional[int] = None, after: Optional[List[Any]] = None, count_only: bool = False,
+                          ids: Optional[List[int]] = None, columnar: bool = False):
     conn = get_conn(); params, where = [], ["1=1"]
     if user_filter: where.append("o.user_id = ?"); params.append(user_filter)
     if company_filter: where.append("o.company_id = ?"); params.append(company_filter)
-    if product_filter: where.append("o.product_id = ?"); params.append(product_filter)
+    # سفارش‌هایی که این محصول در یکی از اقلامشان هست (idx_order_items_product)
+    if product_filter: where.append("o.id IN (SELECT i.order_id FROM order_items i WHERE i.product_id = ?)"); params.append(product_filter)
     if status_filter and status_filter != "همه":
-        where.append("o.status = ?"); params.append(status_filter)
+        # با بازه تاریخ (یا فقط شمارش) idx_orders_status_date؛ بدون آن پیمایش idx_orders_created به ترتیب صفحه
+        # سریع‌تر از خواندن همه سفارش‌های یک وضعیت و مرتب‌سازی دوباره است (+ ایندکس status را کنار می‌گذارد)
+        status_col = "o.status" if start or end or count_only else "+o.status"
+        where.append(f"{status_col} = ?"); params.append(status_filter)
+    _date_range_where(where, params, "o.order_date", start, end)
+    if owner_ids_filter:
+        where.append("o.user_id IN (SELECT u.id FROM users u WHERE u.owner_id IN (" + ",".join(["?"]*len(owner_ids_filter)) + "))")
+        params += owner_ids_filter
+    if ids: where.append("o.id IN (" + ",".join(["?"]*len(ids)) + ")"); params += ids
+
+    if count_only:
+        total = conn.execute(f"SELECT COUNT(*) FROM orders o WHERE {' AND '.join(where)}", params).fetchone()[0]
+        conn.close()
+        return {"total": total}
+
+    _keyset_where(where, params, ("o.created_at", "o.id"), after)
     where_sql = "WHERE " + " AND ".join(where)
+    limit_sql = _limit_sql(limit, params)
 
     query = f"""
         SELECT 
             o.id AS ID, COALESCE(u.full_name, '—') AS کاربر,
             COALESCE(c.name, '—') AS شرکت, p.name AS محصول, p.category AS دسته_بندی,
             o.order_date AS تاریخ_سفارش, o.total_amount AS مبلغ_کل,
+            (SELECT COUNT(*) FROM order_items i WHERE i.order_id = o.id) AS تعداد_اقلام,
             o.status AS وضعیت, o.created_at AS تاریخ_ایجاد
         FROM orders o
         LEFT JOIN users u ON u.id = o.user_id
         LEFT JOIN companies c ON c.id = o.company_id
         LEFT JOIN products p ON p.id = o.product_id
-        {where_sql} ORDER BY o.created_at DESC;
+        {where_sql} ORDER BY o.created_at DESC, o.id DESC {limit_sql};
     """
-    
-    cur = conn.execute(query, params)
-    columns = [description[0] for description in cur.description]
-    results = []
-    for row in cur.fetchall():
-        row_dict = dict(zip(columns, row))
-        # فرمت کردن مبلغ
-        if "مبلغ_کل" in row_dict and row_dict["مبلغ_کل"]:
+    # مبلغ عددی می‌ماند تا کلاینت بتواند مرتب/جمع کند؛ قالب‌بندی با نمایش است
+    results = _collect_rows(conn.execute(query, params), limit, ("تاریخ_ایجاد", "ID"), columnar=columnar)
+    conn.close()
+    return results
+
+# --- همگام‌سازی افزایشی (changes since) ---
+# کلاینت یک بار cursor فعلی را می‌گیرد، لیست‌ها را کامل بار می‌کند و بعد فقط تغییرات بعد از cursor را اعمال می‌کند.
+# ردیف‌های تغییرکرده با همان توابع لیست (و همان شکل ستون‌ها و محدودیت کارشناس) خوانده می‌شوند؛ ردیفی که دیگر
+# وجود ندارد یا برای این کاربر قابل مشاهده نیست (مثلاً مخاطبی که به کارشناس دیگری داده شد) در deletes می‌آید.
+CHANGES_DEFAULT_LIMIT = 500
+CHANGES_MAX_LIMIT = 5000
+CHANGES_FETCH_CHUNK = 500
+_CHANGE_FETCHERS = {
+    "companies": lambda ids, owner: df_companies_advanced(None, [], [], None, None, None, [], owner, ids=ids),
+    "users": lambda ids, owner: df_users_advanced(None, None, None, None, None, None, None, None, None, None,
+                                                  [], [], [], owner, ids=ids),
+    "calls": lambda ids, owner: df_calls_by_filters(None, [], None, None, [], owner, ids=ids),
+    "followups": lambda ids, owner: df_followups_by_filters(None, [], None, None, [], owner, ids=ids),
+    "orders": lambda ids, owner: df_orders_by_filters(ids=ids),
+    "products": lambda ids, owner: list_products(ids=ids),
+}
+
+def changes_since(since: Optional[str], limit: int, enforce_owner: Optional[int]) -> Dict[str, Any]:
+    """تغییرات بعد از cursor؛ بدون since فقط cursor فعلی. اگر cursor مال دیتابیس دیگری (بازیابی‌شده) باشد یا
+    تغییرات آن از لاگ پاک شده باشد reset=true برمی‌گردد و کلاینت باید لیست‌ها را دوباره کامل بار کند."""
+    conn = get_conn()
+    epoch, pruned_seq = conn.execute("SELECT epoch, pruned_seq FROM sync_state WHERE id = 1;").fetchone()
+    # head قبل از خواندن تغییرات؛ تغییری که بین این دو نوشته شود در دور بعد دوباره (بی‌ضرر) فرستاده می‌شود
+    head = (conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log';").fetchone() or (0,))[0]
+    after = decode_cursor(since) if since else None
+    if after is None or after[0] != epoch or not pruned_seq <= after[1] <= head:
+        conn.close()
+        return {"cursor": encode_cursor([epoch, head]), "reset": bool(since), "has_more": False, "changes": {}}
+    rows = conn.execute("SELECT seq, tbl, row_id, op FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?;",
+                        (after[1], limit + 1)).fetchall()
+    conn.close()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    last_seq = rows[-1]["seq"] if rows else after[1]
+
+    changed: Dict[str, Dict[str, List[int]]] = {}
+    for r in rows:
+        changed.setdefault(r["tbl"], {"upsert": [], "delete": []})[r["op"]].append(r["row_id"])
+    changes = {}
+    for table, ops in changed.items():
+        upserts = []
+        for i in range(0, len(ops["upsert"]), CHANGES_FETCH_CHUNK):
+            upserts += _CHANGE_FETCHERS[table](ops["upsert"][i:i + CHANGES_FETCH_CHUNK], enforce_owner)
+        visible = {r.get("ID", r.get("id")) for r in upserts}
+        deletes = ops["delete"] + [i for i in ops["upsert"] if i not in visible]
+        changes[table] = {"upserts": upserts, "deletes": deletes}
+    cursor = last_seq if has_more else max(last_seq, head)
+    return {"cursor": encode_cursor([epoch, cursor]), "reset": False, "has_more": has_more, "changes": changes}
+
+# --- کش لیست‌های مرجع (ETag) ---
+# ETag از epoch دیتابیس و نسخه جدول‌ها ساخته می‌شود؛ با If-None-Match برابر فقط همین چند عدد خوانده و 304
+# برگردانده می‌شود، و تا نسخه عوض نشده JSON آماده از حافظه همین worker فرستاده می‌شود. کش با scope کلید می‌خورد
+# و (etag, JSON) نگه می‌دارد، پس با عوض شدن نسخه همان ورودی جایگزین می‌شود و از هر لیست فقط یک نسخه در حافظه می‌ماند.
+lookup_cache = LRUTTLCache(maxsize=256, ttl=3600)
+
+def tables_etag(tables: Tuple[str, ...], scope: str) -> str:
+    conn = get_conn()
+    epoch = conn.execute("SELECT epoch FROM sync_state WHERE id = 1;").fetchone()[0]
+    versions = dict(conn.execute(f"SELECT tbl, version FROM table_versions WHERE tbl IN ({','.join('?' * len(tables))});",
+                                 tables).fetchall())
+    conn.close()
+    return f'"{epoch}-{scope}-' + ".".join(str(versions.get(t, 0)) for t in tables) + '"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match: return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in (t[2:] if t.startswith("W/") else t for t in tags)
+
+def versioned_payload(tables: Tuple[str, ...], scope: str, if_none_match: Optional[str], fn, *args) -> Tuple[str, Optional[bytes]]:
+    """(etag, JSON) برمی‌گرداند؛ اگر نسخه کلاینت هنوز معتبر باشد JSON برابر None است (پاسخ 304)."""
+    etag = tables_etag(tables, scope)
+    if etag_matches(if_none_match, etag):
+        return etag, None
+    cached = lookup_cache.get(scope)
+    if cached is not None and cached[0] == etag:
+        return cached
+    body = _json_bytes(fn(*args))
+    lookup_cache.set(scope, (etag, body))
+    return etag, body
+
+# --- خروجی استریم CSV/XLSX ---
+# همان توابع df_* صفحه‌به‌صفحه (keyset) خوانده و هر صفحه بلافاصله encode و ارسال می‌شود؛ حافظه مصرفی به اندازه
+# یک صفحه است، نه کل جدول. خواندن و encode هر صفحه در استخر DB انجام می‌شود.
+EXPORT_PAGE_SIZE = int(os.environ.get("CRM_EXPORT_PAGE_SIZE", "2000"))
+_XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# writerها صفحه‌ها را به شکل columnar (نام ستون‌های کوئری + tuple ردیف‌ها) می‌گیرند تا سطر عنوان حتی وقتی هیچ
+# ردیفی با فیلتر جور نیست هم نوشته شود.
+class CsvExportWriter:
+    media_type = "text/csv"  # Starlette خودش "; charset=utf-8" را به text/* اضافه می‌کند
+    extension = "csv"
+
+    def __init__(self, sheet_name: str):
+        self._header_written = False
+
+    def start(self) -> bytes:
+        return "\ufeff".encode("utf-8")  # BOM تا اکسل متن فارسی را درست باز کند
+
+    def rows(self, columns: List[str], rows: List[tuple]) -> bytes:
+        buf = io.StringIO(); w = csv.writer(buf)
+        if not self._header_written:
+            w.writerow(columns); self._header_written = True
+        w.writerows(rows)
+        return buf.getvalue().encode("utf-8")
+
+    def finish(self) -> bytes:
+        return b""
+
+class _ChunkSink(io.RawIOBase):
+    """مقصد غیرقابل seek برای zipfile؛ بایت‌های نوشته‌شده تا drain بعدی نگه داشته می‌شوند."""
+    def __init__(self):
+        super().__init__(); self._chunks: List[bytes] = []
+    def writable(self): return True
+    def write(self, b):
+        self._chunks.append(bytes(b)); return len(b)
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks); self._chunks = []
+        return data
+
+class XlsxExportWriter:
+    """حداقل یک فایل XLSX معتبر (یک شیت راست‌به‌چپ با inlineStr) که به‌صورت افزایشی در zip نوشته می‌شود."""
+    media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    extension = "xlsx"
+    _NS = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+    _REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+    _PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+    def __init__(self, sheet_name: str):
+        self.sheet_name = sheet_name
+        self._header_written = False
+
+    def start(self) -> bytes:
+        self._sink = _ChunkSink()
+        self._zip = zipfile.ZipFile(self._sink, "w", zipfile.ZIP_DEFLATED)
+        ct = "application/vnd.openxmlformats-officedocument.spreadsheetml"
+        self._zip.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            f'<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            f'<Override PartName="/xl/workbook.xml" ContentType="{ct}.sheet.main+xml"/>'
+            f'<Override PartName="/xl/worksheets/sheet1.xml" ContentType="{ct}.worksheet+xml"/></Types>'))
+        self._zip.writestr("_rels/.rels", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Relationships xmlns="{self._PKG_REL_NS}">'
+            f'<Relationship Id="rId1" Type="{self._REL_NS}/officeDocument" Target="xl/workbook.xml"/></Relationships>'))
+        self._zip.writestr("xl/workbook.xml", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><workbook {self._NS} xmlns:r="{self._REL_NS}">'
+            f'<sheets><sheet name="{xml_escape(self.sheet_name[:31])}" sheetId="1" r:id="rId1"/></sheets></workbook>'))
+        self._zip.writestr("xl/_rels/workbook.xml.rels", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Relationships xmlns="{self._PKG_REL_NS}">'
+            f'<Relationship Id="rId1" Type="{self._REL_NS}/worksheet" Target="worksheets/sheet1.xml"/></Relationships>'))
+        self._sheet = self._zip.open("xl/worksheets/sheet1.xml", "w", force_zip64=True)
+        self._sheet.write((
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><worksheet {self._NS}>'
+            '<sheetViews><sheetView rightToLeft="1" workbookViewId="0"/></sheetViews><sheetData>').encode("utf-8"))
+        return self._sink.drain()
+
+    @staticmethod
+    def _cell(value: Any) -> str:
+        if value is None or value == "": return "<c/>"
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return f"<c><v>{value}</v></c>"
+        text = xml_escape(_XML_ILLEGAL.sub("", str(value)))
+        return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+    def rows(self, columns: List[str], rows: List[tuple]) -> bytes:
+        parts = []
+        if not self._header_written:
+            parts.append("<row>" + "".join(self._cell(k) for k in columns) + "</row>")
+            self._header_written = True
+        for row in rows:
+            parts.append("<row>" + "".join(self._cell(v) for v in row) + "</row>")
+        self._sheet.write("".join(parts).encode("utf-8"))
+        return self._sink.drain()
+
+    def finish(self) -> bytes:
+        self._sheet.write(b"</sheetData></worksheet>")
+        self._sheet.close(); self._zip.close()
+        return self._sink.drain()
+
+EXPORT_WRITERS = {"csv": CsvExportWriter, "xlsx": XlsxExportWriter}
+
+def _export_page(fn, writer, filters: Dict[str, Any], after: Optional[List[Any]]) -> Tuple[bytes, Optional[List[Any]]]:
+    page = fn(**filters, limit=EXPORT_PAGE_SIZE, after=after, columnar=True)
+    next_after = decode_cursor(page["next_cursor"]) if page["next_cursor"] else None
+    return writer.rows(page["columns"], page["rows"]), next_after
+
+async def _export_stream(fn, writer, filters: Dict[str, Any]):
+    yield await run_db(writer.start)
+    after = None
+    while True:
+        chunk, after = await run_db(_export_page, fn, writer, filters, after)
+        if chunk: yield chunk
+        if after is None: break
+    yield await run_db(writer.finish)
+
+# --- ایمپورت مخاطبین از CSV/XLSX ---
+# فایل ردیف‌به‌ردیف خوانده می‌شود (XLSX با iterparse)، شماره‌ها/شرکت‌ها/کارشناس‌ها یک بار در dict بارگذاری و
+# هر IMPORT_CHUNK_SIZE ردیف با یک executemany در یک تراکنش درج می‌شود.
+IMPORT_COLUMNS = ["FirstName", "Phone", "LastName", "Role", "Company", "Status", "Level",
+                  "Domain", "Province", "OwnerUsername", "Note"]
+IMPORT_REQUIRED = ("FirstName", "Phone")
+IMPORT_CHUNK_SIZE = int(os.environ.get("CRM_IMPORT_CHUNK_SIZE", "5000"))
+IMPORT_MAX_ERRORS = 500
+_XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_DIGITS_TRANSLATE = str.maketrans({k: v for k, v in _FA_NORMALIZE_MAP.items() if v.isdigit()})
+
+def _iter_csv_rows(fileobj):
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    try:
+        yield from csv.reader(text)
+    finally:
+        text.detach()  # فایل آپلودی را خود FastAPI می‌بندد
+
+def _xlsx_col_index(ref: str) -> int:
+    idx = 0
+    for ch in ref:
+        if not ch.isalpha(): break
+        idx = idx * 26 + (ord(ch.upper()) - 64)
+    return idx - 1
+
+def _iter_xlsx_rows(fileobj):
+    """ردیف‌های اولین شیت؛ هر ردیف پس از خوانده شدن از درخت XML حذف می‌شود تا حافظه ثابت بماند."""
+    try:
+        zf = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile:
+        raise ValueError("فایل XLSX معتبر نیست")
+    names = set(zf.namelist())
+    shared: List[str] = []
+    if "xl/sharedStrings.xml" in names:
+        with zf.open("xl/sharedStrings.xml") as f:
+            for _, el in ET.iterparse(f):
+                if el.tag == _XLSX_NS + "si":
+                    shared.append("".join(t.text or "" for t in el.iter(_XLSX_NS + "t"))); el.clear()
+    sheets = sorted(n for n in names if n.startswith("xl/worksheets/sheet") and n.endswith(".xml"))
+    if not sheets:
+        raise ValueError("فایل XLSX هیچ شیتی ندارد")
+    sheet = "xl/worksheets/sheet1.xml" if "xl/worksheets/sheet1.xml" in names else sheets[0]
+    with zf.open(sheet) as f:
+        sheet_data = None
+        for event, el in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if el.tag == _XLSX_NS + "sheetData": sheet_data = el
+                continue
+            if el.tag != _XLSX_NS + "row": continue
+            values: List[str] = []
+            for c in el.iter(_XLSX_NS + "c"):
+                ref = c.get("r")
+                idx = _xlsx_col_index(ref) if ref else len(values)
+                values.extend([""] * (idx - len(values)))
+                kind = c.get("t")
+                if kind == "inlineStr":
+                    v = "".join(t.text or "" for t in c.iter(_XLSX_NS + "t"))
+                else:
+                    v_el = c.find(_XLSX_NS + "v")
+                    v = v_el.text or "" if v_el is not None else ""
+                    if kind == "s" and v: v = shared[int(v)]
+                values.append(v)
+            if sheet_data is not None: sheet_data.clear()
+            yield values
+
+def _clean_import_phone(value: str) -> str:
+    ph = (value or "").translate(_DIGITS_TRANSLATE).strip()
+    if re.fullmatch(r"\d+\.0", ph): ph = ph[:-2]  # عدد اکسل که به‌صورت float ذخیره شده
+    return ph
+
+_IMPORT_USER_COLS = "first_name,last_name,full_name,phone,role,company_id,note,status,domain,province,level,owner_id,created_by"
+
+def import_users_file(fileobj, filename: str, creator_id: int, on_chunk=None) -> Dict[str, Any]:
+    """on_chunk(inserted, failed): پس از درج هر chunk صدا زده می‌شود (گزارش پیشرفت/لغو در job)."""
+    rows = _iter_xlsx_rows(fileobj) if filename.lower().endswith(".xlsx") else _iter_csv_rows(fileobj)
+    try:
+        return _import_user_rows(rows, creator_id, on_chunk)
+    finally:
+        rows.close()
+
+def _import_user_rows(rows, creator_id: int, on_chunk=None) -> Dict[str, Any]:
+    header = next(rows, None)
+    if not header:
+        raise ValueError("فایل خالی است")
+    col = {h.strip().lower(): i for i, h in enumerate(header) if h and h.strip()}
+    missing = [c for c in IMPORT_REQUIRED if c.lower() not in col]
+    if missing:
+        raise ValueError(f"ستون‌های الزامی یافت نشد: {', '.join(missing)}")
+    ix = {name: col.get(name.lower()) for name in IMPORT_COLUMNS}
+
+    conn = get_conn()
+    phones = {r[0] for r in conn.execute("SELECT phone FROM users WHERE phone IS NOT NULL AND phone<>'';")}
+    companies: Dict[str, int] = {}
+    for cid, name in conn.execute("SELECT id, name FROM companies ORDER BY id;"):
+        companies.setdefault((name or "").strip(), cid)
+    owners = {r[0]: r[1] for r in conn.execute("SELECT username, id FROM app_users;")}
+    conn.close()
+
+    errors: List[str] = []; error_count = 0
+    inserted = 0
+    def error(row_no: int, msg: str):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < IMPORT_MAX_ERRORS: errors.append(f"ردیف {row_no}: {msg}")
+
+    def resolve_company(conn, name: str) -> Optional[int]:
+        if not name: return None
+        if name not in companies:
+            companies[name] = conn.execute("INSERT INTO companies (name, created_by) VALUES (?, ?);",
+                                           (name, creator_id)).lastrowid
+        return companies[name]
+
+    def flush(chunk: List[Tuple[int, str, tuple]]):
+        # ردیف‌ها اول با executemany در یک جدول موقت و سپس با یک INSERT ... SELECT درج می‌شوند: FTS5 در ابتدای
+        # هر statement داده‌های بافرشده‌اش را flush می‌کند و درج تک‌به‌تک روی users را چند برابر کند می‌کرد.
+        # اگر درج گروهی به‌خاطر رکوردی که هم‌زمان ثبت شده شکست بخورد، chunk ردیف‌به‌ردیف تکرار می‌شود.
+        nonlocal inserted
+        if not chunk: return
+        if on_chunk: on_chunk(inserted, error_count)
+        snapshot = dict(companies)
+        try:
+            with write_conn("users", "companies") as conn:
+                conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS import_users_stage ({_IMPORT_USER_COLS});")
+                conn.execute("DELETE FROM temp.import_users_stage;")
+                conn.executemany(f"INSERT INTO temp.import_users_stage VALUES ({','.join('?' * 13)});",
+                                 [(*vals[:5], resolve_company(conn, company), *vals[5:]) for _, company, vals in chunk])
+                conn.execute(f"INSERT INTO users ({_IMPORT_USER_COLS}) SELECT {_IMPORT_USER_COLS} "
+                             "FROM temp.import_users_stage ORDER BY rowid;")
+            inserted += len(chunk)
+            return
+        except sqlite3.IntegrityError:
+            companies.clear(); companies.update(snapshot)
+        for row_no, company, vals in chunk:
             try:
-                row_dict["مبلغ_کل"] = f"{float(row_dict['مبلغ_کل']):,.0f}"
-            except:
-                pass
-        results.append(row_dict)
+                with write_conn("users", "companies") as conn:
+                    conn.execute(f"INSERT INTO users ({_IMPORT_USER_COLS}) VALUES ({','.join('?' * 13)});",
+                                 (*vals[:5], resolve_company(conn, company), *vals[5:]))
+                inserted += 1
+                snapshot = dict(companies)
+            except sqlite3.IntegrityError as e:
+                companies.clear(); companies.update(snapshot)
+                error(row_no, f"ثبت نشد ({e})")
+
+    chunk: List[Tuple[int, str, tuple]] = []
+    for row_no, values in enumerate(rows, start=2):
+        cells = {name: (values[i].strip() if i is not None and i < len(values) and values[i] else "")
+                 for name, i in ix.items()}
+        if not any(cells.values()): continue
+        first, last, phone = cells["FirstName"], cells["LastName"], _clean_import_phone(cells["Phone"])
+        status_v, level_v = cells["Status"] or USER_STATUSES[0], cells["Level"] or LEVELS[0]
+        owner_name = cells["OwnerUsername"]
+        if not first: error(row_no, "نام اجباری است."); continue
+        if not phone: error(row_no, "شماره تماس اجباری است."); continue
+        if phone in phones: error(row_no, f"شماره تماس تکراری است ({phone})."); continue
+        if status_v not in USER_STATUSES: error(row_no, f"وضعیت نامعتبر است ({status_v})."); continue
+        if level_v not in LEVELS: error(row_no, f"سطح نامعتبر است ({level_v})."); continue
+        if owner_name and owner_name not in owners: error(row_no, f"کارشناس «{owner_name}» یافت نشد."); continue
+        phones.add(phone)
+        chunk.append((row_no, cells["Company"], (
+            first, last, f"{first} {last}".strip(), phone, cells["Role"],
+            cells["Note"], status_v, cells["Domain"], cells["Province"], level_v,
+            owners.get(owner_name), creator_id)))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            flush(chunk); chunk = []
+    flush(chunk)
+
+    if error_count > len(errors):
+        errors.append(f"... و {error_count - len(errors)} خطای دیگر")
+    return {"message": f"{inserted} مخاطب وارد شد" + (f"، {error_count} ردیف خطا داشت." if error_count else "."),
+            "inserted": inserted, "failed": error_count, "errors": errors}
+
+# --- کارهای پس‌زمینه (jobs) ---
+# کارهای طولانی ادمین (بازیابی، تغییر گروهی بزرگ، خروجی/ایمپورت حجیم) در thread‌های جدا از استخر DB اجرا می‌شوند؛
+# وضعیت در جدول jobs نگه داشته می‌شود تا هر worker بتواند به polling جواب بدهد.
+JOB_WORKERS = int(os.environ.get("CRM_JOB_WORKERS", "2"))
+JOBS_DIR = os.environ.get("CRM_JOBS_DIR", "jobs")
+JOB_RETENTION_HOURS = float(os.environ.get("CRM_JOB_RETENTION_HOURS", "24"))
+JOB_PROGRESS_INTERVAL = 0.5
+JOB_ACTIVE_STATUSES = ("queued", "running")
+
+class JobCancelled(Exception):
+    pass
+
+class JobContext:
+    """به تابع job داده می‌شود: گزارش پیشرفت (با فاصله حداقل JOB_PROGRESS_INTERVAL) و بررسی درخواست لغو."""
+    def __init__(self, runner: "JobRunner", job_id: str):
+        self.runner, self.job_id = runner, job_id
+        self._last_progress = 0.0
+        self._last_cancel_check = 0.0
+
+    def progress(self, done: float, total: Optional[float] = None, message: Optional[str] = None):
+        """done/total به‌صورت کسر در ستون progress؛ بدون total فقط message به‌روز می‌شود."""
+        now = time.monotonic()
+        if now - self._last_progress < JOB_PROGRESS_INTERVAL and (not total or done < total): return
+        self._last_progress = now
+        fields: Dict[str, Any] = {}
+        if total: fields["progress"] = round(min(done / total, 1.0), 4)
+        if message is not None: fields["message"] = message
+        if fields: self.runner._update(self.job_id, **fields)
+
+    def check_cancelled(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_cancel_check < JOB_PROGRESS_INTERVAL: return
+        self._last_cancel_check = now
+        conn = get_conn()
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id=?;", (self.job_id,)).fetchone()
+        conn.close()
+        if row and row[0]: raise JobCancelled()
+
+    def path(self, extension: str) -> str:
+        """مسیر فایل خروجی این job در JOBS_DIR."""
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        return os.path.join(JOBS_DIR, f"{self.job_id}.{extension}")
+
+class JobRunner:
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crm-job")
+        self._meta: Dict[str, Dict[str, Any]] = {}  # برای بازسازی ردیف job اگر دیتابیس (مثلاً با بازیابی) عوض شد
+        self._lock = threading.Lock()
+        self._submitted = self._completed = self._failed = 0
+
+    def submit(self, kind: str, fn, *args, created_by: Optional[int] = None, **kwargs) -> str:
+        """fn(job, *args, **kwargs) را در صف می‌گذارد؛ خروجی fn (dict) به‌صورت JSON در result ذخیره می‌شود."""
+        self.prune()
+        job_id = uuid.uuid4().hex
+        meta = {"kind": kind, "created_by": created_by, "worker_pid": os.getpid(),
+                "created_at": datetime.utcnow().strftime(DB_DATETIME_FMT)}
+        with write_conn("jobs") as conn:
+            conn.execute("INSERT INTO jobs (id, kind, created_by, worker_pid, created_at) VALUES (?,?,?,?,?);",
+                         (job_id, kind, created_by, meta["worker_pid"], meta["created_at"]))
+        with self._lock:
+            self._meta[job_id] = meta; self._submitted += 1
+        self._executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def _update(self, job_id: str, **fields):
+        sets = ", ".join(f"{k}=?" for k in fields)
+        with write_conn("jobs") as conn:
+            if conn.execute(f"UPDATE jobs SET {sets} WHERE id=?;", (*fields.values(), job_id)).rowcount == 0:
+                row = {**self._meta.get(job_id, {"kind": "unknown"}), **fields, "id": job_id}
+                conn.execute(f"INSERT INTO jobs ({', '.join(row)}) VALUES ({','.join('?' * len(row))});", list(row.values()))
+
+    def _run(self, job_id: str, fn, args, kwargs):
+        now = lambda: datetime.utcnow().strftime(DB_DATETIME_FMT)
+        conn = get_conn()
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id=?;", (job_id,)).fetchone()
+        conn.close()
+        if row and row[0]:
+            self._update(job_id, status="cancelled", finished_at=now()); return
+        self._update(job_id, status="running", started_at=now())
+        try:
+            result = fn(JobContext(self, job_id), *args, **kwargs)
+            self._update(job_id, status="done", progress=1.0, finished_at=now(),
+                         message=(result or {}).get("message"), result=json.dumps(result, ensure_ascii=False, default=str))
+            with self._lock: self._completed += 1
+        except JobCancelled:
+            self._update(job_id, status="cancelled", finished_at=now(), message="لغو شد")
+        except Exception as e:
+            self._update(job_id, status="failed", finished_at=now(), error=str(e))
+            with self._lock: self._failed += 1
+        finally:
+            with self._lock: self._meta.pop(job_id, None)
+
+    def cancel(self, job_id: str) -> bool:
+        with write_conn("jobs") as conn:
+            cur = conn.execute(
+                f"UPDATE jobs SET cancel_requested=1 WHERE id=? AND status IN ({','.join('?' * len(JOB_ACTIVE_STATUSES))});",
+                (job_id, *JOB_ACTIVE_STATUSES))
+        return cur.rowcount > 0
+
+    def recover_interrupted(self):
+        """jobهای نیمه‌کاره‌ای که process اجراکننده‌شان دیگر زنده نیست را failed علامت می‌زند (هنگام startup)."""
+        conn = get_conn()
+        rows = conn.execute(
+            f"SELECT id, worker_pid FROM jobs WHERE status IN ({','.join('?' * len(JOB_ACTIVE_STATUSES))});",
+            JOB_ACTIVE_STATUSES).fetchall()
+        conn.close()
+        dead = [r["id"] for r in rows if not _pid_alive(r["worker_pid"])]
+        for job_id in dead:
+            self._update(job_id, status="failed", error="سرور در حین اجرای این کار متوقف شد",
+                         finished_at=datetime.utcnow().strftime(DB_DATETIME_FMT))
+
+    def prune(self):
+        cutoff = (datetime.utcnow() - timedelta(hours=JOB_RETENTION_HOURS)).strftime(DB_DATETIME_FMT)
+        conn = get_conn()
+        old = [r[0] for r in conn.execute(
+            f"SELECT id FROM jobs WHERE created_at < ? AND status NOT IN ({','.join('?' * len(JOB_ACTIVE_STATUSES))});",
+            (cutoff, *JOB_ACTIVE_STATUSES))]
+        conn.close()
+        if not old: return
+        for job_id in old:
+            for ext in EXPORT_WRITERS_EXTENSIONS:
+                path = os.path.join(JOBS_DIR, f"{job_id}.{ext}")
+                if os.path.exists(path): os.remove(path)
+        with write_conn("jobs") as conn:
+            conn.executemany("DELETE FROM jobs WHERE id=?;", [(j,) for j in old])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"workers": self._executor._max_workers, "in_flight": len(self._meta),
+                    "submitted": self._submitted, "completed": self._completed, "failed": self._failed}
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid: return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+job_runner = JobRunner(JOB_WORKERS)
+EXPORT_WRITERS_EXTENSIONS = tuple(w.extension for w in EXPORT_WRITERS.values())
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    conn = get_conn()
+    row = conn.execute("SELECT * FROM jobs WHERE id=?;", (job_id,)).fetchone()
+    conn.close()
+    if not row: return None
+    job = dict(row)
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    return job
+
+def list_jobs(created_by: Optional[int], limit: int) -> List[Dict[str, Any]]:
+    conn = get_conn()
+    sql = "SELECT id, kind, status, progress, message, error, created_by, created_at, started_at, finished_at FROM jobs"
+    params: List[Any] = []
+    if created_by is not None: sql += " WHERE created_by=?"; params.append(created_by)
+    rows = conn.execute(sql + " ORDER BY created_at DESC, id DESC LIMIT ?;", (*params, limit)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+def job_export(job: JobContext, fn, name: str, writer_cls, filters: Dict[str, Any]) -> Dict[str, Any]:
+    """خروجی حجیم را به‌جای استریم در پاسخ، در فایلی در JOBS_DIR می‌نویسد تا بعداً دانلود شود."""
+    total = fn(**filters, count_only=True)["total"]
+    path, writer = job.path(writer_cls.extension), writer_cls(name)
+    written, after = 0, None
+    try:
+        with open(path, "wb") as f:
+            f.write(writer.start())
+            while True:
+                job.check_cancelled()
+                page = fn(**filters, limit=EXPORT_PAGE_SIZE, after=after, columnar=True)
+                f.write(writer.rows(page["columns"], page["rows"]))
+                written += len(page["rows"])
+                job.progress(written, total)
+                if not page["next_cursor"]: break
+                after = decode_cursor(page["next_cursor"])
+            f.write(writer.finish())
+    except BaseException:
+        if os.path.exists(path): os.remove(path)
+        raise
+    filename = f"{name}-{datetime.now().strftime('%Y%m%d-%H%M')}.{writer_cls.extension}"
+    return {"message": f"{written} ردیف آماده دانلود است.", "rows": written, "filename": filename,
+            "media_type": writer_cls.media_type, "download_url": f"/api/jobs/{job.job_id}/download"}
+
+def job_import_users(job: JobContext, upload_path: str, filename: str, creator_id: int) -> Dict[str, Any]:
+    def on_chunk(inserted, failed):
+        job.check_cancelled()
+        job.progress(inserted + failed, message=f"{inserted} ردیف درج شد، {failed} ردیف خطا")
+    try:
+        with open(upload_path, "rb") as f:
+            return import_users_file(f, filename, creator_id, on_chunk=on_chunk)
+    finally:
+        os.remove(upload_path)
+
+def save_upload(fileobj, suffix: str) -> str:
+    """فایل آپلودی را (تکه‌تکه) در JOBS_DIR ذخیره می‌کند تا بعد از پایان درخواست هم در دسترس job باشد."""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    path = os.path.join(JOBS_DIR, f"upload-{uuid.uuid4().hex}{suffix}")
+    with open(path, "wb") as out:
+        shutil.copyfileobj(fileobj, out, 1024 * 1024)
+    return path
+
+# --- آمار داشبورد ---
+# نتیجه برای هر کارشناس (و یک کلید برای ادمین) کش می‌شود؛ هر نوشتن روی این جدول‌ها کل کش را باطل می‌کند
+# و TTL کوتاه فقط برای عوض شدن «امروز» و نوشتن‌های worker‌های دیگر است.
+DASHBOARD_CACHE_TTL = float(os.environ.get("CRM_DASHBOARD_CACHE_TTL", "30"))
+DASHBOARD_TABLES = {"users", "calls", "followups", "companies"}
+dashboard_cache = LRUTTLCache(maxsize=1024, ttl=DASHBOARD_CACHE_TTL)
+
+def tables_changed(*tables: str):
+    """پس از هر commit موفق در write_conn صدا زده می‌شود."""
+    if DASHBOARD_TABLES.intersection(tables):
+        dashboard_cache.clear()
+
+def _compute_dashboard_stats(owner_id: Optional[int]) -> Dict[str, int]:
+    conn = get_conn()
+    if owner_id is not None:
+        calls_from, fu_from = "calls cl JOIN users u ON u.id=cl.user_id", "followups f JOIN users u ON u.id=f.user_id"
+        owner_sql, params = "AND u.owner_id = ?", [owner_id]
+    else:
+        calls_from, fu_from, owner_sql, params = "calls cl", "followups f", "", []
+
+    # یک اسکن بازه‌ای روی idx_calls_datetime برای هر سه شمارش تماس
+    calls = conn.execute(f"""
+        SELECT COUNT(*) FILTER (WHERE cl.call_datetime >= date('now') AND cl.call_datetime < date('now','+1 day')),
+               COUNT(*) FILTER (WHERE cl.call_datetime >= date('now') AND cl.call_datetime < date('now','+1 day') AND cl.status='موفق'),
+               COUNT(*)
+        FROM {calls_from}
+        WHERE cl.call_datetime >= date('now','-7 day') {owner_sql};
+    """, params).fetchone()
+
+    overdue = conn.execute(f"""
+        SELECT COUNT(*) FROM {fu_from}
+        WHERE f.status='در حال انجام' AND f.due_date < date('now') {owner_sql};
+    """, params).fetchone()[0]
+
+    totals = conn.execute(f"""
+        SELECT (SELECT COUNT(*) FROM companies),
+               (SELECT COUNT(*) FROM users {'WHERE owner_id = ?' if owner_id is not None else ''});
+    """, params).fetchone()
+    conn.close()
+
+    return {
+        "calls_today": calls[0],
+        "calls_success_today": calls[1],
+        "last_7_days_calls": calls[2],
+        "overdue_followups": overdue,
+        "total_companies": totals[0],
+        "total_users": totals[1],
+    }
+
+def dashboard_stats(current_user: UserAuthInfo) -> Dict[str, Any]:
+    """آمار داشبورد به‌همراه cache_age_seconds (۰ یعنی همین حالا محاسبه شد)."""
+    owner_id = None if current_user.role == 'admin' else current_user.id
+    key = (owner_id, datetime.utcnow().date())
+    cached = dashboard_cache.get(key)
+    if cached is None:
+        cached = (time.monotonic(), _compute_dashboard_stats(owner_id))
+        dashboard_cache.set(key, cached)
+    computed_at, stats = cached
+    return {**stats, "cache_age_seconds": round(time.monotonic() - computed_at, 1)}
+
+# --- گزارش‌های تحلیلی (از روی جدول‌های rollup) ---
+# دوره‌ها از calendar_days (با alias cal) خوانده می‌شوند؛ هفته از شنبه شروع می‌شود و با تاریخ شنبه همان هفته مشخص می‌شود.
+# روزهای بیرون از بازه تقویم دوره NULL می‌گیرند.
+ANALYTICS_PERIODS = {"day": "{col}", "week": "cal.week_start", "jalali_month": "cal.jalali_month",
+                     "fiscal_month": "cal.fiscal_month", "total": "NULL"}
+MONTHLY_PERIODS = ("jalali_month", "fiscal_month", "total")
+
+def _calendar_join(period_sql: str, col: str) -> str:
+    return f"LEFT JOIN calendar_days cal ON cal.day = {col}" if "cal." in period_sql else ""
+_ANALYTICS_LABELS = {"product": "SELECT id, name FROM products", "company": "SELECT id, name FROM companies",
+                     "owner": "SELECT id, username FROM app_users"}
+
+def _analytics_labels(conn: sqlite3.Connection, kind: str, keys) -> Dict[Any, str]:
+    ids = [k for k in keys if k]
+    if kind not in _ANALYTICS_LABELS or not ids:
+        return {}
+    return dict(conn.execute(f"{_ANALYTICS_LABELS[kind]} WHERE id IN ({','.join('?' * len(ids))});", ids).fetchall())
+
+def _jalali_month_aligned(start: Optional[date], end: Optional[date]) -> bool:
+    """بازه دقیقاً از اول یک ماه شمسی تا آخر یک ماه شمسی است (پس ردیف‌های ماهانه rollup کافی‌اند)."""
+    one = timedelta(days=1)
+    return ((start is None or jalali_month(start.isoformat()) != jalali_month((start - one).isoformat())) and
+            (end is None or jalali_month(end.isoformat()) != jalali_month((end + one).isoformat())))
+
+def sales_analytics(by: str, period: str, start: Optional[date], end: Optional[date],
+                    statuses: List[str], owner_id: Optional[int]) -> List[Dict[str, Any]]:
+    """تعداد و مبلغ سفارش‌ها به تفکیک محصول/دسته/شرکت/مالک در هر دوره. برای محصول/دسته شمارش روی اقلام
+    سفارش است و به‌جای orders با نام lines برگردانده می‌شود."""
+    conn = get_conn()
+    count_name = "lines" if by in ("product", "category") else "orders"
+    where, params = [], []
+    if owner_id is not None and by != "owner":
+        # سهم یک مالک از هر محصول/دسته/شرکت در rollup نیست (ضرب مالک در همه کلیدها rollup را هم‌اندازه orders می‌کرد)؛
+        # سفارش‌های مخاطبین همان مالک با idx_users_owner و idx_orders_user (و اقلامشان با idx_order_items_order) خوانده می‌شوند
+        col, count = "o.order_date", "COUNT(*)"
+        if by == "company":
+            key, amount, source = "COALESCE(o.company_id, 0)", "TOTAL(o.total_amount)", "orders o"
+        else:
+            key = {"product": "COALESCE(i.product_id, 0)",
+                   "category": "COALESCE((SELECT p.category FROM products p WHERE p.id = i.product_id), '')"}[by]
+            amount, source = "TOTAL(i.quantity * i.unit_price)", "order_items i JOIN orders o ON o.id = i.order_id"
+        where.append("u.owner_id = ?"); params.append(owner_id)
+        _date_range_where(where, params, col, start, end)
+        period_sql = ANALYTICS_PERIODS[period].format(col=col)
+        source += f" JOIN users u ON u.id = o.user_id {_calendar_join(period_sql, col)}"
+        status_col = "o.status"
+    else:
+        source, col, key, count, amount, status_col = "sales_rollup", "bucket", "key", "SUM(orders)", "TOTAL(revenue)", "status"
+        # کوچک‌ترین دانه‌ای که دوره و بازه را دقیق پوشش می‌دهد: کل دوره ← ماه شمسی (ماه مالی هم یک ماه شمسی است) ← روز
+        monthly = period in MONTHLY_PERIODS and _jalali_month_aligned(start, end)
+        grain = "total" if period == "total" and start is None and end is None else SALES_GRAINS[monthly]
+        where += ["grain = ?", "dim = ?"]; params += [grain, by]
+        if owner_id is not None: where.append("key = ?"); params.append(owner_id)
+        if grain == "total":
+            period_sql = "NULL"
+        elif monthly:
+            if start: where.append("bucket >= ?"); params.append(jalali_month(start.isoformat()))
+            if end: where.append("bucket <= ?"); params.append(jalali_month(end.isoformat()))
+            period_sql = {"jalali_month": "bucket", "fiscal_month": "cal.fiscal_month"}.get(period, "NULL")
+            if period == "fiscal_month": source += " LEFT JOIN calendar_days cal ON cal.jalali = bucket || '/01'"
+        else:
+            _date_range_where(where, params, col, start, end)
+            period_sql = ANALYTICS_PERIODS[period].format(col=col)
+            source += " " + _calendar_join(period_sql, col)
+    if statuses: where.append(f"{status_col} IN ({','.join('?' * len(statuses))})"); params += statuses
+    rows = conn.execute(f"""
+        SELECT {period_sql} AS period, {key} AS key, {count} AS {count_name}, ROUND({amount}, 2) AS revenue
+        FROM {source} WHERE {' AND '.join(where)}
+        GROUP BY 1, 2 HAVING {count} <> 0 ORDER BY 1, 4 DESC;
+    """, params).fetchall()
+    labels = _analytics_labels(conn, by, {r["key"] for r in rows})
+    conn.close()
+    return [{**dict(r), "label": labels.get(r["key"]) or (r["key"] if by == "category" and r["key"] else "—")} for r in rows]
+
+def call_analytics(period: str, start: Optional[date], end: Optional[date], agent_id: Optional[int]) -> List[Dict[str, Any]]:
+    """تعداد تماس و نرخ موفقیت هر کارشناس (ثبت‌کننده تماس) در هر دوره."""
+    conn = get_conn()
+    where, params = ["1=1"], [CALL_STATUSES[1]]
+    _date_range_where(where, params, "r.day", start, end)
+    if agent_id is not None: where.append("r.agent_id = ?"); params.append(agent_id)
+    period_sql = ANALYTICS_PERIODS[period].format(col="r.day")
+    rows = conn.execute(f"""
+        SELECT {period_sql} AS period, r.agent_id AS agent_id, SUM(r.calls) AS calls,
+               TOTAL(r.calls) FILTER (WHERE r.status = ?) AS successful
+        FROM call_rollup r {_calendar_join(period_sql, 'r.day')} WHERE {' AND '.join(where)}
+        GROUP BY 1, 2 HAVING SUM(r.calls) <> 0 ORDER BY 1, 3 DESC;
+    """, params).fetchall()
+    labels = _analytics_labels(conn, "owner", {r["agent_id"] for r in rows})
+    conn.close()
+    return [{**dict(r), "successful": int(r["successful"]), "success_rate": round(r["successful"] / r["calls"], 4),
+             "agent": labels.get(r["agent_id"], "—")} for r in rows]
+
+def contact_funnel(start: Optional[date], end: Optional[date], owner_id: Optional[int]) -> Dict[str, Any]:
+    """قیف وضعیت مخاطبین (بر اساس تاریخ ایجاد): reached هر مرحله = مخاطبینی که الان در آن مرحله یا جلوتر هستند؛
+    مرحله اول همه مخاطبین است و «لغو» (آخرین وضعیت) جدا گزارش می‌شود."""
+    conn = get_conn()
+    where, params = ["1=1"], []
+    _date_range_where(where, params, "day", start, end)
+    if owner_id is not None: where.append("owner_id = ?"); params.append(owner_id)
+    counts = dict(conn.execute(f"SELECT status, SUM(contacts) FROM contact_rollup WHERE {' AND '.join(where)} GROUP BY status;",
+                               params).fetchall())
+    conn.close()
+    stages, cancelled = USER_STATUSES[:-1], USER_STATUSES[-1]
+    total = sum(counts.values())
+    steps, prev = [], total
+    for i, stage in enumerate(stages):
+        reached = total if i == 0 else sum(counts.get(s, 0) for s in stages[i:])
+        steps.append({"status": stage, "count": counts.get(stage, 0), "reached": reached,
+                      "conversion": round(reached / prev, 4) if prev else 0.0})
+        prev = reached
+    return {"total": total, "steps": steps, "cancelled": counts.get(cancelled, 0),
+            "conversion_total": round(steps[-1]["reached"] / total, 4) if total else 0.0}
+
+def get_user_profile_data(user_id: int) -> Optional[Dict[str, Any]]:
+    conn = get_conn()
+    u = conn.execute("""
+        SELECT u.id, u.first_name, u.last_name, u.full_name, c.name AS company_name, u.phone,
+                u.role, u.status, u.level, u.domain, u.province,
+                u.note, u.created_at, u.company_id, au.username AS sales_user
+        FROM users u
+        LEFT JOIN companies c ON c.id=u.company_id
+        LEFT JOIN app_users au ON au.id=u.owner_id
+        WHERE u.id=?;
+    """, (user_id,)).fetchone()
+    if not u:
+        conn.close()
+        return None
+
+    calls = conn.execute("SELECT * FROM calls WHERE user_id=? ORDER BY call_datetime DESC", (user_id,)).fetchall()
+    followups = conn.execute("SELECT * FROM followups WHERE user_id=? ORDER BY due_date DESC", (user_id,)).fetchall()
     
+    colleagues = []
+    if u["company_id"]:
+        colleagues = conn.execute("SELECT id, full_name, phone, role FROM users WHERE company_id=? AND id<>?", 
+                                 (u["company_id"], user_id)).fetchall()
     conn.close()
-    return results
+    
+    return {
+        "info": dict(u),
+        "calls": [dict(c) for c in calls],
+        "followups": [dict(f) for f in followups],
+        "colleagues": [dict(c) for c in colleagues]
+    }
+
+def get_company_profile_data(company_id: int) -> Optional[Dict[str, Any]]:
+    conn = get_conn()
+    c = conn.execute("SELECT * FROM companies WHERE id=?", (company_id,)).fetchone()
+    if not c:
+        conn.close()
+        return None
+
+    users = conn.execute("SELECT id, full_name, phone, role FROM users WHERE company_id=?", (company_id,)).fetchall()
+    calls = conn.execute("SELECT cl.* FROM calls cl JOIN users u ON u.id=cl.user_id WHERE u.company_id=? ORDER BY cl.call_datetime DESC", (company_id,)).fetchall()
+    followups = conn.execute("SELECT f.* FROM followups f JOIN users u ON u.id=f.user_id WHERE u.company_id=? ORDER BY f.due_date DESC", (company_id,)).fetchall()
+    conn.close()
+    
+    return {
+        "info": dict(c),
+        "users": [dict(u) for u in users],
+        "calls": [dict(c) for c in calls],
+        "followups": [dict(f) for f in followups]
+    }
 
 # --- توابع بکاپ ---
-def extract_db_from_zip(zip_bytes: bytes) -> Optional[bytes]:
+# بکاپ با Connection.backup و صفحه‌به‌صفحه گرفته می‌شود. اتصال مبدأ در تمام مدت یک تراکنش خواندنی باز نگه
+# می‌دارد: در حالت WAL این تراکنش نویسنده‌ها را متوقف نمی‌کند، و چون snapshot ثابت است، نوشتن‌های هم‌زمان
+# باعث شروع مجدد بکاپ نمی‌شوند (بدون آن، زیر بار نوشتن بکاپ مدام از اول شروع می‌شد).
+try:
+    import zstandard
+except Exception:
+    zstandard = None
+
+BACKUP_DIR = os.environ.get("CRM_BACKUP_DIR", "backups")
+BACKUP_PAGES_PER_STEP = int(os.environ.get("CRM_BACKUP_PAGES_PER_STEP", "1024"))
+BACKUP_STEP_SLEEP = float(os.environ.get("CRM_BACKUP_STEP_SLEEP_MS", "2")) / 1000
+SNAPSHOT_INTERVAL_MINUTES = float(os.environ.get("CRM_SNAPSHOT_INTERVAL_MINUTES", "360"))  # 0 = غیرفعال
+SNAPSHOT_KEEP = int(os.environ.get("CRM_SNAPSHOT_KEEP", "7"))
+SNAPSHOT_PREFIX = "crm-snapshot-"
+BACKUP_CHUNK = 1024 * 1024
+BACKUP_MEDIA_TYPES = {"db": "application/octet-stream", "zip": "application/zip", "zst": "application/zstd"}
+
+def backup_database_to(dest_path: str, progress=None) -> int:
+    """یک کپی سازگار از دیتابیس فعلی در dest_path می‌سازد و تعداد صفحات را برمی‌گرداند.
+    progress(copied_pages, total_pages) پس از هر گام صدا زده می‌شود."""
+    src = sqlite3.connect(DB_PATH, timeout=10)
+    dst = sqlite3.connect(dest_path)
+    pages = 0
     try:
-        with zipfile.ZipFile(io.BytesIO(zip_bytes), "r") as zf:
-            for info in zf.infolist():
-                if info.filename.lower().endswith(".db"):
-                    return zf.read(info)
-    except Exception:
-        return None
-    return None
+        src.execute("BEGIN;")
+        src.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()  # شروع snapshot خواندنی
+        def on_step(status_code, remaining, total):
+            nonlocal pages
+            pages = total
+            if progress: progress(total - remaining, total)
+            if BACKUP_STEP_SLEEP: time.sleep(BACKUP_STEP_SLEEP)
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=on_step)
+    finally:
+        src.rollback(); src.close(); dst.close()
+    return pages
+
+def iter_backup_file(path: str, fmt: str, arcname: str = "crm.db"):
+    """فایل بکاپ را تکه‌تکه و در صورت نیاز فشرده (zip یا zstd) تولید می‌کند."""
+    with open(path, "rb") as f:
+        if fmt == "db":
+            while chunk := f.read(BACKUP_CHUNK): yield chunk
+        elif fmt == "zip":
+            sink = _ChunkSink()
+            with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as zf, \
+                    zf.open(arcname, "w", force_zip64=True) as member:
+                while chunk := f.read(BACKUP_CHUNK):
+                    member.write(chunk)
+                    if data := sink.drain(): yield data
+            yield sink.drain()
+        elif fmt == "zst":
+            compressor = zstandard.ZstdCompressor(level=3).compressobj()
+            while chunk := f.read(BACKUP_CHUNK):
+                if data := compressor.compress(chunk): yield data
+            yield compressor.flush()
+        else:
+            raise ValueError(f"فرمت بکاپ نامعتبر: {fmt}")
+
+def backup_formats() -> List[str]:
+    return ["db", "zip"] + (["zst"] if zstandard is not None else [])
+
+def backup_to_temp() -> str:
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix="download-", suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    try:
+        backup_database_to(path)
+    except BaseException:
+        os.remove(path); raise
+    return path
+
+def stream_backup(path: str, fmt: str):
+    try:
+        yield from iter_backup_file(path, fmt)
+    finally:
+        if os.path.exists(path): os.remove(path)
+
+def list_snapshots() -> List[Dict[str, Any]]:
+    if not os.path.isdir(BACKUP_DIR): return []
+    items = []
+    for name in os.listdir(BACKUP_DIR):
+        if not name.startswith(SNAPSHOT_PREFIX) or name.endswith(".partial"): continue
+        st = os.stat(os.path.join(BACKUP_DIR, name))
+        items.append({"name": name, "size": st.st_size,
+                      "created_at": datetime.fromtimestamp(st.st_mtime).strftime(DB_DATETIME_FMT)})
+    return sorted(items, key=lambda x: x["name"], reverse=True)
+
+def create_snapshot(progress=None) -> Dict[str, Any]:
+    """snapshot فشرده در BACKUP_DIR؛ فقط SNAPSHOT_KEEP تای آخر نگه داشته می‌شوند."""
+    fmt = "zst" if zstandard is not None else "zip"
+    stamp, n = datetime.now().strftime('%Y%m%d-%H%M%S'), 0
+    name = f"{SNAPSHOT_PREFIX}{stamp}.db.{fmt}"
+    while os.path.exists(os.path.join(BACKUP_DIR, name)):
+        n += 1; name = f"{SNAPSHOT_PREFIX}{stamp}-{n}.db.{fmt}"
+    final_path = os.path.join(BACKUP_DIR, name)
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    fd, raw_path = tempfile.mkstemp(prefix="snapshot-", suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    try:
+        pages = backup_database_to(raw_path, progress=(lambda done, total: progress(done, total * 2)) if progress else None)
+        with open(final_path + ".partial", "wb") as out:
+            for chunk in iter_backup_file(raw_path, fmt): out.write(chunk)
+        os.replace(final_path + ".partial", final_path)
+    finally:
+        for path in (raw_path, final_path + ".partial"):
+            if os.path.exists(path): os.remove(path)
+    for old in list_snapshots()[SNAPSHOT_KEEP:]:
+        os.remove(os.path.join(BACKUP_DIR, old["name"]))
+    return {"message": f"snapshot {name} ساخته شد.", "name": name, "pages": pages,
+            "size": os.path.getsize(final_path)}
+
+def job_snapshot(job: "JobContext") -> Dict[str, Any]:
+    return create_snapshot(progress=job.progress)
+
+def snapshot_due_in() -> float:
+    """چند ثانیه تا snapshot بعدی مانده (بر اساس جدیدترین فایل، تا چند worker هم‌زمان snapshot تکراری نسازند)."""
+    snapshots = list_snapshots()
+    if not snapshots: return 0.0
+    newest = os.path.getmtime(os.path.join(BACKUP_DIR, snapshots[0]["name"]))
+    return max(0.0, newest + SNAPSHOT_INTERVAL_MINUTES * 60 - time.time())
+
+async def snapshot_scheduler():
+    while True:
+        try:
+            wait = await run_db(snapshot_due_in)
+            if wait > 0:
+                await asyncio.sleep(min(wait, 300)); continue
+            await run_db(job_runner.submit, "snapshot", job_snapshot)
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Warning: scheduled snapshot failed: {e}")
+            await asyncio.sleep(300)
 
 def validate_db_file(path: str) -> Tuple[bool, str]:
     try:
@@ -849,14 +3149,91 @@ def validate_db_file(path: str) -> Tuple[bool, str]:
     except Exception as e:
         return False, str(e)
 
+def _prepare_restored_db(path: str, restored_by: UserAuthInfo):
+    """ساختار نسخه فعلی را روی فایل بکاپ (پیش از جایگزینی) می‌سازد و ردیف jobهای در جریان و نشست‌های ادمین
+    بازیابی‌کننده را به آن منتقل می‌کند تا پس از جایگزینی، polling همین job و توکن ادمین بدون وقفه کار کنند.
+    نشست‌ها فقط اگر همان کاربر (id و username) در بکاپ باشد منتقل می‌شوند."""
+    live = get_conn()
+    jobs = live.execute(f"SELECT * FROM jobs WHERE status IN ({','.join('?' * len(JOB_ACTIVE_STATUSES))});",
+                        JOB_ACTIVE_STATUSES).fetchall()
+    sessions = live.execute("SELECT token, app_user_id, created_at, expires_at FROM sessions WHERE app_user_id=?;",
+                            (restored_by.id,)).fetchall()
+    live.close()
+    conn = sqlite3.connect(path, timeout=10)
+    try:
+        conn.execute("PRAGMA foreign_keys = ON;")
+        _create_schema(conn)
+        if jobs:
+            cols = jobs[0].keys()
+            conn.executemany(f"INSERT OR REPLACE INTO jobs ({', '.join(cols)}) VALUES ({','.join('?' * len(cols))});",
+                             [tuple(r) for r in jobs])
+        if sessions and conn.execute("SELECT 1 FROM app_users WHERE id=? AND username=?;",
+                                     (restored_by.id, restored_by.username)).fetchone():
+            conn.executemany("INSERT OR REPLACE INTO sessions (token, app_user_id, created_at, expires_at) VALUES (?,?,?,?);",
+                             [tuple(r) for r in sessions])
+        conn.commit()
+    finally:
+        conn.close()
+
+def job_restore_database(job: JobContext, upload_path: str, filename: str, restored_by: UserAuthInfo) -> Dict[str, Any]:
+    tmp_path = DB_PATH + ".restore_tmp"
+    try:
+        if filename.endswith(".zst"):
+            if zstandard is None:
+                raise ValueError("پشتیبانی از zstd نصب نیست")
+            job.progress(0.1, 1, "باز کردن فایل zstd")
+            with open(upload_path, "rb") as src, open(tmp_path, "wb") as dst:
+                zstandard.ZstdDecompressor().copy_stream(src, dst)
+        elif filename.endswith(".zip"):
+            job.progress(0.1, 1, "استخراج فایل ZIP")
+            try:
+                with zipfile.ZipFile(upload_path) as zf:
+                    member = next((i for i in zf.infolist() if i.filename.lower().endswith(".db")), None)
+                    if member is None:
+                        raise ValueError("در فایل ZIP هیچ فایل .db یافت نشد")
+                    with zf.open(member) as src, open(tmp_path, "wb") as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+            except zipfile.BadZipFile:
+                raise ValueError("فایل ZIP معتبر نیست")
+        else:
+            shutil.move(upload_path, tmp_path)
+        job.check_cancelled(force=True)
+
+        job.progress(0.4, 1, "اعتبارسنجی")
+        ok, msg = validate_db_file(tmp_path)
+        if not ok:
+            raise ValueError(f"اعتبارسنجی بکاپ ناموفق بود: {msg}")
+        job.check_cancelled(force=True)
+
+        job.progress(0.7, 1, "تهیه نسخه پشتیبان از دیتابیس فعلی")
+        try:
+            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+            os.makedirs(BACKUP_DIR, exist_ok=True)
+            backup_database_to(os.path.join(BACKUP_DIR, f"crm_before_restore_{ts}.db"))
+        except Exception as e:
+            print(f"Warning: Could not create backup: {e}")
+        job.check_cancelled(force=True)
+
+        # از این نقطه لغو پذیرفته نمی‌شود
+        job.progress(0.8, 1, "به‌روزرسانی ساختار بکاپ")
+        _prepare_restored_db(tmp_path, restored_by)
+        db_pool.swap_database(tmp_path)
+        session_cache.clear(); dashboard_cache.clear()
+        rotate_sync_epoch()
+        return {"message": "بازیابی با موفقیت انجام شد."}
+    finally:
+        for path in (upload_path, tmp_path):
+            if os.path.exists(path): os.remove(path)
+
 
 # ====================== 6. سیستم احراز هویت API ======================
 
 token_auth_scheme = HTTPBearer()
 
-def get_current_auth_user(creds: HTTPAuthorizationCredentials = Depends(token_auth_scheme)) -> UserAuthInfo:
-    token = creds.credentials
-    user_info = get_session_user(token)
+async def _auth_user_for_token(token: Optional[str]) -> UserAuthInfo:
+    user_info = session_cache.get(token) if token else None
+    if user_info is None and token:
+        user_info = await run_db(get_session_user, token)
     if not user_info:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -865,8 +3242,24 @@ def get_current_auth_user(creds: HTTPAuthorizationCredentials = Depends(token_au
         )
     return user_info
 
+async def get_current_auth_user(creds: HTTPAuthorizationCredentials = Depends(token_auth_scheme)) -> UserAuthInfo:
+    return await _auth_user_for_token(creds.credentials)
+
+# EventSource مرورگر نمی‌تواند هدر Authorization بفرستد؛ استریم رویدادها علاوه بر هدر، ?ticket= یک‌بار مصرف
+# از POST /api/events/ticket را می‌پذیرد (نه توکن سشن، که در لاگ‌های دسترسی ثبت می‌شد)
+optional_token_auth_scheme = HTTPBearer(auto_error=False)
+
+async def get_stream_auth_user(ticket: Optional[str] = None,
+                               creds: Optional[HTTPAuthorizationCredentials] = Depends(optional_token_auth_scheme)) -> UserAuthInfo:
+    if creds or not ticket:
+        return await _auth_user_for_token(creds.credentials if creds else None)
+    user_info = await run_db(consume_stream_ticket, ticket)
+    if not user_info:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="تیکت نامعتبر، منقضی یا قبلاً استفاده شده است")
+    return user_info
+
 # ✅ تابع get_admin_user اضافه شد
-def get_admin_user(current_user: UserAuthInfo = Depends(get_current_auth_user)):
+async def get_admin_user(current_user: UserAuthInfo = Depends(get_current_auth_user)):
     if current_user.role != "admin":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -874,17 +3267,114 @@ def get_admin_user(current_user: UserAuthInfo = Depends(get_current_auth_user)):
         )
     return current_user
 
+def page_params(limit: Optional[int], cursor: Optional[str]) -> Tuple[Optional[int], Optional[List[Any]]]:
+    """پارامترهای صفحه‌بندی را اعتبارسنجی می‌کند؛ بدون limit و cursor کل لیست برگردانده می‌شود."""
+    if not cursor: return limit, None
+    after = decode_cursor(cursor)
+    if after is None:
+        raise HTTPException(status_code=400, detail="cursor نامعتبر است")
+    return (limit or DEFAULT_PAGE_LIMIT), after
+
+ListOrPage = Union[List[Dict], Dict[str, Any]]
+
+def dictionary_encode(body: Dict[str, Any]) -> Dict[str, Any]:
+    """ستون‌های متنی پرتکرار یک پاسخ columnar (وضعیت، کارشناس، شرکت، ...) را به اندیس در
+    dictionaries[ستون] تبدیل می‌کند. ستونی کدگذاری می‌شود که تعداد مقادیر یکتای آن حداکثر نصف ردیف‌ها باشد."""
+    rows, dictionaries = body["rows"], {}
+    if not rows:
+        return {**body, "dictionaries": dictionaries}
+    columns = []
+    for name, values in zip(body["columns"], zip(*rows)):
+        distinct = dict.fromkeys(v for v in values if v is not None)
+        if not distinct or len(distinct) * 2 > len(values) or not all(isinstance(v, str) for v in distinct):
+            columns.append(values); continue
+        index = {v: i for i, v in enumerate(distinct)}
+        dictionaries[name] = list(distinct)
+        columns.append([None if v is None else index[v] for v in values])
+    return {**body, "dictionaries": dictionaries, "rows": list(zip(*columns))}
+
+def list_response(fn, format: str, dictionary: bool, jalali: bool, *args, **kwargs):
+    """تابع لیست را با قالب درخواستی اجرا می‌کند (در thread دیتابیس، از طریق run_db_json)."""
+    result = fn(*args, **kwargs, columnar=format == "columnar")
+    if jalali:
+        result = jalali_columns(result)
+    if dictionary and isinstance(result, dict) and "rows" in result:
+        result = dictionary_encode(result)
+    return result
+
+async def versioned_response(request: Request, tables: Tuple[str, ...], scope: str, fn, *args) -> Response:
+    etag, body = await run_db(versioned_payload, tables, scope, request.headers.get("if-none-match"), fn, *args)
+    # no-cache: مرورگر پاسخ را نگه می‌دارد ولی هر بار با If-None-Match اعتبارسنجی می‌کند
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if body is None:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def job_accepted(job_id: str, message: str) -> JSONResponse:
+    body = JobAccepted(message=message, job_id=job_id, status_url=f"/api/jobs/{job_id}")
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=body.dict())
+
+async def export_response(fn, name: str, format: str, background: bool = False,
+                          current_user: Optional[UserAuthInfo] = None, **filters) -> Response:
+    """فایل CSV/XLSX را با همان فیلترهای لیست به‌صورت استریم برمی‌گرداند؛ با background=true به‌صورت job
+    ساخته می‌شود و از /api/jobs/{id}/download دانلود می‌شود."""
+    writer_cls = EXPORT_WRITERS.get(format)
+    if writer_cls is None:
+        raise HTTPException(status_code=400, detail="فرمت خروجی باید csv یا xlsx باشد")
+    if background:
+        job_id = await run_db(job_runner.submit, "export", job_export, fn, name, writer_cls, filters,
+                              created_by=current_user.id if current_user else None)
+        return job_accepted(job_id, "خروجی در پس‌زمینه در حال ساخت است.")
+    filename = f"{name}-{datetime.now().strftime('%Y%m%d-%H%M')}.{writer_cls.extension}"
+    return StreamingResponse(_export_stream(fn, writer_cls(name), filters), media_type=writer_cls.media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+async def event_stream(owner_id: Optional[int]):
+    sub_id, queue = event_broker.subscribe(owner_id)
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"; continue  # اتصال‌های بیکار را proxyها نبندند
+            if item is None: return
+            yield _sse(*item)
+    finally:
+        event_broker.unsubscribe(sub_id)
+
 # ====================== 7. اندپوینت‌های API ======================
 
 @app.on_event("startup")
 async def startup_event():
     if not os.path.exists(DB_PATH):
-        init_db()
+        await run_db(init_db)
         print("Database initialized with default data.")
     else:
+        # init_db تکرارپذیر است؛ جدول‌ها/ستون‌ها/triggerهای جدید روی دیتابیس موجود هم ساخته می‌شوند
+        await run_db(init_db)
         print("Existing crm.db found.")
+    await run_db(job_runner.recover_interrupted)
+    await run_db(prune_change_log)
+    try:
+        written = await asyncio.to_thread(precompress_static, FRONTEND_DIR)
+        if written: print(f"{written} precompressed static file(s) written.")
+    except OSError as e:
+        print(f"⚠️ ساخت نسخه‌های فشرده فایل‌های فرانت ممکن نشد: {e}")
+    if SNAPSHOT_INTERVAL_MINUTES > 0:
+        app.state.snapshot_task = asyncio.create_task(snapshot_scheduler())
     print(f"Database at {DB_PATH} is ready.")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    event_broker.close()
+    task = getattr(app.state, "snapshot_task", None)
+    if task is not None:
+        task.cancel()
+
 @app.get("/api", tags=["General"])
 def get_root():
     return {"message": "FardaPack CRM API در حال اجرا است."}
@@ -894,86 +3384,75 @@ async def get_dashboard_stats(current_user: UserAuthInfo = Depends(get_current_a
     """
     آمار کلی داشبورد را برمی‌گرداند
     """
-    conn = get_conn()
-    
-    owner_clause = ""
-    params = ()
-    if current_user.role != 'admin':
-        owner_clause = f" WHERE owner_id = {current_user.id} "
-        owner_clause_joined_calls = f" WHERE u.owner_id = {current_user.id} "
-        owner_clause_joined_followups = f" WHERE u.owner_id = {current_user.id} "
-    else:
-        owner_clause = ""
-        owner_clause_joined_calls = ""
-        owner_clause_joined_followups = ""
-
-
-    calls_today = conn.execute(f"""
-        SELECT COUNT(cl.id) FROM calls cl 
-        JOIN users u ON u.id=cl.user_id 
-        {owner_clause_joined_calls}
-        {'AND' if owner_clause_joined_calls else 'WHERE'} date(cl.call_datetime)=date('now');
-    """).fetchone()[0]
-    
-    calls_success_today = conn.execute(f"""
-        SELECT COUNT(cl.id) FROM calls cl
-        JOIN users u ON u.id=cl.user_id
-        {owner_clause_joined_calls}
-        {'AND' if owner_clause_joined_calls else 'WHERE'} date(cl.call_datetime)=date('now') AND cl.status='موفق';
-    """).fetchone()[0]
-
-    last7 = conn.execute(f"""
-        SELECT COUNT(cl.id) FROM calls cl
-        JOIN users u ON u.id=cl.user_id
-        {owner_clause_joined_calls}
-        {'AND' if owner_clause_joined_calls else 'WHERE'} date(cl.call_datetime) >= date('now','-7 day');
-    """).fetchone()[0]
-    
-    overdue = conn.execute(f"""
-        SELECT COUNT(f.id) FROM followups f
-        JOIN users u ON u.id=f.user_id
-        {owner_clause_joined_followups}
-        {'AND' if owner_clause_joined_followups else 'WHERE'} f.status='در حال انجام' AND date(f.due_date) < date('now');
-    """).fetchone()[0]
-
-    total_companies = conn.execute("SELECT COUNT(*) FROM companies").fetchone()[0]
-    total_users = conn.execute(f"SELECT COUNT(*) FROM users {owner_clause}").fetchone()[0]
-    
-    conn.close()
-    
-    return {
-        "calls_today": calls_today,
-        "calls_success_today": calls_success_today,
-        "last_7_days_calls": last7,
-        "overdue_followups": overdue,
-        "total_companies": total_companies,
-        "total_users": total_users,
-    }
+    return await run_db(dashboard_stats, current_user)
 
 # --- اندپوینت‌های Auth ---
 @app.post("/api/login", response_model=TokenResponse, tags=["Auth"])
 async def login_for_access_token(data: LoginRequest):
-    user = auth_check(data.username, data.password)
+    user = await run_password_hash(auth_check, data.username, data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="نام کاربری یا رمز عبور اشتباه است",
         )
-    token = create_session(app_user_id=user["id"], days_valid=30)
+    token = await run_db(create_session, app_user_id=user["id"], days_valid=30)
     return TokenResponse(token=token, username=user["username"], role=user["role"])
 
 @app.post("/api/logout", response_model=MessageResponse, tags=["Auth"])
 async def logout(current_user: UserAuthInfo = Depends(get_current_auth_user),
                   creds: HTTPAuthorizationCredentials = Depends(token_auth_scheme)):
-    delete_session(creds.credentials)
+    await run_db(delete_session, creds.credentials)
     return {"message": "خروج با موفقیت انجام شد"}
 
 @app.get("/api/me", response_model=UserAuthInfo, tags=["Auth"])
 async def read_users_me(current_user: UserAuthInfo = Depends(get_current_auth_user)):
     return current_user
 
+@app.get("/api/search", response_model=List[Dict], tags=["General"])
+async def search(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100),
+                 current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    """جستجوی سریع مخاطبین و شرکت‌ها (نام، تلفن، حوزه، استان، یادداشت، آدرس) با نتایج رتبه‌بندی‌شده."""
+    enforce_owner = None if current_user.role == "admin" else current_user.id
+    return await run_db_json(search_all, q, limit, enforce_owner)
+
+@app.get("/api/changes", tags=["General"])
+async def get_changes(since: Optional[str] = None,
+                      limit: int = Query(CHANGES_DEFAULT_LIMIT, ge=1, le=CHANGES_MAX_LIMIT),
+                      current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    """تغییرات (درج/ویرایش/حذف) مخاطبین، شرکت‌ها، تماس‌ها، پیگیری‌ها، سفارش‌ها و محصولات بعد از cursor.
+    تا وقتی has_more=true است با cursor برگشتی دوباره صدا زده شود."""
+    enforce_owner = None if current_user.role == "admin" else current_user.id
+    return await run_db_json(changes_since, since, limit, enforce_owner)
+
+@app.post("/api/events/ticket", response_model=StreamTicketResponse, tags=["General"])
+async def create_events_ticket(current_user: UserAuthInfo = Depends(get_current_auth_user),
+                               creds: HTTPAuthorizationCredentials = Depends(token_auth_scheme)):
+    """تیکت یک‌بار مصرف برای new EventSource('/api/events?ticket=...')؛ برای هر اتصال (از جمله اتصال مجدد) تیکت تازه لازم است."""
+    ticket = await run_db(create_stream_ticket, creds.credentials)
+    return StreamTicketResponse(ticket=ticket, expires_in=STREAM_TICKET_TTL)
+
+@app.get("/api/events", tags=["General"])
+async def stream_events(current_user: UserAuthInfo = Depends(get_stream_auth_user)):
+    """استریم SSE رویدادهای تماس، پیگیری، تغییر کارشناس و سفارش (کارشناس فقط رویدادهای مخاطبین خودش را می‌گیرد).
+    هر رویداد جدول و IDها را دارد؛ ردیف‌ها با /api/changes گرفته می‌شوند و بعد از resync یا اتصال مجدد هم همان کافی است.
+    احراز هویت با هدر Authorization یا ?ticket= از POST /api/events/ticket."""
+    owner_id = None if current_user.role == "admin" else current_user.id
+    return StreamingResponse(event_stream(owner_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- لیست‌های مرجع برای فرم‌ها (فقط ID و نام، با ETag) ---
+@app.get("/api/lookups/users", response_model=List[Dict], tags=["Lookups"])
+async def lookup_users(request: Request, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    """مخاطبین (id, full_name, company_id) برای لیست‌های کشویی؛ کارشناس فقط مخاطبین خودش را می‌بیند."""
+    owner = None if current_user.role == "admin" else current_user.id
+    return await versioned_response(request, ("users",), f"users{owner or ''}", list_users_basic, owner)
+
+@app.get("/api/lookups/companies", response_model=List[Dict], tags=["Lookups"])
+async def lookup_companies(request: Request, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    return await versioned_response(request, ("companies",), "companies", list_companies, None)
+
 # --- اندپوینت‌های Users ---
-@app.get("/api/users", response_model=List[Dict], tags=["Users"])
+@app.get("/api/users", response_model=ListOrPage, tags=["Users"])
 async def get_users_list(
     first_q: Optional[str] = None,
     last_q: Optional[str] = None,
@@ -988,11 +3467,18 @@ async def get_users_list(
     statuses: Optional[List[str]] = Query(None),
     levels: Optional[List[str]] = Query(None), 
     owner_ids_filter: Optional[List[int]] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    count_only: bool = False,
+    format: str = Query("rows", pattern="^(rows|columnar)$"),
+    dictionary: bool = False,
+    jalali: bool = False,
     current_user: UserAuthInfo = Depends(get_current_auth_user)
 ):
     enforce_owner = None if current_user.role == "admin" else current_user.id
+    limit, after = page_params(limit, cursor)
     
-    users_data = df_users_advanced(
+    users_data = await run_db_json(list_response, df_users_advanced, format, dictionary, jalali, 
         first_q=first_q, last_q=last_q, 
         phone_q=phone_q, role_q=role_q, 
         domain_q=domain_q,
@@ -1002,81 +3488,97 @@ async def get_users_list(
         statuses=statuses or [],
         levels=levels or [], 
         owner_ids_filter=owner_ids_filter or [],
-        enforce_owner=enforce_owner
+        enforce_owner=enforce_owner,
+        limit=limit, after=after, count_only=count_only
     )
     return users_data
 
+@app.get("/api/users/export", tags=["Users"])
+async def export_users(
+    format: str = "csv",
+    first_q: Optional[str] = None,
+    last_q: Optional[str] = None,
+    phone_q: Optional[str] = None,
+    role_q: Optional[str] = None,
+    domain_q: Optional[str] = None,
+    created_from: Optional[date] = None,
+    created_to: Optional[date] = None,
+    has_open_task: Optional[bool] = None,
+    last_call_from: Optional[date] = None,
+    last_call_to: Optional[date] = None,
+    statuses: Optional[List[str]] = Query(None),
+    levels: Optional[List[str]] = Query(None),
+    owner_ids_filter: Optional[List[int]] = Query(None),
+    background: bool = False,
+    current_user: UserAuthInfo = Depends(get_admin_user)
+):
+    return await export_response(df_users_advanced, "users", format, background, current_user,
+        first_q=first_q, last_q=last_q, phone_q=phone_q, role_q=role_q, domain_q=domain_q,
+        created_from=created_from, created_to=created_to, has_open_task=has_open_task,
+        last_call_from=last_call_from, last_call_to=last_call_to,
+        statuses=statuses or [], levels=levels or [],
+        owner_ids_filter=owner_ids_filter or [], enforce_owner=None)
+
 @app.post("/api/users", response_model=MessageResponse, status_code=status.HTTP_201_CREATED, tags=["Users"])
 async def create_new_user(user_data: UserCreate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    ok, msg = create_user(user_data, current_user.id)
+    ok, msg = await run_db(create_user, user_data, current_user.id)
     if not ok:
         raise HTTPException(status_code=400, detail=msg)
     return {"message": msg}
 
 @app.put("/api/users/bulk-owner", response_model=MessageResponse, tags=["Users"])
 async def bulk_update_owner(data: BulkOwnerUpdate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    affected = bulk_update_users_owner(data.user_ids, data.new_owner_id, current_user)
+    if len(data.user_ids) > BULK_OWNER_JOB_THRESHOLD:
+        job_id = await run_db(job_runner.submit, "bulk_owner", job_bulk_update_owner,
+                              data.user_ids, data.new_owner_id, current_user, created_by=current_user.id)
+        return job_accepted(job_id, f"تغییر کارشناس {len(data.user_ids)} مخاطب در پس‌زمینه انجام می‌شود.")
+    affected = await run_db(bulk_update_users_owner, data.user_ids, data.new_owner_id, current_user)
     return {"message": f"کارشناس فروش {affected} مخاطب تغییر کرد."}
 
 @app.put("/api/users/{user_id}", response_model=MessageResponse, tags=["Users"])
 async def update_existing_user(user_id: int, user_data: UserUpdate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    ok, msg = update_user(user_id, user_data)
+    ok, msg = await run_db(update_user, user_id, user_data)
     if not ok:
         raise HTTPException(status_code=400, detail=msg)
     return {"message": msg}
 
-# ❌ توابع import/export اکسل غیرفعال شدند
 @app.get("/api/users/import-template", tags=["Users"])
-async def download_excel_template(current_user: UserAuthInfo = Depends(get_admin_user)):
-    raise HTTPException(
-        status_code=501, 
-        detail="امکان دانلود قالب اکسل در حال حاضر وجود ندارد. لطفاً از طریق رابط کاربری اقدام کنید."
-    )
+async def download_excel_template(format: str = "xlsx", current_user: UserAuthInfo = Depends(get_admin_user)):
+    writer_cls = EXPORT_WRITERS.get(format)
+    if writer_cls is None:
+        raise HTTPException(status_code=400, detail="فرمت خروجی باید csv یا xlsx باشد")
+    writer = writer_cls("contacts")
+    content = writer.start() + writer.rows(IMPORT_COLUMNS, []) + writer.finish()
+    return Response(content=content, media_type=writer_cls.media_type,
+                    headers={"Content-Disposition": f'attachment; filename="contacts_template.{writer_cls.extension}"'})
 
 @app.post("/api/users/import-excel", response_model=Dict[str, Any], tags=["Users"])
 async def import_users_from_excel(
     file: UploadFile = File(...), 
+    background: bool = False,
     current_user: UserAuthInfo = Depends(get_admin_user)
 ):
-    raise HTTPException(
-        status_code=501, 
-        detail="امکان ایمپورت از اکسل در حال حاضر وجود ندارد. لطفاً کاربران را به صورت دستی اضافه کنید."
-    )
+    if not (file.filename or "").lower().endswith((".xlsx", ".csv")):
+        raise HTTPException(status_code=400, detail="فایل باید .xlsx یا .csv باشد")
+    if background:
+        path = await run_db(save_upload, file.file, os.path.splitext(file.filename)[1].lower())
+        job_id = await run_db(job_runner.submit, "import_users", job_import_users, path, file.filename, current_user.id,
+                              created_by=current_user.id)
+        return job_accepted(job_id, "ایمپورت در پس‌زمینه شروع شد.")
+    try:
+        return await run_db(import_users_file, file.file, file.filename, current_user.id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/users/{user_id}/profile", tags=["Users"])
 async def get_user_profile(user_id: int, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    conn = get_conn()
-    u = conn.execute("""
-        SELECT u.id, u.first_name, u.last_name, u.full_name, c.name AS company_name, u.phone,
-                u.role, u.status, u.level, u.domain, u.province,
-                u.note, u.created_at, u.company_id, au.username AS sales_user
-        FROM users u
-        LEFT JOIN companies c ON c.id=u.company_id
-        LEFT JOIN app_users au ON au.id=u.owner_id
-        WHERE u.id=?;
-    """, (user_id,)).fetchone()
-    if not u:
-        conn.close()
+    profile = await run_db(get_user_profile_data, user_id)
+    if not profile:
         raise HTTPException(status_code=404, detail="کاربر یافت نشد")
-
-    calls = conn.execute("SELECT * FROM calls WHERE user_id=? ORDER BY call_datetime DESC", (user_id,)).fetchall()
-    followups = conn.execute("SELECT * FROM followups WHERE user_id=? ORDER BY due_date DESC", (user_id,)).fetchall()
-    
-    colleagues = []
-    if u["company_id"]:
-        colleagues = conn.execute("SELECT id, full_name, phone, role FROM users WHERE company_id=? AND id<>?", 
-                                 (u["company_id"], user_id)).fetchall()
-    conn.close()
-    
-    return {
-        "info": dict(u),
-        "calls": [dict(c) for c in calls],
-        "followups": [dict(f) for f in followups],
-        "colleagues": [dict(c) for c in colleagues]
-    }
+    return profile
 
 # --- اندپوینت‌های Companies ---
-@app.get("/api/companies", response_model=List[Dict], tags=["Companies"])
+@app.get("/api/companies", response_model=ListOrPage, tags=["Companies"])
 async def get_companies_list(
     q_name: Optional[str] = None,
     f_status: Optional[List[str]] = Query(None),
@@ -1085,156 +3587,301 @@ async def get_companies_list(
     created_to: Optional[date] = None,
     has_open_task: Optional[bool] = None,
     owner_ids_filter: Optional[List[int]] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    count_only: bool = False,
+    format: str = Query("rows", pattern="^(rows|columnar)$"),
+    dictionary: bool = False,
+    jalali: bool = False,
     current_user: UserAuthInfo = Depends(get_current_auth_user)
 ):
     enforce_owner = None if current_user.role == "admin" else current_user.id
-    companies_data = df_companies_advanced(
+    limit, after = page_params(limit, cursor)
+    companies_data = await run_db_json(list_response, df_companies_advanced, format, dictionary, jalali, 
         q_name=q_name, f_status=f_status or [], f_level=f_level or [],
         created_from=created_from, created_to=created_to,
         has_open_task=has_open_task,
         owner_ids_filter=owner_ids_filter or [],
-        enforce_owner=enforce_owner
+        enforce_owner=enforce_owner,
+        limit=limit, after=after, count_only=count_only
     )
     return companies_data
 
+@app.get("/api/companies/export", tags=["Companies"])
+async def export_companies(
+    format: str = "csv",
+    q_name: Optional[str] = None,
+    f_status: Optional[List[str]] = Query(None),
+    f_level: Optional[List[str]] = Query(None),
+    created_from: Optional[date] = None,
+    created_to: Optional[date] = None,
+    has_open_task: Optional[bool] = None,
+    owner_ids_filter: Optional[List[int]] = Query(None),
+    background: bool = False,
+    current_user: UserAuthInfo = Depends(get_admin_user)
+):
+    return await export_response(df_companies_advanced, "companies", format, background, current_user,
+        q_name=q_name, f_status=f_status or [], f_level=f_level or [],
+        created_from=created_from, created_to=created_to, has_open_task=has_open_task,
+        owner_ids_filter=owner_ids_filter or [], enforce_owner=None)
+
 @app.post("/api/companies", response_model=MessageResponse, status_code=status.HTTP_201_CREATED, tags=["Companies"])
 async def create_new_company(company_data: CompanyCreate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    create_company(company_data, current_user.id)
+    await run_db(create_company, company_data, current_user.id)
     return {"message": "شرکت ثبت شد"}
 
 @app.get("/api/companies/{company_id}/profile", tags=["Companies"])
 async def get_company_profile(company_id: int, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    conn = get_conn()
-    c = conn.execute("SELECT * FROM companies WHERE id=?", (company_id,)).fetchone()
-    if not c:
-        conn.close()
+    profile = await run_db(get_company_profile_data, company_id)
+    if not profile:
         raise HTTPException(status_code=404, detail="شرکت یافت نشد")
-
-    users = conn.execute("SELECT id, full_name, phone, role FROM users WHERE company_id=?", (company_id,)).fetchall()
-    calls = conn.execute("SELECT cl.* FROM calls cl JOIN users u ON u.id=cl.user_id WHERE u.company_id=? ORDER BY cl.call_datetime DESC", (company_id,)).fetchall()
-    followups = conn.execute("SELECT f.* FROM followups f JOIN users u ON u.id=f.user_id WHERE u.company_id=? ORDER BY f.due_date DESC", (company_id,)).fetchall()
-    conn.close()
-    
-    return {
-        "info": dict(c),
-        "users": [dict(u) for u in users],
-        "calls": [dict(c) for c in calls],
-        "followups": [dict(f) for f in followups]
-    }
+    return profile
 
 @app.put("/api/companies/{company_id}", response_model=MessageResponse, tags=["Companies"])
 async def update_existing_company(company_id: int, company_data: CompanyUpdate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    ok, msg = update_company(company_id, company_data)
+    ok, msg = await run_db(update_company, company_id, company_data)
     if not ok:
         raise HTTPException(status_code=400, detail=msg)
     return {"message": msg}
 
 # --- اندپوینت‌های Calls ---
-@app.get("/api/calls", response_model=List[Dict], tags=["Calls"])
+@app.get("/api/calls", response_model=ListOrPage, tags=["Calls"])
 async def get_calls_list(
     name_query: Optional[str] = None,
     statuses: Optional[List[str]] = Query(None),
     start: Optional[date] = None,
     end: Optional[date] = None,
     owner_ids_filter: Optional[List[int]] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    count_only: bool = False,
+    format: str = Query("rows", pattern="^(rows|columnar)$"),
+    dictionary: bool = False,
+    jalali: bool = False,
     current_user: UserAuthInfo = Depends(get_current_auth_user)
 ):
     enforce_owner = None if current_user.role == "admin" else current_user.id
-    calls_data = df_calls_by_filters(
+    limit, after = page_params(limit, cursor)
+    calls_data = await run_db_json(list_response, df_calls_by_filters, format, dictionary, jalali, 
         name_query=name_query, statuses=statuses or [],
         start=start, end=end,
         owner_ids_filter=owner_ids_filter or [],
-        enforce_owner=enforce_owner
+        enforce_owner=enforce_owner,
+        limit=limit, after=after, count_only=count_only
     )
     return calls_data
 
+@app.get("/api/calls/export", tags=["Calls"])
+async def export_calls(
+    format: str = "csv",
+    name_query: Optional[str] = None,
+    statuses: Optional[List[str]] = Query(None),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    owner_ids_filter: Optional[List[int]] = Query(None),
+    background: bool = False,
+    current_user: UserAuthInfo = Depends(get_admin_user)
+):
+    return await export_response(df_calls_by_filters, "calls", format, background, current_user,
+        name_query=name_query, statuses=statuses or [], start=start, end=end,
+        owner_ids_filter=owner_ids_filter or [], enforce_owner=None)
+
 @app.post("/api/calls", response_model=MessageResponse, status_code=status.HTTP_201_CREATED, tags=["Calls"])
 async def create_new_call(call_data: CallCreate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    create_call(call_data, current_user.id)
+    await run_db(create_call, call_data, current_user.id)
     return {"message": "تماس ثبت شد"}
 
+@app.post("/api/calls/bulk", response_model=BulkWriteResult, tags=["Calls"])
+async def create_calls_bulk(data: CallBulkCreate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    return await run_db(bulk_create_calls, data.items, current_user.id)
+
 # --- اندپوینت‌های Followups ---
-@app.get("/api/followups", response_model=List[Dict], tags=["Followups"])
+@app.get("/api/followups", response_model=ListOrPage, tags=["Followups"])
 async def get_followups_list(
     name_query: Optional[str] = None,
     statuses: Optional[List[str]] = Query(None),
     start: Optional[date] = None,
     end: Optional[date] = None,
     owner_ids_filter: Optional[List[int]] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    count_only: bool = False,
+    format: str = Query("rows", pattern="^(rows|columnar)$"),
+    dictionary: bool = False,
+    jalali: bool = False,
     current_user: UserAuthInfo = Depends(get_current_auth_user)
 ):
     enforce_owner = None if current_user.role == "admin" else current_user.id
-    followups_data = df_followups_by_filters(
+    limit, after = page_params(limit, cursor)
+    followups_data = await run_db_json(list_response, df_followups_by_filters, format, dictionary, jalali, 
         name_query=name_query, statuses=statuses or [],
         start=start, end=end,
         owner_ids_filter=owner_ids_filter or [],
-        enforce_owner=enforce_owner
+        enforce_owner=enforce_owner,
+        limit=limit, after=after, count_only=count_only
     )
     return followups_data
 
+@app.get("/api/followups/export", tags=["Followups"])
+async def export_followups(
+    format: str = "csv",
+    name_query: Optional[str] = None,
+    statuses: Optional[List[str]] = Query(None),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    owner_ids_filter: Optional[List[int]] = Query(None),
+    background: bool = False,
+    current_user: UserAuthInfo = Depends(get_admin_user)
+):
+    return await export_response(df_followups_by_filters, "followups", format, background, current_user,
+        name_query=name_query, statuses=statuses or [], start=start, end=end,
+        owner_ids_filter=owner_ids_filter or [], enforce_owner=None)
+
 @app.post("/api/followups", response_model=MessageResponse, status_code=status.HTTP_201_CREATED, tags=["Followups"])
 async def create_new_followup(fu_data: FollowupCreate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    create_followup(fu_data, current_user.id)
+    await run_db(create_followup, fu_data, current_user.id)
     return {"message": "پیگیری ثبت شد"}
 
+@app.post("/api/followups/bulk", response_model=BulkWriteResult, tags=["Followups"])
+async def create_followups_bulk(data: FollowupBulkCreate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    return await run_db(bulk_create_followups, data.items, current_user.id)
+
+@app.put("/api/followups/bulk-status", response_model=BulkWriteResult, tags=["Followups"])
+async def update_followups_status_bulk(data: FollowupBulkStatusUpdate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    return await run_db(bulk_update_followups_status, data.items)
+
 @app.put("/api/followups/{task_id}/status", response_model=MessageResponse, tags=["Followups"])
 async def update_task_status(task_id: int, data: FollowupStatusUpdate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
     if data.status not in TASK_STATUSES:
         raise HTTPException(status_code=400, detail="وضعیت نامعتبر است")
-    update_followup_status(task_id, data.status)
+    await run_db(update_followup_status, task_id, data.status)
     return {"message": "وضعیت پیگیری به‌روزرسانی شد"}
 
 # --- اندپوینت‌های Products ---
 @app.get("/api/products", response_model=List[Dict], tags=["Products"])
-async def get_products(current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    return list_products()
+async def get_products(request: Request, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    return await versioned_response(request, ("products",), "products", list_products)
 
 @app.post("/api/products", response_model=MessageResponse, status_code=status.HTTP_201_CREATED, tags=["Products"])
 async def create_new_product(prod_data: ProductCreate, current_user: UserAuthInfo = Depends(get_admin_user)):
-    create_product(prod_data)
+    await run_db(create_product, prod_data)
     return {"message": "محصول اضافه شد"}
 
 @app.put("/api/products/{product_id}", response_model=MessageResponse, tags=["Products"])
 async def update_existing_product(product_id: int, prod_data: ProductCreate, current_user: UserAuthInfo = Depends(get_admin_user)):
-    update_product(product_id, prod_data)
+    await run_db(update_product, product_id, prod_data)
     return {"message": "محصول به‌روزرسانی شد"}
 
 # --- اندپوینت‌های Orders ---
-@app.get("/api/orders", response_model=List[Dict], tags=["Orders"])
+@app.get("/api/orders", response_model=ListOrPage, tags=["Orders"])
 async def get_orders_list(
     user_filter: Optional[int] = None,
     company_filter: Optional[int] = None,
     product_filter: Optional[int] = None,
     status_filter: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    owner_ids_filter: Optional[List[int]] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    count_only: bool = False,
+    format: str = Query("rows", pattern="^(rows|columnar)$"),
+    dictionary: bool = False,
+    jalali: bool = False,
     current_user: UserAuthInfo = Depends(get_current_auth_user)
 ):
-    orders_data = df_orders_by_filters(user_filter, company_filter, product_filter, status_filter)
+    limit, after = page_params(limit, cursor)
+    orders_data = await run_db_json(list_response, df_orders_by_filters, format, dictionary, jalali, user_filter, company_filter, product_filter, status_filter,
+                                       start=start, end=end, owner_ids_filter=owner_ids_filter or [],
+                                       limit=limit, after=after, count_only=count_only)
     return orders_data
 
+@app.get("/api/orders/export", tags=["Orders"])
+async def export_orders(
+    format: str = "csv",
+    user_filter: Optional[int] = None,
+    company_filter: Optional[int] = None,
+    product_filter: Optional[int] = None,
+    status_filter: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    owner_ids_filter: Optional[List[int]] = Query(None),
+    background: bool = False,
+    current_user: UserAuthInfo = Depends(get_admin_user)
+):
+    return await export_response(df_orders_by_filters, "orders", format, background, current_user,
+        user_filter=user_filter, company_filter=company_filter,
+        product_filter=product_filter, status_filter=status_filter,
+        start=start, end=end, owner_ids_filter=owner_ids_filter or [])
+
+@app.get("/api/orders/{order_id}/items", response_model=List[Dict], tags=["Orders"])
+async def get_order_items(order_id: int, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    items = await run_db(list_order_items, order_id)
+    if items is None:
+        raise HTTPException(status_code=404, detail="سفارش یافت نشد")
+    return items
+
 @app.post("/api/orders", response_model=MessageResponse, status_code=status.HTTP_201_CREATED, tags=["Orders"])
 async def create_new_order(order_data: OrderCreate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    create_order(order_data)
-    return {"message": "سفارش ثبت شد"}
+    ok, msg = await run_db(create_order, order_data)
+    if not ok:
+        raise HTTPException(status_code=400, detail=msg)
+    return {"message": msg}
 
 @app.put("/api/orders/{order_id}", response_model=MessageResponse, tags=["Orders"])
 async def update_existing_order(order_id: int, order_data: OrderCreate, current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    ok, msg = update_order(order_id, order_data)
+    ok, msg = await run_db(update_order, order_id, order_data)
     if not ok:
         raise HTTPException(status_code=400, detail=msg)
     return {"message": msg}
 
+# --- اندپوینت‌های Analytics ---
+# کارشناس فقط داده مخاطبین/تماس‌های خودش را می‌بیند؛ ادمین می‌تواند با owner_id/agent_id فیلتر کند.
+ANALYTICS_PERIOD_PATTERN = f"^({'|'.join(ANALYTICS_PERIODS)})$"
+
+@app.get("/api/analytics/revenue", response_model=List[Dict], tags=["Analytics"])
+async def get_revenue_analytics(
+    by: str = Query("product", pattern=f"^({'|'.join(SALES_DIMENSIONS)}|owner)$"),
+    period: str = Query("jalali_month", pattern=ANALYTICS_PERIOD_PATTERN),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    statuses: Optional[List[str]] = Query(None),
+    owner_id: Optional[int] = None,
+    current_user: UserAuthInfo = Depends(get_current_auth_user)
+):
+    if current_user.role != "admin": owner_id = current_user.id
+    return await run_db_json(sales_analytics, by, period, start, end, statuses or [], owner_id)
+
+@app.get("/api/analytics/calls", response_model=List[Dict], tags=["Analytics"])
+async def get_call_analytics(
+    period: str = Query("jalali_month", pattern=ANALYTICS_PERIOD_PATTERN),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    agent_id: Optional[int] = None,
+    current_user: UserAuthInfo = Depends(get_current_auth_user)
+):
+    if current_user.role != "admin": agent_id = current_user.id
+    return await run_db_json(call_analytics, period, start, end, agent_id)
+
+@app.get("/api/analytics/funnel", tags=["Analytics"])
+async def get_contact_funnel(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    owner_id: Optional[int] = None,
+    current_user: UserAuthInfo = Depends(get_current_auth_user)
+):
+    if current_user.role != "admin": owner_id = current_user.id
+    return await run_db_json(contact_funnel, start, end, owner_id)
+
 # --- اندپوینت‌های Admin ---
 @app.get("/api/admin/app-users", response_model=List[Dict], tags=["Admin"])
-async def get_app_users(current_user: UserAuthInfo = Depends(get_current_auth_user)):
-    return list_sales_accounts_including_admins()
+async def get_app_users(request: Request, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    return await versioned_response(request, ("app_users",), "app_users", list_sales_accounts_including_admins)
 
 @app.post("/api/admin/app-users", response_model=MessageResponse, tags=["Admin"])
 async def create_new_app_user(data: AppUserCreate, current_user: UserAuthInfo = Depends(get_admin_user)):
     try:
-        conn = get_conn()
-        conn.execute("INSERT INTO app_users (username,password_sha256,role,linked_user_id) VALUES (?,?,?,?);",
-                     (data.username.strip(), sha256(data.password), data.role, data.linked_user_id))
-        conn.commit(); conn.close()
+        await run_password_hash(create_app_user, data)
         return {"message": "کاربر ایجاد شد."}
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="این نام کاربری قبلاً وجود دارد.")
@@ -1244,11 +3891,7 @@ async def update_app_user_password(user_id: int, data: PasswordUpdate, current_u
     if not data.new_password or len(data.new_password) < 6:
         raise HTTPException(status_code=400, detail="رمز عبور جدید باید حداقل 6 کاراکتر باشد")
     
-    new_pass_sha256 = sha256(data.new_password)
-    conn = get_conn()
-    conn.execute("UPDATE app_users SET password_sha256 = ? WHERE id = ?", (new_pass_sha256, user_id))
-    conn.commit()
-    conn.close()
+    await run_password_hash(set_app_user_password, user_id, data.new_password)
     return {"message": "رمز عبور کاربر با موفقیت به‌روزرسانی شد"}
 
 @app.delete("/api/admin/app-users/{user_id}", response_model=MessageResponse, tags=["Admin"])
@@ -1256,79 +3899,194 @@ async def delete_app_user(user_id: int, current_user: UserAuthInfo = Depends(get
     if user_id == current_user.id:
         raise HTTPException(status_code=400, detail="شما نمی‌توانید حساب کاربری خودتان را حذف کنید")
     
-    conn = get_conn()
-    cur = conn.execute("DELETE FROM app_users WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
-    if cur.rowcount == 0:
+    if await run_db(remove_app_user, user_id) == 0:
         raise HTTPException(status_code=404, detail="کاربر یافت نشد")
     return {"message": "کاربر با موفقیت حذف شد"}
 
+@app.get("/api/admin/runtime-stats", tags=["Admin"])
+async def get_runtime_stats(current_user: UserAuthInfo = Depends(get_admin_user)):
+    return {"db_pool": db_pool.stats(), "db_workers": DB_WORKERS, "session_cache": session_cache.stats(),
+            "dashboard_cache": dashboard_cache.stats(), "jobs": job_runner.stats(), "events": event_broker.stats(),
+            "lookup_cache": lookup_cache.stats()}
+
 @app.get("/api/admin/backup-db", tags=["Admin"])
-async def download_database_backup(current_user: UserAuthInfo = Depends(get_admin_user)):
+async def download_database_backup(format: str = "db", current_user: UserAuthInfo = Depends(get_admin_user)):
+    """بکاپ آنلاین (سازگار حتی زیر بار نوشتن) به‌صورت استریم؛ format: db، zip یا zst."""
+    if format not in backup_formats():
+        raise HTTPException(status_code=400, detail=f"فرمت بکاپ باید یکی از {', '.join(backup_formats())} باشد")
     if not os.path.exists(DB_PATH):
         raise HTTPException(status_code=404, detail="فایل دیتابیس یافت نشد")
-    return FileResponse(DB_PATH, media_type="application/octet-stream", filename="crm_backup.db")
+    path = await run_db(backup_to_temp)
+    filename = "crm_backup.db" + ("" if format == "db" else f".{format}")
+    return StreamingResponse(stream_backup(path, format), media_type=BACKUP_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
-@app.post("/api/admin/restore-db", response_model=MessageResponse, tags=["Admin"])
-async def restore_database(file: UploadFile = File(...), current_user: UserAuthInfo = Depends(get_admin_user)):
-    if not (file.filename.endswith(".db") or file.filename.endswith(".zip")):
-        raise HTTPException(status_code=400, detail="فایل باید .db یا .zip باشد")
-    
-    data = await file.read()
-    if len(data) == 0:
-        raise HTTPException(status_code=400, detail="فایل خالی است")
+@app.get("/api/admin/snapshots", response_model=List[Dict], tags=["Admin"])
+async def get_snapshots(current_user: UserAuthInfo = Depends(get_admin_user)):
+    return await run_db(list_snapshots)
 
-    if file.filename.endswith(".zip"):
-        extracted = extract_db_from_zip(data)
-        if not extracted:
-            raise HTTPException(status_code=400, detail="در فایل ZIP هیچ فایل .db یافت نشد")
-        data = extracted
-    
-    tmp_path = "_restore_tmp.db"
-    try:
-        with open(tmp_path, "wb") as f: f.write(data)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"خطا در نوشتن فایل موقت: {e}")
+@app.post("/api/admin/snapshots", response_model=JobAccepted, status_code=status.HTTP_202_ACCEPTED, tags=["Admin"])
+async def create_snapshot_now(current_user: UserAuthInfo = Depends(get_admin_user)):
+    job_id = await run_db(job_runner.submit, "snapshot", job_snapshot, created_by=current_user.id)
+    return job_accepted(job_id, "snapshot در پس‌زمینه ساخته می‌شود.")
 
-    ok, msg = validate_db_file(tmp_path)
-    if not ok:
-        os.remove(tmp_path)
-        raise HTTPException(status_code=400, detail=f"اعتبارسنجی بکاپ ناموفق بود: {msg}")
+@app.post("/api/admin/restore-db", response_model=JobAccepted, status_code=status.HTTP_202_ACCEPTED, tags=["Admin"])
+async def restore_database(file: UploadFile = File(...), current_user: UserAuthInfo = Depends(get_admin_user)):
+    """فایل ذخیره و بازیابی به‌صورت job انجام می‌شود؛ وضعیت از status_url قابل پیگیری است."""
+    if not file.filename.endswith((".db", ".zip", ".zst")):
+        raise HTTPException(status_code=400, detail="فایل باید .db، .zip یا .zst باشد")
     
-    try:
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_name = f"crm_before_restore_{ts}.db"
-        shutil.copyfile(DB_PATH, backup_name)
-    except Exception as e:
-        print(f"Warning: Could not create backup: {e}")
-
-    try:
-        os.replace(tmp_path, DB_PATH)
-    except Exception as e:
-        if os.path.exists(tmp_path): os.remove(tmp_path)
-        raise HTTPException(status_code=500, detail=f"جایگزینی دیتابیس ناموفق بود: {e}")
+    path = await run_db(save_upload, file.file, os.path.splitext(file.filename)[1])
+    if os.path.getsize(path) == 0:
+        os.remove(path)
+        raise HTTPException(status_code=400, detail="فایل خالی است")
 
-    return {"message": "بازیابی با موفقیت انجام شد. سرور را ری‌استارت کنید."}
+    job_id = await run_db(job_runner.submit, "restore", job_restore_database, path, file.filename, current_user,
+                          created_by=current_user.id)
+    return job_accepted(job_id, "بازیابی در پس‌زمینه شروع شد؛ وضعیت را از بخش کارها پیگیری کنید.")
+
+# --- اندپوینت‌های Jobs ---
+@app.get("/api/jobs", response_model=List[Dict], tags=["Jobs"])
+async def get_jobs(limit: int = Query(50, ge=1, le=500), current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    return await run_db(list_jobs, None if current_user.role == "admin" else current_user.id, limit)
+
+async def _get_visible_job(job_id: str, current_user: UserAuthInfo) -> Dict[str, Any]:
+    job = await run_db(get_job, job_id)
+    if not job or (current_user.role != "admin" and job["created_by"] != current_user.id):
+        raise HTTPException(status_code=404, detail="کار یافت نشد")
+    return job
+
+@app.get("/api/jobs/{job_id}", tags=["Jobs"])
+async def get_job_status(job_id: str, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    return await _get_visible_job(job_id, current_user)
+
+@app.post("/api/jobs/{job_id}/cancel", response_model=MessageResponse, tags=["Jobs"])
+async def cancel_job(job_id: str, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    await _get_visible_job(job_id, current_user)
+    if not await run_db(job_runner.cancel, job_id):
+        raise HTTPException(status_code=400, detail="این کار در حال اجرا نیست")
+    return {"message": "درخواست لغو ثبت شد"}
+
+@app.get("/api/jobs/{job_id}/download", tags=["Jobs"])
+async def download_job_result(job_id: str, current_user: UserAuthInfo = Depends(get_current_auth_user)):
+    job = await _get_visible_job(job_id, current_user)
+    result = job["result"] or {}
+    path = os.path.join(JOBS_DIR, f"{job_id}.{os.path.splitext(result.get('filename', ''))[1].lstrip('.')}")
+    if job["status"] != "done" or "filename" not in result or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="فایلی برای این کار وجود ندارد")
+    return FileResponse(path, media_type=result["media_type"], filename=result["filename"])
 
 # ====================== 8. سرویس‌دهی فرانت‌اند (Vue.js / dist) ======================
 # این بخش باید پس از تعریف تمام اندپوینت‌های API قرار گیرد.
-
-# 1. Mount کردن پوشه 'dist' در روت اصلی ('/') برای سرو کردن دارایی‌های استاتیک (CSS, JS)
-# 'html=True' تضمین می‌کند که index.html برای روت '/' سرو شود.
-app.mount(
-    "/",  
-    StaticFiles(directory="dist", html=True), 
-    name="frontend_static"
-)
-
-# 2. روت Catch-all برای مدیریت SPA History Mode
-# اگر روت مورد نظر در API یا StaticFiles یافت نشد (مثل /users یا /settings)، 
-# آن را به فایل index.html هدایت می‌کند.
-@app.get("/{full_path:path}", include_in_schema=False)
-async def serve_frontend_fallback(full_path: str):
-    # مسیر فایل index.html که در پوشه dist قرار دارد.
-    return FileResponse(os.path.join("dist", "index.html"))
+# - فایل‌های assets/ نام hash‌دار Vite دارند و محتوایشان هرگز عوض نمی‌شود: یک سال با immutable کش می‌شوند.
+# - نسخه‌های .br/.gz که precompress_static در startup کنار فایل‌ها می‌سازد بر اساس Accept-Encoding انتخاب
+#   می‌شوند (CompressionMiddleware چون Content-Encoding ست شده دوباره فشرده نمی‌کند).
+# - index.html (روت '/' و هر مسیر SPA مثل /users) از حافظه با ETag و no-cache سرو می‌شود؛ مرورگر فقط
+#   If-None-Match می‌فرستد و 304 می‌گیرد، و بعد از deploy جدید (تغییر mtime/اندازه) نسخه تازه خوانده می‌شود.
+FRONTEND_DIR = os.environ.get("CRM_FRONTEND_DIR", "dist")
+FRONTEND_ASSETS_DIR = "assets"
+STATIC_PRECOMPRESS_EXTS = (".js", ".css", ".html", ".svg", ".json", ".ico", ".txt", ".map")
+STATIC_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))  # به ترتیب اولویت
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def _static_compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    c = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+def precompress_static(directory: str = FRONTEND_DIR) -> int:
+    """نسخه‌های .gz (و .br اگر brotli نصب باشد) فایل‌های متنی dist را کنارشان می‌سازد؛ فقط اگر نباشند یا قدیمی‌تر از فایل باشند."""
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(STATIC_PRECOMPRESS_EXTS):
+                continue
+            path = os.path.join(root, name)
+            mtime, data = os.path.getmtime(path), None
+            for encoding, ext in STATIC_ENCODINGS:
+                target = path + ext
+                if (encoding == "br" and brotli is None) or (os.path.exists(target) and os.path.getmtime(target) >= mtime):
+                    continue
+                if data is None:
+                    with open(path, "rb") as f: data = f.read()
+                if len(data) < COMPRESS_MIN_SIZE:
+                    break
+                blob = _static_compress(data, encoding)
+                if len(blob) >= len(data):
+                    continue
+                with open(target + ".tmp", "wb") as f: f.write(blob)
+                os.replace(target + ".tmp", target)
+                written += 1
+    return written
+
+class FrontendStaticFiles(StaticFiles):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._index = None  # ((mtime_ns, size), hash, {encoding: bytes})
+
+    async def get_response(self, path: str, scope) -> Response:
+        if path in (".", "index.html"):
+            return self.index_response(scope)
+        try:
+            return await super().get_response(path, scope)
+        except StarletteHTTPException as e:
+            # مسیرهای SPA (بدون پسوند) index.html می‌گیرند؛ فایل گم‌شده (مثلاً chunk قدیمی) و /api/... همان 404 می‌مانند
+            if e.status_code != 404 or os.path.splitext(path)[1] or path.split(os.sep)[0] == "api":
+                raise
+            return self.index_response(scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        extensions = dict(STATIC_ENCODINGS)
+        full_path, response = str(full_path), None
+        for encoding in preferred_encodings(request_headers.get("accept-encoding", ""), extensions):
+            ext = extensions[encoding]
+            try:
+                variant_stat = os.stat(full_path + ext)
+            except OSError:
+                continue
+            response = FileResponse(full_path + ext, status_code=status_code, stat_result=variant_stat, method=scope["method"],
+                                    media_type=mimetypes.guess_type(full_path)[0] or "text/plain")
+            response.headers["Content-Encoding"] = encoding
+            break
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, method=scope["method"])
+        hashed = os.path.relpath(full_path, os.path.realpath(self.directory)).split(os.sep)[0] == FRONTEND_ASSETS_DIR
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if hashed else "no-cache"
+        if full_path.endswith(STATIC_PRECOMPRESS_EXTS):
+            response.headers.add_vary_header("Accept-Encoding")
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def _load_index(self) -> tuple:
+        path = os.path.join(self.directory, "index.html")
+        st = os.stat(path)
+        cached = self._index
+        if cached is None or cached[0] != (st.st_mtime_ns, st.st_size):
+            with open(path, "rb") as f: body = f.read()
+            variants = {None: body, "gzip": _static_compress(body, "gzip")}
+            if brotli is not None:
+                variants["br"] = _static_compress(body, "br")
+            cached = self._index = ((st.st_mtime_ns, st.st_size), hashlib.md5(body).hexdigest()[:20], variants)
+        return cached
+
+    def index_response(self, scope) -> Response:
+        _, digest, variants = self._load_index()
+        request_headers = Headers(scope=scope)
+        encoding = next(iter(preferred_encodings(request_headers.get("accept-encoding", ""),
+                                                 [e for e, _ in STATIC_ENCODINGS if e in variants])), None)
+        etag = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if etag_matches(request_headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(variants[encoding], media_type="text/html", headers=headers)
+
+# باید آخرین route باشد (پس از تمام اندپوینت‌های API)
+app.mount("/", FrontendStaticFiles(directory=FRONTEND_DIR, html=True), name="frontend_static")
 
 
 # ====================== 9. اجرای سرور ======================